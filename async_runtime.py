@@ -0,0 +1,134 @@
+import logging
+from collections import deque
+
+import anyio
+import httpx
+
+from metrics import histogram, timed
+
+# Includes the long-poll wait, so most calls land near the poll timeout
+GET_UPDATES_SECONDS = histogram("telegram_get_updates_seconds", "getUpdates round trip",
+                                buckets=(0.1, 0.5, 1, 2.5, 5, 10, 30, 60, 100, 120))
+
+
+class GetUpdatesError(Exception):
+    """getUpdates answered ``"ok": false`` (a 409 while another poller runs, 401, 429...)."""
+
+    def __init__(self, payload):
+        super().__init__(f"{payload.get('error_code')} {payload.get('description')}")
+        self.retry_after = (payload.get("parameters") or {}).get("retry_after")
+
+
+def updates_result(payload):
+    """The updates in a getUpdates response; raises ``GetUpdatesError`` if it failed."""
+    if not payload.get("ok"):
+        raise GetUpdatesError(payload)
+    return payload.get("result", [])
+
+
+def update_chat_id(update):
+    """Return the chat an update belongs to, or None if it has no chat."""
+    if "callback_query" in update:
+        message = update["callback_query"].get("message") or {}
+    else:
+        message = update.get("message") or update.get("edited_message") or {}
+    chat = message.get("chat")
+    return str(chat["id"]) if chat else None
+
+
+class AsyncEngine:
+    """Runs ``handle_update`` concurrently across chats.
+
+    Updates for one chat are processed strictly in arrival order; different
+    chats run in parallel, at most ``concurrency`` at a time. The handler
+    itself is the same blocking function the polling loop uses, so it runs
+    in a worker thread. The committer only moves past an update once it and
+    every update before it have finished.
+    """
+
+    def __init__(self, api_url, handle_update, states, committer,
+                 concurrency=16, poll_timeout=100, max_in_flight=500):
+        self.api_url = api_url
+        self.handle_update = handle_update
+        self.states = states
+        self.committer = committer
+        self.poll_timeout = poll_timeout
+        self.max_in_flight = max_in_flight
+
+        self._limiter = anyio.CapacityLimiter(concurrency)
+        self._chat_queues = {}
+        self._in_flight = set()
+        self._next_offset = None
+        self._room = None
+        self._backoff = 1
+
+    def run(self):
+        anyio.run(self._run)
+
+    async def _run(self):
+        self._room = anyio.Event()
+        self._next_offset = self.committer.offset
+        timeout = httpx.Timeout(self.poll_timeout + 10)
+        async with httpx.AsyncClient(timeout=timeout) as client:
+            async with anyio.create_task_group() as tg:
+                while True:
+                    while len(self._in_flight) >= self.max_in_flight:
+                        self._room = anyio.Event()
+                        await self._room.wait()
+                    updates = await self._get_updates(client)
+                    for update in updates:
+                        self._dispatch(tg, update)
+                    if self.committer.due() or (not updates and self.committer.pending):
+                        await anyio.to_thread.run_sync(self.committer.commit)
+
+    async def _get_updates(self, client):
+        # Don't sit in a long poll while an offset commit is still owed
+        timeout = max(1, int(self.committer.interval)) if self.committer.pending else self.poll_timeout
+        params = {"timeout": timeout}
+        if self._next_offset is not None:
+            params["offset"] = self._next_offset
+        try:
+            with timed(GET_UPDATES_SECONDS):
+                response = await client.get(f"{self.api_url}/getUpdates", params=params)
+            updates = updates_result(response.json())
+        except (httpx.HTTPError, ValueError, GetUpdatesError) as e:
+            delay = getattr(e, "retry_after", None) or self._backoff
+            logging.error("getUpdates failed, retrying in %ss: %s", delay, e)
+            await anyio.sleep(delay)
+            self._backoff = min(self._backoff * 2, 30)
+            return []
+        self._backoff = 1
+        return updates
+
+    def _dispatch(self, tg, update):
+        update_id = update["update_id"]
+        self._in_flight.add(update_id)
+        self._next_offset = update_id + 1
+
+        chat_id = update_chat_id(update)
+        queue = self._chat_queues.get(chat_id)
+        if queue is not None:
+            queue.append(update)
+            return
+        self._chat_queues[chat_id] = deque([update])
+        tg.start_soon(self._drain_chat, chat_id)
+
+    async def _drain_chat(self, chat_id):
+        queue = self._chat_queues[chat_id]
+        while queue:
+            update = queue.popleft()
+            try:
+                await anyio.to_thread.run_sync(
+                    self.handle_update, update, self.states, limiter=self._limiter
+                )
+            except Exception as e:
+                logging.error("Failed to handle update %s for chat_id %s: %s", update["update_id"], chat_id, e, exc_info=True)
+            await self._finish(update["update_id"])
+        del self._chat_queues[chat_id]
+
+    async def _finish(self, update_id):
+        self._in_flight.discard(update_id)
+        self._room.set()
+        offset = min(self._in_flight) if self._in_flight else self._next_offset
+        if offset is not None and offset != self.committer.offset and self.committer.advance(offset):
+            await anyio.to_thread.run_sync(self.committer.commit)
@@ -0,0 +1,203 @@
+import logging
+import multiprocessing
+import os
+import queue
+import signal
+import socket
+import threading
+import time
+import zlib
+from collections import OrderedDict
+
+from async_runtime import update_chat_id, updates_result
+from metrics import gauge, serve
+
+STATE_COLLECTION = "conversation_states"
+
+
+def partition(chat_id, workers):
+    return zlib.crc32(str(chat_id).encode()) % workers
+
+
+def worker_owner(pid):
+    return f"{socket.gethostname()}:{pid}"
+
+
+def worker_main(index, inbox, acks, batch_size):
+    """Entry point of a worker process: handle the updates of one partition.
+
+    Updates are taken in small batches; state and buffered writes are
+    flushed before the batch is acknowledged, so the ingress process never
+    commits an offset past work that isn't stored yet.
+    """
+    import sms_sender
+    from state_store import MongoStateStore
+
+    # SIGTERM reaches every process of a dyno; workers keep going until the
+    # ingress process has stopped feeding them and sends the final None
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    app = sms_sender.app
+    # Set before anything is built: this worker gets its share of the rate limits
+    app.processes = sms_sender.BOT_WORKERS + 1
+    app.start_logging()
+    states = MongoStateStore(app.db[STATE_COLLECTION], owner=worker_owner(os.getpid()))
+    if sms_sender.METRICS_PORT:
+        # Each worker is its own scrape target, on the ports after the ingress one
+        serve(sms_sender.METRICS_PORT + 1 + index)
+    # Conversation state is leased per chat, so only the geocode caches are preloaded
+    sms_sender.start_warmup()
+    logging.info("Worker %s started as %s", index, states.owner)
+    running = True
+    while running:
+        try:
+            update = inbox.get(timeout=states.flush_interval)
+        except queue.Empty:
+            states.flush_if_due()
+            continue
+        if update is None:
+            break
+        batch = [update]
+        while len(batch) < batch_size:
+            try:
+                update = inbox.get_nowait()
+            except queue.Empty:
+                break
+            if update is None:
+                running = False
+                break
+            batch.append(update)
+
+        for update in batch:
+            try:
+                sms_sender.handle_update(update, states)
+            except Exception as e:
+                logging.error("Worker %s failed on update %s: %s", index, update["update_id"], e, exc_info=True)
+        states.flush()
+        app.writer.flush()
+        acks.put((index, [update["update_id"] for update in batch]))
+
+    states.close()
+    app.close()
+
+
+class Cluster:
+    """Ingress process that fans updates out to N worker processes.
+
+    Updates are hash-partitioned by ``chat_id``, so one chat is always
+    handled by the same worker, in order. The ingress keeps every update
+    until its worker acknowledges it and only advances the offset past
+    acknowledged updates. A worker that dies is restarted with a fresh
+    queue holding its unacknowledged updates, after its Mongo leases are
+    released; anything it had already applied is skipped by
+    ``handle_update``'s replay check.
+    """
+
+    def __init__(self, workers, collection, committer, batch_size=20, max_in_flight=2000):
+        self.workers = workers
+        self.collection = collection
+        self.committer = committer
+        self.batch_size = batch_size
+        self.max_in_flight = max_in_flight
+
+        self._ctx = multiprocessing.get_context("spawn")
+        self._acks = self._ctx.Queue()
+        self._inboxes = [None] * workers
+        self._processes = [None] * workers
+        self._unacked = [OrderedDict() for _ in range(workers)]
+        self._in_flight = 0
+        self._next_offset = committer.offset
+        self._lock = threading.Lock()
+        self._stopping = False
+        gauge("cluster_in_flight", "Updates dispatched to workers and not yet acknowledged",
+              fn=lambda: self._in_flight)
+
+    # ---- worker management ------------------------------------------------
+
+    def start(self):
+        for index in range(self.workers):
+            self._start_worker(index)
+        threading.Thread(target=self._ack_loop, name="cluster-acks", daemon=True).start()
+        threading.Thread(target=self._monitor_loop, name="cluster-monitor", daemon=True).start()
+
+    def _start_worker(self, index):
+        inbox = self._ctx.Queue()
+        process = self._ctx.Process(target=worker_main, args=(index, inbox, self._acks, self.batch_size),
+                                    name=f"bot-worker-{index}", daemon=True)
+        process.start()
+        with self._lock:
+            self._inboxes[index] = inbox
+            self._processes[index] = process
+            for update in self._unacked[index].values():
+                inbox.put(update)
+
+    def _monitor_loop(self):
+        while not self._stopping:
+            time.sleep(1)
+            for index, process in enumerate(self._processes):
+                if process.is_alive() or self._stopping:
+                    continue
+                logging.error("Worker %s (pid %s) exited with %s; restarting", index, process.pid, process.exitcode)
+                from state_store import MongoStateStore
+                MongoStateStore.release_owner(self.collection, worker_owner(process.pid))
+                self._start_worker(index)
+
+    def stop(self, timeout=30):
+        self._stopping = True
+        for inbox in self._inboxes:
+            inbox.put(None)
+        for process in self._processes:
+            process.join(timeout)
+        self.committer.commit()
+
+    # ---- dispatch and offsets ---------------------------------------------
+
+    def dispatch(self, update):
+        """Route one update to its worker; False when too much is in flight."""
+        with self._lock:
+            if self._in_flight >= self.max_in_flight:
+                return False
+            index = partition(update_chat_id(update), self.workers)
+            self._unacked[index][update["update_id"]] = update
+            self._in_flight += 1
+            if self._next_offset is None or update["update_id"] >= self._next_offset:
+                self._next_offset = update["update_id"] + 1
+            self._inboxes[index].put(update)
+        return True
+
+    def _watermark(self):
+        oldest = [next(iter(pending)) for pending in self._unacked if pending]
+        return min(oldest) if oldest else self._next_offset
+
+    def _ack_loop(self):
+        while True:
+            index, update_ids = self._acks.get()
+            with self._lock:
+                for update_id in update_ids:
+                    if self._unacked[index].pop(update_id, None) is not None:
+                        self._in_flight -= 1
+                offset = self._watermark()
+            if offset is not None and offset != self.committer.offset:
+                self.committer.advance(offset)
+            self.committer.commit_if_due()
+
+    def run_polling(self, get_updates):
+        """Own getUpdates and feed the workers until interrupted."""
+        offset = self.committer.offset
+        backoff = 1
+        while True:
+            poll_timeout = max(1, int(self.committer.interval)) if self.committer.pending else 100
+            try:
+                results = updates_result(get_updates(offset=offset, timeout=poll_timeout))
+            except Exception as e:
+                delay = getattr(e, "retry_after", None) or backoff
+                logging.error("getUpdates failed, retrying in %ss: %s", delay, e)
+                time.sleep(delay)
+                backoff = min(backoff * 2, 30)
+                continue
+            backoff = 1
+            for update in results:
+                while not self.dispatch(update):
+                    time.sleep(0.05)
+                offset = update["update_id"] + 1
+            if not results:
+                self.committer.commit()
@@ -0,0 +1,239 @@
+import logging
+from collections import namedtuple
+
+from metrics import counter
+
+LOCATION_FIELD = "location_marker"
+PAYMENT_FIELD = "payment_from_sender_or_receiver"
+
+Step = namedtuple("Step", "index field label kind")
+
+COMMANDS = counter("bot_commands_total", "Commands received", ["command"])
+
+
+def is_ethiopian_phone(text):
+    return ((text.startswith("09") and len(text) == 10 and text.isdigit()) or
+            (text.startswith("+2519") and len(text) == 13 and text[1:].isdigit()))
+
+
+def is_positive_int(text):
+    return text.isdigit() and int(text) > 0
+
+
+def skipped_phone(payment):
+    """The phone question that is skipped once ``payment`` is already known."""
+    return "receiver_phone" if payment == "Sender / ላኪ" else "sender_phone"
+
+
+class Form:
+    """A delivery form compiled from ``Data_Message``-style field lists.
+
+    Every step gets its prompt kind (``location``, ``payment`` or
+    ``text``) and validator up front, and the payment-based skips are
+    turned into per-step jump tables, so answering a step never scans the
+    field list.
+    """
+
+    def __init__(self, fields, validators=None):
+        self.steps = [Step(i, f["field"], f["label"], self._kind(f["field"])) for i, f in enumerate(fields)]
+        self.last = len(self.steps) - 1
+        # field -> (check, error message)
+        self.validators = dict(validators or {})
+
+        self._first = {}
+        self._after = {}
+        for skip in ("receiver_phone", "sender_phone"):
+            first = next((s.index for s in self.steps if s.field != skip), len(self.steps))
+            after = []
+            for step in self.steps:
+                nxt = next((s.index for s in self.steps[step.index + 1:] if s.field != skip), self.last)
+                after.append(max(nxt, step.index))
+            self._first[skip] = first
+            self._after[skip] = after
+
+    @staticmethod
+    def _kind(field):
+        if field == LOCATION_FIELD:
+            return "location"
+        if field == PAYMENT_FIELD:
+            return "payment"
+        return "text"
+
+    def __getitem__(self, index):
+        return self.steps[index]
+
+    def __len__(self):
+        return len(self.steps)
+
+    def first_step(self, payment=None):
+        """Where a new order starts; with a known payer, their phone step is skipped."""
+        return self._first[skipped_phone(payment)] if payment else 0
+
+    def skip_from(self, step, payment):
+        """The step after ``step`` once the payer is already known."""
+        return self._after[skipped_phone(payment)][step]
+
+    def validate(self, field, text):
+        """Return the error message for an invalid answer, or None."""
+        validator = self.validators.get(field)
+        if validator and not validator[0](text):
+            return validator[1]
+        return None
+
+
+def update_key(update):
+    """A stable id for what the user did, for deduplicating replays.
+
+    Unlike ``update_id``, which Telegram renumbers after a week without
+    updates, message ids and callback query ids are never reused.
+    """
+    fallback = f"u{update['update_id']}"
+    if "callback_query" in update:
+        return f"cb:{update['callback_query'].get('id', fallback)}"
+    message = update.get("message") or {}
+    return f"{message.get('chat', {}).get('id')}:{message.get('message_id', fallback)}"
+
+
+class Context:
+    """One incoming update, as seen by a handler."""
+
+    __slots__ = ("update_id", "key", "chat_id", "states", "message", "text", "data")
+
+    def __init__(self, update_id, chat_id, states, message=None, text=None, data=None, key=None):
+        self.update_id = update_id
+        self.key = key if key is not None else str(update_id)
+        self.chat_id = chat_id
+        self.states = states
+        self.message = message
+        self.text = text
+        self.data = data
+
+    @property
+    def state(self):
+        return self.states.get(self.chat_id)
+
+
+class Router:
+    """Dispatch table for commands, callback buttons and free text.
+
+    Commands and ``callback_data`` values are looked up in dicts (callbacks
+    that carry an argument, like ``mydeliveries:<cursor>``, by the part
+    before the colon). Which handler gets plain text depends on the chat's
+    mode: filling in the form, writing feedback, or idle. The router holds
+    no I/O of its own, so every runtime can share it and it can be timed
+    with stub handlers.
+    """
+
+    def __init__(self, commands=()):
+        self.advertised = [c["command"] for c in commands]
+        self.commands = {}
+        self.callbacks = {}
+        self.on_location = None
+        self.on_form_input = None
+        self.on_feedback = None
+        self.on_idle = None
+        self.on_blocked = None
+
+    def command(self, name, blocked_in_form=False, in_feedback=False):
+        """Register a command handler.
+
+        ``blocked_in_form`` commands are refused while an order is being
+        filled in; in feedback mode only ``in_feedback`` commands work and
+        any other text is taken as the feedback itself.
+        """
+        def register(handler):
+            self.commands[name] = (handler, blocked_in_form, in_feedback)
+            return handler
+        return register
+
+    def callback(self, name):
+        def register(handler):
+            self.callbacks[name] = handler
+            return handler
+        return register
+
+    def check(self):
+        missing = [name for name in self.advertised if name not in self.commands]
+        if missing:
+            logging.warning("Commands without a handler: %s", ", ".join(missing))
+
+    @staticmethod
+    def mode(state):
+        if state is None:
+            return None
+        return "feedback" if state.get("step") == "feedback" else "form"
+
+    def dispatch(self, update, states):
+        update_id = update["update_id"]
+        if "callback_query" in update:
+            callback = update["callback_query"]
+            data = callback["data"]
+            handler = self.callbacks.get(data) or self.callbacks.get(data.split(":", 1)[0] + ":")
+            if handler:
+                handler(Context(update_id, str(callback["message"]["chat"]["id"]), states, data=data,
+                                key=update_key(update)))
+            return
+
+        message = update.get("message")
+        if not message:
+            return
+        chat_id = str(message["chat"]["id"])
+        logging.info("Processing message from chat_id %s with update_id %s", chat_id, update_id,
+                     extra={"sampled": True})
+
+        if "location" in message:
+            if self.mode(states.get(chat_id)) == "form":
+                self.on_location(Context(update_id, chat_id, states, message=message, key=update_key(update)))
+            return
+        if "text" not in message:
+            return
+
+        text = message["text"].strip()
+        logging.info("Received message from chat_id %s: %s", chat_id, text, extra={"sampled": True})
+        ctx = Context(update_id, chat_id, states, message=message, text=text, key=update_key(update))
+        mode = self.mode(states.get(chat_id))
+
+        command = self.commands.get(text.lower())
+        if command and (mode != "feedback" or command[2]):
+            COMMANDS.inc(command=text.lower())
+            handler, blocked_in_form, _ = command
+            if mode == "form" and blocked_in_form:
+                self.on_blocked(ctx)
+            else:
+                handler(ctx)
+        elif mode == "feedback":
+            self.on_feedback(ctx)
+        elif mode == "form":
+            self.on_form_input(ctx)
+        else:
+            self.on_idle(ctx)
+
+
+if __name__ == "__main__":
+    # Routing cost on its own: python conversation.py [updates]
+    import sys
+    import time
+
+    router = Router()
+    for name in ("/start", "/cancel", "/about", "/contact", "/price", "/feedback", "/mydeliveries"):
+        router.command(name, blocked_in_form=name in ("/about", "/contact", "/price", "/feedback"))(lambda ctx: None)
+    router.callback("new_order")(lambda ctx: None)
+    router.callback("mydeliveries:")(lambda ctx: None)
+    router.on_blocked = router.on_idle = router.on_feedback = router.on_location = router.on_form_input = lambda ctx: None
+    logging.disable(logging.INFO)
+
+    states = {str(chat): {"step": 2, "data": {}} for chat in range(0, 1000, 2)}
+    samples = [
+        {"message": {"chat": {"id": 1}, "text": "/start"}},
+        {"message": {"chat": {"id": 2}, "text": "Piassa"}},
+        {"message": {"chat": {"id": 4}, "text": "/about"}},
+        {"message": {"chat": {"id": 6}, "location": {"latitude": 9.0, "longitude": 38.7}}},
+        {"callback_query": {"data": "mydeliveries:2024-01-01T00:00:00", "message": {"chat": {"id": 3}}}},
+    ]
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+    updates = [dict(samples[i % len(samples)], update_id=i) for i in range(count)]
+    started = time.perf_counter()
+    for update in updates:
+        router.dispatch(update, states)
+    elapsed = time.perf_counter() - started
+    print(f"{count} updates in {elapsed:.3f}s = {count / elapsed:,.0f} updates/s")
@@ -0,0 +1,373 @@
+"""Assigns pending deliveries to the nearest available driver.
+
+Runs as its own process (``python dispatcher.py``, see the Procfile).
+Driver positions come from the ``drivers`` collection::
+
+    {_id, name, phone, latitude, longitude, available: bool, updated_at}
+
+Every tick the dispatcher picks up newly saved orders, refreshes the
+drivers that changed, matches open orders to drivers oldest order first,
+writes the assignments back and queues SMS notifications for the sender
+and the driver.
+"""
+import logging
+import math
+import queue
+import threading
+import time
+from datetime import datetime, timedelta
+
+from pymongo import UpdateOne
+from pymongo.errors import PyMongoError
+
+from metrics import counter, gauge, histogram, timed
+from pricing import haversine_km
+
+KM_PER_DEGREE = 111.32
+# Orders older than this are left to ops, as are orders saved without a
+# created_at datetime (everything from before the dispatcher existed)
+MAX_ORDER_AGE = timedelta(hours=24)
+
+ASSIGNMENTS = counter("dispatch_assignments_total", "Orders assigned to a driver")
+TICK_SECONDS = histogram("dispatch_tick_seconds", "Time for one dispatch tick")
+
+ORDER_FIELDS = {"order_id": 1, "chat_id": 1, "latitude": 1, "longitude": 1, "sender_phone": 1,
+                "pickup": 1, "dropoff": 1, "created_at": 1}
+
+
+class GridIndex:
+    """Points bucketed into roughly ``cell_km`` square cells.
+
+    ``nearest`` searches rings of cells outwards from the query point and
+    stops as soon as no unsearched cell can hold anything closer, so a
+    lookup only touches the few cells around the point.
+    """
+
+    def __init__(self, cell_km=1.0, ref_lat=9.0):
+        self.cell_km = cell_km
+        self.lat_step = cell_km / KM_PER_DEGREE
+        self.lon_step = cell_km / (KM_PER_DEGREE * math.cos(math.radians(ref_lat)))
+        self._cells = {}
+        self._where = {}
+
+    def _cell(self, lat, lon):
+        return int(math.floor(lat / self.lat_step)), int(math.floor(lon / self.lon_step))
+
+    def __len__(self):
+        return len(self._where)
+
+    def __contains__(self, key):
+        return key in self._where
+
+    def add(self, key, lat, lon):
+        self.remove(key)
+        cell = self._cell(lat, lon)
+        self._cells.setdefault(cell, {})[key] = (lat, lon)
+        self._where[key] = cell
+
+    def remove(self, key):
+        cell = self._where.pop(key, None)
+        if cell is None:
+            return
+        bucket = self._cells[cell]
+        del bucket[key]
+        if not bucket:
+            del self._cells[cell]
+
+    def _ring(self, ci, cj, ring):
+        if ring == 0:
+            return [(ci, cj)]
+        cells = []
+        for j in range(cj - ring, cj + ring + 1):
+            cells.append((ci - ring, j))
+            cells.append((ci + ring, j))
+        for i in range(ci - ring + 1, ci + ring):
+            cells.append((i, cj - ring))
+            cells.append((i, cj + ring))
+        return cells
+
+    def nearest(self, lat, lon, max_km):
+        """Return ``(key, km)`` of the closest point within ``max_km``, or None."""
+        ci, cj = self._cell(lat, lon)
+        best_key, best_km = None, float("inf")
+        for ring in range(math.ceil(max_km / self.cell_km) + 2):
+            for cell in self._ring(ci, cj, ring):
+                for key, (plat, plon) in self._cells.get(cell, {}).items():
+                    km = haversine_km(lat, lon, plat, plon)
+                    if km < best_km:
+                        best_key, best_km = key, km
+            # Cells beyond this ring are at least ring * cell_km away
+            if best_km <= ring * self.cell_km:
+                break
+        if best_key is None or best_km > max_km:
+            return None
+        return best_key, best_km
+
+
+class PollingOrderFeed:
+    """Finds new orders by polling ``deliveries`` in ``_id`` order.
+
+    ``poll()`` is the whole feed interface: it returns the orders saved
+    since the previous call. The first call returns every order that has
+    no driver yet and was created within ``max_age``.
+    """
+
+    def __init__(self, deliveries, batch_size=1000, max_age=MAX_ORDER_AGE):
+        self.deliveries = deliveries
+        self.batch_size = batch_size
+        self.max_age = max_age
+        self._last_id = None
+
+    def is_open(self, doc):
+        created_at = doc.get("created_at")
+        return ("driver_id" not in doc and "latitude" in doc and isinstance(created_at, datetime)
+                and created_at >= datetime.now() - self.max_age)
+
+    def poll(self):
+        query = {"driver_id": {"$exists": False}, "latitude": {"$exists": True},
+                 "created_at": {"$type": "date", "$gte": datetime.now() - self.max_age}}
+        if self._last_id is not None:
+            query["_id"] = {"$gt": self._last_id}
+        orders = list(self.deliveries.find(query, ORDER_FIELDS).sort("_id", 1).limit(self.batch_size))
+        if orders:
+            self._last_id = orders[-1]["_id"]
+        return orders
+
+
+class ChangeStreamOrderFeed(PollingOrderFeed):
+    """Receives new orders from a change stream (needs a replica set).
+
+    Orders saved before the stream opened are loaded with one query, like
+    ``PollingOrderFeed``; after that ``poll()`` only drains what the
+    stream delivered. If the stream fails it is reopened from its resume
+    token; if that fails too, the feed falls back to polling.
+    """
+
+    PIPELINE = [{"$match": {"operationType": {"$in": ["insert", "update", "replace"]}}}]
+
+    def __init__(self, deliveries, batch_size=1000, max_age=MAX_ORDER_AGE, max_backoff=60):
+        super().__init__(deliveries, batch_size, max_age)
+        self.max_backoff = max_backoff
+        self._queue = queue.Queue()
+        self._backlog_done = False
+        self.polling = False
+        # Opened before the backlog query so nothing saved in between is missed
+        self._stream = deliveries.watch(self.PIPELINE, full_document="updateLookup")
+        threading.Thread(target=self._listen, name="order-feed", daemon=True).start()
+
+    def _listen(self):
+        backoff = 1
+        while True:
+            try:
+                for change in self._stream:
+                    backoff = 1
+                    doc = change.get("fullDocument")
+                    if doc and self.is_open(doc):
+                        self._queue.put({k: doc.get(k) for k in ORDER_FIELDS} | {"_id": doc["_id"]})
+                logging.warning("Order change stream closed; reopening")
+            except PyMongoError as e:
+                logging.error("Order change stream failed, reopening in %ss: %s", backoff, e)
+                time.sleep(backoff)
+                backoff = min(backoff * 2, self.max_backoff)
+            token = self._stream.resume_token
+            try:
+                self._stream.close()
+                self._stream = self.deliveries.watch(self.PIPELINE, full_document="updateLookup",
+                                                     start_after=token)
+            except PyMongoError as e:
+                # Usually the token has fallen off the oplog; polling picks up whatever was missed
+                logging.error("Could not reopen the order change stream, falling back to polling: %s", e)
+                self.polling = True
+                return
+
+    def poll(self):
+        orders = []
+        if not self._backlog_done or self.polling:
+            while True:
+                batch = super().poll()
+                orders.extend(batch)
+                if len(batch) < self.batch_size:
+                    break
+            self._backlog_done = True
+        while True:
+            try:
+                orders.append(self._queue.get_nowait())
+            except queue.Empty:
+                return orders
+
+
+class Dispatcher:
+    """Matches open orders to available drivers every ``tick`` seconds.
+
+    Drivers are kept in a ``GridIndex``; only drivers whose document
+    changed since the last tick are re-read. Open orders stay in memory
+    until assigned or older than ``max_age``. Each tick matches orders
+    oldest first to the nearest driver within ``max_km``, then claims the
+    drivers and marks the orders with one ``bulk_write`` each. Both writes
+    are conditional, so an order or driver that ops assigned by hand in
+    the meantime is left alone.
+    """
+
+    def __init__(self, deliveries, drivers, feed, sms_outbox, tick=5.0, max_km=10.0,
+                 cell_km=1.0, max_age=MAX_ORDER_AGE):
+        self.deliveries = deliveries
+        self.drivers = drivers
+        self.feed = feed
+        self.sms_outbox = sms_outbox
+        self.tick = tick
+        self.max_km = max_km
+        self.max_age = max_age
+
+        self.index = GridIndex(cell_km)
+        self._driver_info = {}
+        self._drivers_synced_at = None
+        self._open = {}
+        self._stop = threading.Event()
+        gauge("dispatch_open_orders", "Orders waiting for a driver", fn=lambda: len(self._open))
+        gauge("dispatch_available_drivers", "Drivers available for assignment", fn=lambda: len(self.index))
+
+    def ensure_indexes(self):
+        self.drivers.create_index("updated_at", name="driver_updates")
+
+    def refresh_drivers(self):
+        now = datetime.utcnow()
+        query = {} if self._drivers_synced_at is None else {"updated_at": {"$gte": self._drivers_synced_at}}
+        for doc in self.drivers.find(query):
+            if doc.get("available") and doc.get("latitude") is not None and doc.get("longitude") is not None:
+                self.index.add(doc["_id"], doc["latitude"], doc["longitude"])
+                self._driver_info[doc["_id"]] = {"name": doc.get("name", ""), "phone": doc.get("phone")}
+            else:
+                self.index.remove(doc["_id"])
+                self._driver_info.pop(doc["_id"], None)
+        self._drivers_synced_at = now
+
+    def match(self):
+        """Pick a driver for as many open orders as possible; returns (order, driver_id, km) triples."""
+        matches = []
+        cutoff = datetime.now() - self.max_age
+        for order_id, order in list(self._open.items()):
+            if not isinstance(order.get("created_at"), datetime) or order["created_at"] < cutoff:
+                del self._open[order_id]
+        for order_id, order in sorted(self._open.items(), key=lambda item: item[1]["created_at"]):
+            if not len(self.index):
+                break
+            found = self.index.nearest(order["latitude"], order["longitude"], self.max_km)
+            if found is None:
+                continue
+            driver_id, km = found
+            self.index.remove(driver_id)
+            matches.append((order, driver_id, km))
+        return matches
+
+    def assign(self, matches):
+        """Claim the drivers and write the assignments; returns what was stored."""
+        if not matches:
+            return []
+        now = datetime.utcnow()
+        claims = self.drivers.bulk_write([
+            UpdateOne({"_id": driver_id, "available": True},
+                      {"$set": {"available": False, "current_order": order["_id"], "updated_at": now}})
+            for order, driver_id, _ in matches
+        ], ordered=False)
+        if claims.modified_count != len(matches):
+            # A driver went off duty since the last refresh; keep the claims that held
+            held = {(doc["_id"], doc.get("current_order")) for doc in self.drivers.find(
+                {"_id": {"$in": [driver_id for _, driver_id, _ in matches]}}, {"current_order": 1})}
+            matches = [m for m in matches if (m[1], m[0]["_id"]) in held]
+        if not matches:
+            return []
+
+        result = self.deliveries.bulk_write([
+            UpdateOne({"_id": order["_id"], "driver_id": {"$exists": False}},
+                      {"$set": {"driver_id": driver_id, "driver_name": self._driver_info[driver_id]["name"],
+                                "driver_phone": self._driver_info[driver_id]["phone"],
+                                "driver_distance_km": round(km, 2), "assigned_at": now, "status": "assigned"}})
+            for order, driver_id, km in matches
+        ], ordered=False)
+        if result.modified_count != len(matches):
+            # Ops assigned some of these by hand meanwhile; free our drivers again
+            assigned = {doc["_id"]: doc.get("driver_id") for doc in self.deliveries.find(
+                {"_id": {"$in": [order["_id"] for order, _, _ in matches]}}, {"driver_id": 1})}
+            lost = [m for m in matches if assigned.get(m[0]["_id"]) != m[1]]
+            self.drivers.update_many({"_id": {"$in": [driver_id for _, driver_id, _ in lost]}},
+                                     {"$set": {"available": True, "updated_at": now},
+                                      "$unset": {"current_order": ""}})
+            for order, _, _ in lost:
+                self._open.pop(order["_id"], None)
+            logging.warning("%s orders were assigned elsewhere during this tick", len(lost))
+            matches = [m for m in matches if m not in lost]
+        return matches
+
+    def notify(self, matches):
+        items = []
+        for order, driver_id, km in matches:
+            driver = self._driver_info[driver_id]
+            # order_id is only unique per chat; the delivery's _id keys the SMS
+            delivery_id = str(order["_id"])
+            if order.get("sender_phone"):
+                items.append((delivery_id, "customer_assigned", order["sender_phone"],
+                              f"Tolo Delivery: driver {driver['name']} ({driver['phone']}) is on the way "
+                              f"for order {order['order_id']}."))
+            if driver.get("phone"):
+                items.append((delivery_id, "driver_assigned", driver["phone"],
+                              f"Tolo Delivery order {order['order_id']}: pick up at {order.get('pickup', '')}, "
+                              f"deliver to {order.get('dropoff', '')}. Sender: {order.get('sender_phone', '')}."))
+        self.sms_outbox.enqueue_many(items)
+
+    def run_once(self):
+        with timed(TICK_SECONDS):
+            self.refresh_drivers()
+            for order in self.feed.poll():
+                self._open[order["_id"]] = order
+            matches = self.assign(self.match())
+            self.notify(matches)
+            for order, driver_id, _ in matches:
+                self._open.pop(order["_id"], None)
+                self._driver_info.pop(driver_id, None)
+        ASSIGNMENTS.inc(len(matches))
+        if matches:
+            logging.info("Assigned %s orders; %s still open, %s drivers free",
+                         len(matches), len(self._open), len(self.index))
+        return len(matches)
+
+    def run(self):
+        while not self._stop.is_set():
+            started = time.monotonic()
+            try:
+                self.run_once()
+            except Exception as e:
+                logging.error("Dispatch tick failed: %s", e, exc_info=True)
+            self._stop.wait(max(0.0, self.tick - (time.monotonic() - started)))
+
+    def stop(self):
+        self._stop.set()
+
+
+if __name__ == "__main__":
+    import os
+
+    import sms_sender
+
+    app = sms_sender.app
+    app.start_logging()
+    sms_sender.exit_on_sigterm()
+    deliveries = app.deliveries
+    feed_class = ChangeStreamOrderFeed if os.getenv("DISPATCH_FEED") == "changestream" else PollingOrderFeed
+    max_age = timedelta(hours=float(os.getenv("DISPATCH_MAX_AGE_HOURS", "24")))
+    dispatcher = Dispatcher(
+        deliveries,
+        app.db["drivers"],
+        feed_class(deliveries, max_age=max_age),
+        app.sms_outbox,
+        tick=float(os.getenv("DISPATCH_TICK", "5")),
+        max_km=float(os.getenv("DISPATCH_MAX_KM", "10")),
+        max_age=max_age,
+    )
+    dispatcher.ensure_indexes()
+    app.sms_outbox.start()
+    if sms_sender.METRICS_PORT:
+        sms_sender.serve(sms_sender.METRICS_PORT)
+    try:
+        dispatcher.run()
+    finally:
+        app.close()
@@ -0,0 +1,217 @@
+import logging
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime, timedelta
+
+_BASE32 = "0123456789bcdefghjkmnpqrstuvwxyz"
+
+
+def geohash(lat, lon, precision=7):
+    """Encode a coordinate as a geohash; precision 7 is a ~150 m cell."""
+    lat_range = [-90.0, 90.0]
+    lon_range = [-180.0, 180.0]
+    chars = []
+    bits = 0
+    bit_count = 0
+    even = True
+    while len(chars) < precision:
+        if even:
+            mid = (lon_range[0] + lon_range[1]) / 2
+            if lon > mid:
+                bits = (bits << 1) | 1
+                lon_range[0] = mid
+            else:
+                bits <<= 1
+                lon_range[1] = mid
+        else:
+            mid = (lat_range[0] + lat_range[1]) / 2
+            if lat > mid:
+                bits = (bits << 1) | 1
+                lat_range[0] = mid
+            else:
+                bits <<= 1
+                lat_range[1] = mid
+        even = not even
+        bit_count += 1
+        if bit_count == 5:
+            chars.append(_BASE32[bits])
+            bits = 0
+            bit_count = 0
+    return "".join(chars)
+
+
+class RateLimiter:
+    """Allows one call per ``interval`` seconds across all threads."""
+
+    def __init__(self, interval):
+        self.interval = interval
+        self._lock = threading.Lock()
+        self._last = 0.0
+
+    def wait(self):
+        with self._lock:
+            delay = self._last + self.interval - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            self._last = time.monotonic()
+
+
+class _Pending:
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = {}
+
+
+class GeocodeCache:
+    """Reverse-geocode cache keyed by geohash cell.
+
+    Lookups go through an in-process LRU, then the optional Mongo
+    collection, and only then ``fetch``. Concurrent lookups for the same
+    cell wait for one shared fetch, and fetches are spaced out by
+    ``min_interval`` to honour Nominatim's 1 request/second policy. Empty
+    results (failed lookups) are never cached.
+    """
+
+    def __init__(self, fetch, collection=None, precision=7, max_entries=10000,
+                 ttl=timedelta(days=30), min_interval=1.0, rate_limiter=None):
+        self.fetch = fetch
+        self.collection = collection
+        self.precision = precision
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.rate_limiter = rate_limiter or RateLimiter(min_interval)
+
+        self._entries = OrderedDict()
+        self._pending = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def ensure_indexes(self):
+        if self.collection is not None:
+            self.collection.create_index("expires_at", expireAfterSeconds=0)
+
+    def lookup(self, lat, lon):
+        return self._lookup(geohash(lat, lon, self.precision), lat, lon)
+
+    def warm(self, limit=None):
+        """Fill the in-process LRU from Mongo, newest entries first.
+
+        Returns how many entries were loaded. Entries keep the expiry they
+        have in Mongo.
+        """
+        if self.collection is None:
+            return 0
+        limit = min(limit or self.max_entries, self.max_entries)
+        try:
+            docs = list(self.collection.find({"expires_at": {"$gt": datetime.utcnow()}})
+                        .sort("expires_at", -1).limit(limit))
+        except Exception as e:
+            logging.warning("Geocode cache warm-up failed: %s", e)
+            return 0
+        with self._lock:
+            # Oldest first, so the freshest entries end up most recently used
+            for doc in reversed(docs):
+                if doc["_id"] not in self._entries:
+                    self._entries[doc["_id"]] = (doc["expires_at"], doc["address"])
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return len(docs)
+
+    def _lookup(self, key, *args):
+        with self._lock:
+            cached = self._get_local(key)
+            if cached is not None:
+                self.hits += 1
+                return cached
+            pending = self._pending.get(key)
+            owner = pending is None
+            if owner:
+                pending = self._pending[key] = _Pending()
+
+        if not owner:
+            pending.event.wait()
+            return pending.result
+
+        try:
+            pending.result = self._resolve(key, *args)
+        finally:
+            with self._lock:
+                del self._pending[key]
+            pending.event.set()
+        return pending.result
+
+    def _resolve(self, key, *args):
+        result = self._get_persistent(key)
+        if result is not None:
+            self.hits += 1
+        else:
+            self.misses += 1
+            self.rate_limiter.wait()
+            result = self.fetch(*args)
+            if not result:
+                return result
+            self._put_persistent(key, result)
+        with self._lock:
+            self._put_local(key, result)
+        return result
+
+    def _get_local(self, key):
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        expires_at, value = entry
+        if expires_at <= datetime.utcnow():
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        return value
+
+    def _put_local(self, key, value):
+        self._entries[key] = (datetime.utcnow() + self.ttl, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def _get_persistent(self, key):
+        if self.collection is None:
+            return None
+        try:
+            doc = self.collection.find_one({"_id": key, "expires_at": {"$gt": datetime.utcnow()}})
+        except Exception as e:
+            logging.warning("Geocode cache read failed: %s", e)
+            return None
+        return doc["address"] if doc else None
+
+    def _put_persistent(self, key, value):
+        if self.collection is None:
+            return
+        try:
+            self.collection.update_one(
+                {"_id": key},
+                {"$set": {"address": value, "expires_at": datetime.utcnow() + self.ttl}},
+                upsert=True,
+            )
+        except Exception as e:
+            logging.warning("Geocode cache write failed: %s", e)
+
+
+def place_key(place):
+    """Normalise free-text place names so trivial variations share a cache entry."""
+    return " ".join(place.lower().replace(",", " ").split())
+
+
+class PlaceCache(GeocodeCache):
+    """Forward-geocode cache: free-text place name -> ``{"lat", "lon"}``.
+
+    Same layers and coalescing as ``GeocodeCache``, keyed by the
+    normalised text. Pass the reverse cache's ``rate_limiter`` so both
+    kinds of lookup share Nominatim's request budget.
+    """
+
+    def lookup(self, place):
+        key = place_key(place)
+        if not key:
+            return {}
+        return self._lookup(key, place)
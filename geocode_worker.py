@@ -0,0 +1,103 @@
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+ADDRESS_FIELDS = ("full_address", "city", "postcode", "country")
+
+
+class GeocodeWorker:
+    """Resolves shared locations in the background.
+
+    The location step only stores ``latitude``/``longitude`` and moves on;
+    the address fields are filled in here once ``resolve`` returns. If the
+    chat is still filling in the form, the pending state is patched. If the
+    order was already saved, or is being saved, the matching ``deliveries``
+    document is patched instead. Orders that still have no address
+    (Nominatim failed or the process stopped first) are picked up by
+    ``backfill``.
+    """
+
+    def __init__(self, resolve, deliveries_collection, workers=4):
+        self.resolve = resolve
+        self.deliveries = deliveries_collection
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="geocode")
+
+    def submit(self, states, chat_id, lat, lon):
+        return self._executor.submit(self._run, states, chat_id, lat, lon)
+
+    def shutdown(self, wait=True):
+        self._executor.shutdown(wait=wait)
+
+    def _run(self, states, chat_id, lat, lon):
+        try:
+            address = self.resolve(lat, lon)
+            if not address:
+                logging.warning("No address for chat_id %s at %s, %s; leaving it for backfill", chat_id, lat, lon)
+                return
+            data = self._patch_state(states, chat_id, lat, lon, address)
+            if data is None:
+                # The order was saved, and its state dropped, before the address arrived
+                self.deliveries.update_many(
+                    {"chat_id": chat_id, "latitude": lat, "longitude": lon,
+                     "full_address": {"$exists": False}},
+                    {"$set": address},
+                )
+            elif data.get("order_id"):
+                # finish_order is saving this order and may have copied it before the patch
+                self._patch_order(chat_id, data["order_id"], address)
+        except Exception as e:
+            logging.error("Background geocoding failed for chat_id %s: %s", chat_id, e)
+
+    def _patch_state(self, states, chat_id, lat, lon, address):
+        """Add the address to the chat's unfinished order; returns its data, or None if it is gone."""
+        state = states.get(chat_id)
+        data = state.get("data") if state else None
+        if not data or data.get("latitude") != lat or data.get("longitude") != lon:
+            return None
+        data.update(address)
+        states.commit(chat_id)
+        return data
+
+    def _patch_order(self, chat_id, order_id, address, attempts=25, delay=0.2):
+        # The insert may still be on its way; retry until it lands
+        for _ in range(attempts):
+            if self.deliveries.update_one({"chat_id": chat_id, "order_id": order_id},
+                                          {"$set": address}).matched_count:
+                return True
+            time.sleep(delay)
+        logging.warning("Order %s of chat_id %s not found; leaving its address for backfill", order_id, chat_id)
+        return False
+
+    def backfill(self, batch_size=100):
+        """Geocode saved deliveries that have coordinates but no address."""
+        query = {"latitude": {"$exists": True}, "longitude": {"$exists": True},
+                 "full_address": {"$exists": False}}
+        fixed = 0
+        failed_ids = []
+        while True:
+            batch = list(self.deliveries.find(
+                dict(query, _id={"$nin": failed_ids}),
+                {"latitude": 1, "longitude": 1},
+            ).limit(batch_size))
+            if not batch:
+                break
+            for doc in batch:
+                address = self.resolve(doc["latitude"], doc["longitude"])
+                if not address:
+                    failed_ids.append(doc["_id"])
+                    continue
+                self.deliveries.update_one({"_id": doc["_id"]}, {"$set": address})
+                fixed += 1
+        logging.info("Geocode backfill patched %s deliveries, %s still unresolved", fixed, len(failed_ids))
+        return fixed
+
+
+if __name__ == "__main__":
+    # Catch-up mode: python geocode_worker.py
+    import sms_sender
+
+    sms_sender.app.start_logging()
+    try:
+        sms_sender.app.geocode_worker.backfill()
+    finally:
+        sms_sender.app.close()
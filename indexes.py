@@ -0,0 +1,40 @@
+from pymongo import ASCENDING, DESCENDING
+
+# /mydeliveries filters on chat_id, sorts on created_at and only reads the
+# fields below, so the whole query is answered from this index.
+MY_DELIVERIES_FIELDS = ["order_id", "pickup", "dropoff", "created_at"]
+
+
+def ensure_indexes(db):
+    """Create the indexes the bot's queries rely on; safe to run on every start."""
+    deliveries = db["deliveries"]
+    # The upsert key of save_delivery; order ids are 8 hex digits, unique per chat only
+    deliveries.create_index(
+        [("chat_id", ASCENDING), ("order_id", ASCENDING)],
+        name="chat_order_id",
+        unique=True,
+        partialFilterExpression={"order_id": {"$type": "string"}},
+    )
+    deliveries.create_index(
+        [("chat_id", ASCENDING), ("created_at", DESCENDING),
+         ("order_id", ASCENDING), ("pickup", ASCENDING), ("dropoff", ASCENDING)],
+        name="chat_recent_orders",
+    )
+    # Time-range scans (rollups, reporting) use the native datetimes
+    deliveries.create_index("created_at", name="created_at")
+
+    db["feedback"].create_index([("chat_id", ASCENDING), ("timestamp", DESCENDING)],
+                                name="chat_feedback")
+    db["feedback"].create_index("created_at", name="created_at")
+
+    bot_events = db["bot_events"]
+    bot_events.create_index([("event", ASCENDING), ("timestamp", DESCENDING)], name="event_time")
+    bot_events.create_index([("chat_id", ASCENDING), ("timestamp", DESCENDING)], name="chat_events")
+
+    # Per-chat leases of the cluster runtime; dead workers are released by owner
+    db["conversation_states"].create_index("owner", name="lease_owner")
+    # ...and idle sessions are found oldest first by the session sweeper
+    db["conversation_states"].create_index("updated_at", name="state_idle")
+
+    # offset_tracking and chat_stats are only ever read by _id, which is
+    # always indexed, so they need nothing extra.
@@ -0,0 +1,255 @@
+"""Replay synthetic conversations against the bot using local stand-ins.
+
+The bot runs in-process against the stub Telegram, Nominatim and
+AfroMessage servers from stub_servers.py, and against either a local
+MongoDB (a throwaway database, dropped first) or mongomock, which has to
+be installed separately::
+
+    python loadtest.py --chats 200 --runtime async --nominatim-latency 0.5
+    python loadtest.py --chats 50 --mock-mongo
+
+Each simulated user waits for the bot's reply before sending the next
+message, like a real customer would. The report shows updates/second,
+end-to-end reply latency and where time was spent per dependency.
+"""
+import argparse
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+import pymongo
+from pymongo import DeleteOne, InsertOne, ReplaceOne, UpdateMany, UpdateOne, monitoring
+from pymongo.results import BulkWriteResult
+
+from stub_servers import AfroMessageStub, NominatimStub, TelegramStub
+
+PHONE = "0911223344"
+QUOTE_PREFIXES = ("💰", "📏")
+
+# (kind, value, replies the bot is expected to send, not counting the price quote)
+SCRIPTS = {
+    "order": [
+        ("text", "/start", 2),
+        ("text", "Bole, Edna Mall", 1),
+        ("text", PHONE, 1),
+        ("text", "Piassa", 1),
+        ("text", PHONE, 1),
+        ("location", None, 1),
+        ("text", "Sender / ላኪ", 1),
+        ("text", "Documents", 1),
+        ("text", "2", 1),
+        ("callback", "new_order", 2),
+        ("text", "/cancel", 1),
+    ],
+    "feedback": [
+        ("text", "/feedback", 1),
+        ("text", "Fast delivery, thanks!", 1),
+    ],
+    "start_over": [
+        ("text", "/start", 2),
+        ("text", "Megenagna", 1),
+        ("text", "/start", 1),
+        ("callback", "start_over", 2),
+        ("text", "/cancel", 1),
+    ],
+}
+
+
+class MongoTimer(monitoring.CommandListener):
+    """Accumulates time spent per Mongo command (real MongoDB only)."""
+
+    def __init__(self):
+        self.timings = defaultdict(lambda: [0, 0.0])
+        self.lock = threading.Lock()
+
+    def started(self, event):
+        pass
+
+    def succeeded(self, event):
+        self._record(event)
+
+    def failed(self, event):
+        self._record(event)
+
+    def _record(self, event):
+        with self.lock:
+            entry = self.timings[event.command_name]
+            entry[0] += 1
+            entry[1] += event.duration_micros / 1e6
+
+
+def mongomock_bulk_write(self, requests, ordered=True, **kwargs):
+    """``Collection.bulk_write`` for mongomock, applying operations one at a time.
+
+    mongomock can't consume the operation objects of recent pymongo
+    releases; this returns a real ``BulkWriteResult`` with the counts.
+    """
+    counts = {"nInserted": 0, "nMatched": 0, "nModified": 0, "nRemoved": 0, "nUpserted": 0, "upserted": []}
+    for index, op in enumerate(requests):
+        if isinstance(op, InsertOne):
+            self.insert_one(op._doc)
+            counts["nInserted"] += 1
+            continue
+        if isinstance(op, DeleteOne):
+            counts["nRemoved"] += self.delete_one(op._filter).deleted_count
+            continue
+        if isinstance(op, UpdateOne):
+            result = self.update_one(op._filter, op._doc, upsert=op._upsert)
+        elif isinstance(op, UpdateMany):
+            result = self.update_many(op._filter, op._doc, upsert=op._upsert)
+        elif isinstance(op, ReplaceOne):
+            result = self.replace_one(op._filter, op._doc, upsert=op._upsert)
+        else:
+            raise NotImplementedError(type(op).__name__)
+        counts["nMatched"] += result.matched_count
+        counts["nModified"] += result.modified_count
+        if result.upserted_id is not None:
+            counts["nUpserted"] += 1
+            counts["upserted"].append({"index": index, "_id": result.upserted_id})
+    return BulkWriteResult(counts, True)
+
+
+def use_mongomock():
+    import mongomock
+
+    mongomock.collection.Collection.bulk_write = mongomock_bulk_write
+    pymongo.MongoClient = mongomock.MongoClient
+
+
+def make_update(chat_id, kind, value, rng):
+    user = {"id": chat_id, "first_name": "Load", "last_name": str(chat_id)}
+    message = {"message_id": rng.randint(1, 10 ** 9), "date": int(time.time()),
+               "chat": {"id": chat_id, "type": "private"}, "from": user}
+    if kind == "callback":
+        return {"callback_query": {"id": str(rng.random()), "from": user, "data": value,
+                                   "message": message}}
+    if kind == "location":
+        # Spread over central Addis Ababa so the geocode cache sees a realistic mix
+        message["location"] = {"latitude": rng.uniform(8.95, 9.08), "longitude": rng.uniform(38.70, 38.85)}
+    else:
+        message["text"] = value
+    return {"message": message}
+
+
+def is_quote(message):
+    # The price quote is sent from a Quoter.quote_later background task once
+    # both places are geocoded, so it can land after any later step and
+    # isn't part of the reply counts
+    return (message.get("text") or "").startswith(QUOTE_PREFIXES)
+
+
+def run_conversation(telegram, chat_id, script, latencies, timeout, rng):
+    received = len(telegram.messages_for(chat_id, skip=is_quote))
+    for kind, value, replies in SCRIPTS[script]:
+        injected = time.monotonic()
+        telegram.push(make_update(chat_id, kind, value, rng))
+        messages = telegram.wait_for_messages(chat_id, received + replies, timeout, skip=is_quote)
+        if messages is None:
+            return False
+        latencies.append(messages[received]["at"] - injected)
+        received = len(messages)
+    return True
+
+
+def percentile(values, pct):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * pct / 100))]
+
+
+def print_timings(name, timings):
+    for endpoint, (count, total) in sorted(timings.items()):
+        mean = total / count * 1000 if count else 0
+        print(f"  {name:<12} {endpoint:<20} {count:>7} calls  {total:>8.2f}s total  {mean:>8.2f}ms mean")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--chats", type=int, default=50, help="concurrent simulated users")
+    parser.add_argument("--rounds", type=int, default=1, help="conversations per user")
+    parser.add_argument("--runtime", choices=["sync", "async"], default="sync")
+    parser.add_argument("--telegram-latency", type=float, default=0.02)
+    parser.add_argument("--nominatim-latency", type=float, default=0.3)
+    parser.add_argument("--afro-latency", type=float, default=0.1)
+    parser.add_argument("--geocode-interval", type=float, default=1.0,
+                        help="minimum seconds between Nominatim calls (the policy is 1)")
+    parser.add_argument("--mongo-uri", default="mongodb://localhost:27017")
+    parser.add_argument("--mongo-db", default="tolo_loadtest")
+    parser.add_argument("--mock-mongo", action="store_true", help="use mongomock instead of a server")
+    parser.add_argument("--reply-timeout", type=float, default=30.0)
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    telegram = TelegramStub(latency=args.telegram_latency).start()
+    nominatim = NominatimStub(latency=args.nominatim_latency).start()
+    afro = AfroMessageStub(latency=args.afro_latency).start()
+
+    os.environ.update({
+        "BOT_TOKEN": "loadtest",
+        "TELEGRAM_API_BASE": telegram.url,
+        "NOMINATIM_URL": nominatim.url,
+        "AFRO_BASE_URL": afro.url,
+        "MONGO_URI": args.mongo_uri,
+        "MONGO_DB": args.mongo_db,
+        "BOT_MODE": "polling",
+        "BOT_RUNTIME": args.runtime,
+        "GEOCODE_MIN_INTERVAL": str(args.geocode_interval),
+    })
+    # State files go to a scratch directory
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    os.chdir(tempfile.mkdtemp(prefix="tolo-loadtest-"))
+
+    mongo_timer = None
+    if args.mock_mongo:
+        use_mongomock()
+    else:
+        mongo_timer = MongoTimer()
+        monitoring.register(mongo_timer)
+
+    import sms_sender
+
+    sms_sender.app.start_logging()
+    if not args.mock_mongo:
+        sms_sender.app.client.drop_database(args.mongo_db)
+    threading.Thread(target=sms_sender.main, name="bot", daemon=True).start()
+
+    rng = random.Random(args.seed)
+    users = {100000 + i: ([rng.choice(list(SCRIPTS)) for _ in range(args.rounds)], random.Random(rng.random()))
+             for i in range(args.chats)}
+
+    def run_user(chat_id):
+        scripts, user_rng = users[chat_id]
+        return all([run_conversation(telegram, chat_id, script, latencies, args.reply_timeout, user_rng)
+                    for script in scripts])
+
+    latencies = []
+    started = time.monotonic()
+    with ThreadPoolExecutor(max_workers=args.chats) as pool:
+        results = list(pool.map(run_user, users))
+    elapsed = time.monotonic() - started
+
+    updates = telegram.next_update_id - 1
+    print(f"runtime={args.runtime} chats={args.chats} rounds={args.rounds} "
+          f"mongo={'mongomock' if args.mock_mongo else args.mongo_uri}")
+    print(f"updates:        {updates} in {elapsed:.2f}s = {updates / elapsed:.1f} updates/s")
+    print(f"reply latency:  p50 {percentile(latencies, 50) * 1000:.1f}ms  "
+          f"p99 {percentile(latencies, 99) * 1000:.1f}ms  max {max(latencies or [0]) * 1000:.1f}ms")
+    print(f"timed out:      {results.count(False)} of {len(results)} users")
+    print(f"outbox:         {sms_sender.app.outbox.stats()}")
+    print(f"geocode cache:  {sms_sender.app.geocode_cache.hits} hits, {sms_sender.app.geocode_cache.misses} misses")
+    print("dependency time:")
+    print_timings("telegram", telegram.timings)
+    print_timings("nominatim", nominatim.timings)
+    print_timings("afromessage", afro.timings)
+    if mongo_timer:
+        print_timings("mongo", mongo_timer.timings)
+
+
+if __name__ == "__main__":
+    main()
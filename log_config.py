@@ -0,0 +1,116 @@
+import itertools
+import json
+import logging
+import logging.handlers
+import multiprocessing
+import queue
+import re
+import sys
+from datetime import datetime, timezone
+
+# Ethiopian mobile numbers (09/07..., 2519/2517... with or without +)
+PHONE_RE = re.compile(r"(?<!\d)(\+?251|0)([79])\d{6}(\d{2})(?!\d)")
+
+TEXT_FORMAT = "%(asctime)s - %(levelname)s - %(message)s"
+
+# Attributes every LogRecord has; anything else was passed with extra=
+_RECORD_FIELDS = set(vars(logging.LogRecord("", 0, "", 0, "", (), None))) | {"message", "asctime", "sampled"}
+
+
+def redact(text):
+    """Mask phone numbers, keeping the prefix and the last two digits."""
+    return PHONE_RE.sub(r"\1\2******\3", text)
+
+
+class JsonFormatter(logging.Formatter):
+    """One compact JSON object per record; extra= fields become keys."""
+
+    def format(self, record):
+        entry = {
+            "ts": datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": redact(record.getMessage()),
+        }
+        for key, value in vars(record).items():
+            if key not in _RECORD_FIELDS:
+                entry[key] = redact(value) if isinstance(value, str) else value
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry["exc"] = record.exc_text
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class RedactingFormatter(logging.Formatter):
+    def format(self, record):
+        return redact(super().format(record))
+
+
+class SamplingFilter(logging.Filter):
+    """Keeps one in ``every`` records logged with ``extra={"sampled": True}``.
+
+    Meant for per-message chatter; everything else passes untouched.
+    """
+
+    def __init__(self, every):
+        super().__init__()
+        self.every = max(1, int(every))
+        self._counter = itertools.count()
+
+    def filter(self, record):
+        if not getattr(record, "sampled", False) or self.every == 1:
+            return True
+        return next(self._counter) % self.every == 0
+
+
+class DeferredQueueHandler(logging.handlers.QueueHandler):
+    """Hands records to the listener thread without formatting them.
+
+    Only tracebacks are rendered here, while their frames still exist;
+    the message itself is built from ``msg % args`` by the listener, so
+    arguments should not be mutated after the call.
+    """
+
+    def prepare(self, record):
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+def setup_logging(level="INFO", path="bot_activity.log", fmt="json", max_bytes=10 * 1024 * 1024,
+                  backups=5, rotate_when=None, sample_every=10):
+    """Route all logging through a queue to rotating file and console handlers.
+
+    Returns the ``QueueListener``; stop it on shutdown to drain the queue.
+    Worker processes of the cluster runtime only log to stderr, since
+    several processes can't safely rotate one file.
+    """
+    formatter = JsonFormatter() if fmt == "json" else RedactingFormatter(TEXT_FORMAT)
+    handlers = []
+    if path and multiprocessing.parent_process() is None:
+        if rotate_when:
+            file_handler = logging.handlers.TimedRotatingFileHandler(path, when=rotate_when, backupCount=backups,
+                                                                     encoding="utf-8")
+        else:
+            file_handler = logging.handlers.RotatingFileHandler(path, maxBytes=max_bytes, backupCount=backups,
+                                                                encoding="utf-8")
+        handlers.append(file_handler)
+    handlers.append(logging.StreamHandler(sys.stderr))
+    for handler in handlers:
+        handler.setFormatter(formatter)
+
+    records = queue.SimpleQueue()
+    queue_handler = DeferredQueueHandler(records)
+    queue_handler.addFilter(SamplingFilter(sample_every))
+
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    root.addHandler(queue_handler)
+    root.setLevel(level)
+
+    listener = logging.handlers.QueueListener(records, *handlers, respect_handler_level=True)
+    listener.start()
+    return listener
@@ -0,0 +1,123 @@
+import logging
+import threading
+import time
+
+from pymongo import InsertOne, UpdateOne
+from pymongo.errors import BulkWriteError, PyMongoError
+
+from metrics import histogram, timed
+
+DUPLICATE_KEY = 11000
+
+MONGO_WRITE_SECONDS = histogram("mongo_write_seconds", "Mongo write latency", ["collection"])
+
+
+class BatchWriter:
+    """Write-behind buffer for inserts that don't need to block a reply.
+
+    Writes are queued per collection and flushed with one unordered
+    ``bulk_write`` per collection, either once ``max_batch`` operations are
+    waiting or every ``flush_interval`` seconds. Duplicate-key errors are
+    expected for replayed updates and ignored; other failures are put back
+    and retried with backoff up to ``max_retries`` times. ``close`` drains
+    whatever is left.
+    """
+
+    def __init__(self, max_batch=500, flush_interval=1.0, max_retries=5):
+        self.max_batch = max_batch
+        self.flush_interval = flush_interval
+        self.max_retries = max_retries
+
+        self._pending = {}
+        self._size = 0
+        self._cond = threading.Condition()
+        self._flush_lock = threading.Lock()
+        self._closed = False
+        self._thread = None
+
+    # ---- producers --------------------------------------------------------
+
+    def insert(self, collection, doc):
+        self._add(collection, InsertOne(doc))
+
+    def insert_once(self, collection, doc_id, doc):
+        """Insert ``doc`` as ``doc_id`` unless it already exists."""
+        self._add(collection, UpdateOne({"_id": doc_id}, {"$setOnInsert": doc}, upsert=True))
+
+    def update(self, collection, filter, update, upsert=False):
+        self._add(collection, UpdateOne(filter, update, upsert=upsert))
+
+    def _add(self, collection, op, attempts=0):
+        with self._cond:
+            entry = self._pending.setdefault(collection.full_name, (collection, []))
+            entry[1].append((op, attempts))
+            self._size += 1
+            if self._size >= self.max_batch:
+                self._cond.notify()
+        self._ensure_started()
+
+    # ---- flushing ---------------------------------------------------------
+
+    def _ensure_started(self):
+        if self._thread is None and not self._closed:
+            with self._cond:
+                if self._thread is None:
+                    self._thread = threading.Thread(target=self._loop, name="mongo-writer", daemon=True)
+                    self._thread.start()
+
+    def _loop(self):
+        while True:
+            with self._cond:
+                if not self._closed and self._size < self.max_batch:
+                    self._cond.wait(self.flush_interval)
+                closed = self._closed
+            self.flush()
+            if closed:
+                return
+
+    def pending(self):
+        return self._size
+
+    def flush(self):
+        with self._flush_lock:
+            with self._cond:
+                pending, self._pending, self._size = self._pending, {}, 0
+            retry = False
+            for collection, ops in pending.values():
+                retry |= self._write(collection, ops)
+        if retry and not self._closed:
+            time.sleep(min(self.flush_interval, 1.0))
+
+    def _write(self, collection, ops):
+        """Write one collection's batch; returns True if anything was requeued."""
+        failed = []
+        try:
+            with timed(MONGO_WRITE_SECONDS, collection=collection.name):
+                collection.bulk_write([op for op, _ in ops], ordered=False)
+        except BulkWriteError as e:
+            for error in e.details.get("writeErrors", []):
+                if error.get("code") != DUPLICATE_KEY:
+                    failed.append(ops[error["index"]])
+        except PyMongoError as e:
+            logging.warning("Batch write to %s failed: %s", collection.full_name, e)
+            failed = ops
+
+        requeued = False
+        for op, attempts in failed:
+            if attempts + 1 >= self.max_retries:
+                logging.error("Dropping write to %s after %s attempts: %s", collection.full_name, attempts + 1, op)
+                continue
+            self._add(collection, op, attempts + 1)
+            requeued = True
+        return requeued
+
+    def close(self, timeout=30):
+        with self._cond:
+            self._closed = True
+            self._cond.notify()
+        if self._thread is not None:
+            self._thread.join(timeout)
+        # Drain anything that was requeued after the loop exited.
+        deadline = time.monotonic() + timeout
+        while self._size and time.monotonic() < deadline:
+            self.flush()
@@ -0,0 +1,61 @@
+import threading
+import time
+
+
+class OffsetCommitter:
+    """Coalesces ``save_offset`` calls.
+
+    The polling loops report every processed update with ``advance``; the
+    offset is only written once ``max_updates`` updates or ``interval``
+    seconds have gone by. ``before_commit`` (the state journal flush) always
+    runs first, so the stored offset never gets ahead of the stored state.
+    Updates replayed after a crash are made harmless by the idempotency
+    checks in ``handle_update`` and the keyed inserts.
+    """
+
+    def __init__(self, save_offset, before_commit=None, interval=5.0, max_updates=100):
+        self.save_offset = save_offset
+        self.before_commit = before_commit
+        self.interval = interval
+        self.max_updates = max_updates
+
+        self.offset = None
+        self.committed = None
+        self._since_commit = 0
+        self._last_commit = time.monotonic()
+        self._lock = threading.Lock()
+
+    def start(self, offset):
+        self.offset = self.committed = offset
+
+    @property
+    def pending(self):
+        return self.offset != self.committed
+
+    def advance(self, offset):
+        """Record that everything before ``offset`` is done; returns ``due()``."""
+        self.offset = offset
+        self._since_commit += 1
+        return self.due()
+
+    def due(self):
+        if not self.pending:
+            return False
+        return (self._since_commit >= self.max_updates
+                or time.monotonic() - self._last_commit >= self.interval)
+
+    def commit_if_due(self):
+        if self.due():
+            self.commit()
+
+    def commit(self):
+        with self._lock:
+            offset = self.offset
+            if offset is None or offset == self.committed:
+                return
+            if self.before_commit:
+                self.before_commit()
+            self.save_offset(offset)
+            self.committed = offset
+            self._since_commit = 0
+            self._last_commit = time.monotonic()
@@ -0,0 +1,173 @@
+import logging
+import math
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from pymongo import UpdateOne
+
+from geocache import place_key
+
+# (up to km, birr); the same tiers /price shows
+PRICE_TIERS = [(5, 100), (10, 200), (20, 300)]
+EARTH_RADIUS_KM = 6371.0088
+
+# Price per whole kilometre, rounded up: _PRICE_BY_KM[6] is the 6 - 10 km tier
+_PRICE_BY_KM = [PRICE_TIERS[0][1]]
+for _limit, _price in PRICE_TIERS:
+    _PRICE_BY_KM.extend([_price] * (_limit + 1 - len(_PRICE_BY_KM)))
+
+
+def price_for_km(km):
+    """Tier price for a distance, or None beyond the last tier."""
+    index = math.ceil(km)
+    return _PRICE_BY_KM[index] if index < len(_PRICE_BY_KM) else None
+
+
+def price_table(unit="km", currency="birr"):
+    lines = []
+    lower = 1
+    for limit, price in PRICE_TIERS:
+        lines.append(f"{lower} - {limit} {unit}: {price} {currency}")
+        lower = limit + 1
+    return "\n".join(lines) + "\n"
+
+
+def haversine_many(points):
+    """Great-circle distances in km for ``[(lat1, lon1, lat2, lon2), ...]``.
+
+    Plain Python over the whole batch (numpy isn't a dependency here); the
+    trigonometry is bound to locals once, which is most of the cost.
+    """
+    radians, sin, cos, asin, sqrt = math.radians, math.sin, math.cos, math.asin, math.sqrt
+    diameter = 2 * EARTH_RADIUS_KM
+    distances = []
+    for lat1, lon1, lat2, lon2 in points:
+        phi1, phi2 = radians(lat1), radians(lat2)
+        a = sin((phi2 - phi1) / 2) ** 2 + cos(phi1) * cos(phi2) * sin(radians(lon2 - lon1) / 2) ** 2
+        distances.append(diameter * asin(sqrt(a)))
+    return distances
+
+
+def haversine_km(lat1, lon1, lat2, lon2):
+    return haversine_many([(lat1, lon1, lat2, lon2)])[0]
+
+
+class Quoter:
+    """Prices a delivery from its pickup and drop-off text.
+
+    Both places are resolved with ``geocode_place`` (normally a
+    ``PlaceCache`` lookup returning ``{"lat", "lon"}``), the straight-line
+    distance is mapped onto ``PRICE_TIERS``, and the quote is memoized per
+    pickup/drop-off pair. Quotes that couldn't be computed are not kept.
+    """
+
+    def __init__(self, geocode_place, max_entries=10000, workers=2):
+        self.geocode_place = geocode_place
+        self.max_entries = max_entries
+        self._memo = OrderedDict()
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="quote")
+
+    def quote(self, pickup, dropoff):
+        return self.quote_many([(pickup, dropoff)])[0]
+
+    def quote_many(self, pairs):
+        """Quote ``[(pickup, dropoff), ...]``, geocoding each distinct place once."""
+        keys = [(place_key(p), place_key(d)) for p, d in pairs]
+        quotes = [None] * len(pairs)
+        todo = []
+        with self._lock:
+            for i, key in enumerate(keys):
+                if key in self._memo:
+                    self._memo.move_to_end(key)
+                    quotes[i] = self._memo[key]
+                else:
+                    todo.append(i)
+        if not todo:
+            return quotes
+
+        places = {}
+        for i in todo:
+            for place in pairs[i]:
+                if place and place_key(place) not in places:
+                    places[place_key(place)] = self.geocode_place(place)
+
+        ready = []
+        for i in todo:
+            start, end = (places.get(key) for key in keys[i])
+            if start and end:
+                ready.append(i)
+        distances = haversine_many(
+            [(places[keys[i][0]]["lat"], places[keys[i][0]]["lon"],
+              places[keys[i][1]]["lat"], places[keys[i][1]]["lon"]) for i in ready]
+        )
+        with self._lock:
+            for i, km in zip(ready, distances):
+                quotes[i] = {"distance_km": round(km, 2), "price": price_for_km(km)}
+                self._memo[keys[i]] = quotes[i]
+            while len(self._memo) > self.max_entries:
+                self._memo.popitem(last=False)
+        return quotes
+
+    def quote_later(self, pickup, dropoff, callback):
+        """Quote in the background and call ``callback(quote)``."""
+        def run():
+            try:
+                callback(self.quote(pickup, dropoff))
+            except Exception as e:
+                logging.error("Quoting %s -> %s failed: %s", pickup, dropoff, e, exc_info=True)
+        return self._executor.submit(run)
+
+    def shutdown(self, wait=True):
+        self._executor.shutdown(wait=wait)
+
+
+def reprice(deliveries, quoter, batch_size=500, only_missing=True):
+    """Store a ``quote`` on saved deliveries, for reporting.
+
+    By default only deliveries without a quote are priced. With
+    ``only_missing=False`` every delivery is re-tiered; ones that already
+    have a distance are not geocoded again.
+    """
+    query = {"pickup": {"$type": "string"}, "dropoff": {"$type": "string"}}
+    if only_missing:
+        query["quote"] = {"$exists": False}
+    priced = unpriced = 0
+    last_id = None
+    while True:
+        page = dict(query, _id={"$gt": last_id}) if last_id is not None else query
+        batch = list(deliveries.find(page, {"pickup": 1, "dropoff": 1, "quote": 1})
+                     .sort("_id", 1).limit(batch_size))
+        if not batch:
+            break
+        last_id = batch[-1]["_id"]
+
+        known = [doc for doc in batch if (doc.get("quote") or {}).get("distance_km") is not None]
+        unknown = [doc for doc in batch if (doc.get("quote") or {}).get("distance_km") is None]
+        quotes = [{"distance_km": doc["quote"]["distance_km"], "price": price_for_km(doc["quote"]["distance_km"])}
+                  for doc in known]
+        quotes += quoter.quote_many([(doc["pickup"], doc["dropoff"]) for doc in unknown])
+
+        ops = [UpdateOne({"_id": doc["_id"]}, {"$set": {"quote": quote}})
+               for doc, quote in zip(known + unknown, quotes) if quote]
+        if ops:
+            deliveries.bulk_write(ops, ordered=False)
+        priced += len(ops)
+        unpriced += len(batch) - len(ops)
+    logging.info("Re-pricing stored %s quotes; %s deliveries could not be priced", priced, unpriced)
+    return priced
+
+
+if __name__ == "__main__":
+    # Reporting mode: python pricing.py [--all]
+    import sys
+
+    import sms_sender
+
+    app = sms_sender.app
+    app.start_logging()
+    try:
+        reprice(app.deliveries, app.quoter, only_missing="--all" not in sys.argv)
+    finally:
+        app.close()
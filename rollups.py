@@ -0,0 +1,242 @@
+"""Hourly and daily counters for dashboards, kept in the ``rollups`` collection.
+
+Each run recomputes every whole hour between the checkpoint and
+``now - lag`` from ``bot_events``, ``deliveries`` and ``feedback`` (range
+scans on their time indexes, grouped server-side), replaces those hour
+documents and re-sums the daily documents they fall in. Recomputing
+instead of incrementing makes a run safe to repeat after a crash; the lag
+leaves time for the batched writers to land their last inserts.
+
+    {"_id": "hour:2026-10-18T09", "period": "hour", "start": datetime,
+     "starts": 12, "sessions": 9, "orders": 5, "cancellations": 2, "feedback": 1,
+     "funnel": {"0": 9, "1": 8, ...}, "dropoff": {"0": 1, ...},
+     "cancelled_at": {"3": 1}, "payment": {"Sender / ላኪ": 4, ...},
+     "cities": {"Addis Ababa": 5}}
+
+``funnel`` counts answers per ``Data_Message`` step and ``dropoff`` is how
+many fewer answered the next one; steps skipped for returning customers
+show up as drop-off.
+"""
+import logging
+import time
+from datetime import datetime, timedelta
+
+from pymongo import ReplaceOne, UpdateOne
+
+HOUR = timedelta(hours=1)
+DAY = timedelta(days=1)
+CHECKPOINT_ID = "checkpoint"
+TIMESTAMP_FORMAT = "%Y-%m-%d %H:%M:%S"
+COUNTERS = ("starts", "sessions", "orders", "cancellations", "feedback")
+BREAKDOWNS = ("funnel", "cancelled_at", "payment", "cities")
+
+
+def hour_floor(moment):
+    return moment.replace(minute=0, second=0, microsecond=0)
+
+
+def hour_id(start):
+    return start.strftime("hour:%Y-%m-%dT%H")
+
+
+def day_id(start):
+    return start.strftime("day:%Y-%m-%d")
+
+
+def _key(value):
+    # Field names can't contain "." or start with "$"
+    return str(value).replace(".", "_").replace("$", "_") if value not in (None, "") else "unknown"
+
+
+def _by_hour(collection, time_field, start, end, match=None, group=None):
+    """``{(hour, group values...): count}`` for documents in ``[start, end)``."""
+    group_id = {"hour": {"$dateToString": {"format": "%Y-%m-%dT%H", "date": f"${time_field}"}}}
+    group_id.update({name: f"${field}" for name, field in (group or {}).items()})
+    pipeline = [
+        {"$match": dict(match or {}, **{time_field: {"$gte": start, "$lt": end}})},
+        {"$group": {"_id": group_id, "n": {"$sum": 1}}},
+    ]
+    counts = {}
+    for row in collection.aggregate(pipeline):
+        key = row["_id"]
+        hour = datetime.strptime(key.pop("hour"), "%Y-%m-%dT%H")
+        counts[(hour,) + tuple(key.get(name) for name in (group or {}))] = row["n"]
+    return counts
+
+
+def _empty(period, start):
+    doc = {"_id": (hour_id if period == "hour" else day_id)(start), "period": period, "start": start}
+    doc.update({name: 0 for name in COUNTERS})
+    doc.update({name: {} for name in BREAKDOWNS})
+    return doc
+
+
+def _dropoff(funnel):
+    steps = sorted(funnel, key=int)
+    return {step: max(0, funnel[step] - funnel.get(str(int(step) + 1), 0)) for step in steps[:-1]}
+
+
+def compute_hours(db, start, end):
+    """Rollup documents for every hour in ``[start, end)``, zeros included."""
+    hours = {}
+    moment = start
+    while moment < end:
+        hours[moment] = _empty("hour", moment)
+        moment += HOUR
+
+    events = _by_hour(db["bot_events"], "timestamp", start, end,
+                      match={"event": {"$in": ["bot_start", "fallback", "step", "cancel"]}},
+                      group={"event": "event", "step": "step"})
+    for (hour, event, step), n in events.items():
+        doc = hours[hour]
+        if event == "bot_start":
+            doc["starts"] += n
+        elif event == "fallback":
+            doc["sessions"] += n
+        elif event == "step":
+            doc["funnel"][_key(step)] = doc["funnel"].get(_key(step), 0) + n
+        else:
+            doc["cancellations"] += n
+            if step is not None:
+                doc["cancelled_at"][_key(step)] = doc["cancelled_at"].get(_key(step), 0) + n
+
+    orders = _by_hour(db["deliveries"], "created_at", start, end,
+                      group={"payment": "payment_from_sender_or_receiver", "city": "city"})
+    for (hour, payment, city), n in orders.items():
+        doc = hours[hour]
+        doc["orders"] += n
+        doc["payment"][_key(payment)] = doc["payment"].get(_key(payment), 0) + n
+        doc["cities"][_key(city)] = doc["cities"].get(_key(city), 0) + n
+
+    for (hour,), n in _by_hour(db["feedback"], "created_at", start, end).items():
+        hours[hour]["feedback"] += n
+
+    for doc in hours.values():
+        doc["dropoff"] = _dropoff(doc["funnel"])
+    return list(hours.values())
+
+
+def merge(docs, period, start):
+    """Sum rollup documents into one covering ``start``."""
+    total = _empty(period, start)
+    for doc in docs:
+        for name in COUNTERS:
+            total[name] += doc.get(name, 0)
+        for name in BREAKDOWNS:
+            for key, n in doc.get(name, {}).items():
+                total[name][key] = total[name].get(key, 0) + n
+    total["dropoff"] = _dropoff(total["funnel"])
+    return total
+
+
+def _first_activity(db):
+    candidates = [
+        db["bot_events"].find_one({}, {"timestamp": 1}, sort=[("timestamp", 1)]),
+        db["deliveries"].find_one({"created_at": {"$type": "date"}}, {"created_at": 1}, sort=[("created_at", 1)]),
+        db["feedback"].find_one({"created_at": {"$type": "date"}}, {"created_at": 1}, sort=[("created_at", 1)]),
+    ]
+    moments = [doc.get("timestamp") or doc.get("created_at") for doc in candidates if doc]
+    moments = [moment for moment in moments if isinstance(moment, datetime)]
+    return hour_floor(min(moments)) if moments else None
+
+
+def update_rollups(db, now=None, lag=timedelta(minutes=10), since=None):
+    """Bring the rollups up to ``now - lag``; returns the number of hours written.
+
+    Work is done a day at a time and the checkpoint advances after each
+    day, so an interrupted backfill resumes where it stopped. ``since``
+    recomputes from that hour regardless of the checkpoint.
+    """
+    rollups = db["rollups"]
+    end = hour_floor((now or datetime.now()) - lag)
+    if since is not None:
+        start = hour_floor(since)
+    else:
+        checkpoint = rollups.find_one({"_id": CHECKPOINT_ID})
+        start = checkpoint["until"] if checkpoint else _first_activity(db)
+    if start is None or start >= end:
+        return 0
+
+    written = 0
+    while start < end:
+        chunk_end = min(end, datetime.combine(start.date(), datetime.min.time()) + DAY)
+        hours = compute_hours(db, start, chunk_end)
+        rollups.bulk_write([ReplaceOne({"_id": doc["_id"]}, doc, upsert=True) for doc in hours], ordered=False)
+
+        day = datetime.combine(start.date(), datetime.min.time())
+        day_hours = rollups.find({"_id": {"$gte": hour_id(day), "$lte": hour_id(day + DAY - HOUR)}})
+        rollups.replace_one({"_id": day_id(day)}, merge(day_hours, "day", day), upsert=True)
+
+        rollups.update_one({"_id": CHECKPOINT_ID}, {"$set": {"until": chunk_end, "updated_at": datetime.now()}},
+                           upsert=True)
+        written += len(hours)
+        start = chunk_end
+    logging.info("Rollups updated through %s (%s hours)", end, written)
+    return written
+
+
+def top_cities(db, day, n=5):
+    """``[(city, orders), ...]`` for the day containing ``day``, busiest first."""
+    doc = db["rollups"].find_one({"_id": day_id(day)}, {"cities": 1}) or {}
+    return sorted(doc.get("cities", {}).items(), key=lambda item: item[1], reverse=True)[:n]
+
+
+def migrate_timestamps(db, batch_size=500):
+    """Store ``created_at`` datetimes next to the legacy ``timestamp`` strings.
+
+    Only documents that lack ``created_at`` are touched, so it can be run
+    again safely. Returns the number of documents updated per collection.
+    """
+    migrated = {}
+    for name in ("deliveries", "feedback"):
+        collection = db[name]
+        query = {"created_at": {"$exists": False}, "timestamp": {"$type": "string"}}
+        updated = 0
+        last_id = None
+        while True:
+            page = dict(query, _id={"$gt": last_id}) if last_id is not None else query
+            batch = list(collection.find(page, {"timestamp": 1}).sort("_id", 1).limit(batch_size))
+            if not batch:
+                break
+            last_id = batch[-1]["_id"]
+            ops = []
+            for doc in batch:
+                try:
+                    created_at = datetime.strptime(doc["timestamp"], TIMESTAMP_FORMAT)
+                except ValueError:
+                    logging.warning("Unparseable timestamp %r in %s %s", doc["timestamp"], name, doc["_id"])
+                    continue
+                ops.append(UpdateOne({"_id": doc["_id"], "created_at": {"$exists": False}},
+                                     {"$set": {"created_at": created_at}}))
+            if ops:
+                updated += collection.bulk_write(ops, ordered=False).modified_count
+        migrated[name] = updated
+        logging.info("Stored created_at on %s %s documents", updated, name)
+    return migrated
+
+
+if __name__ == "__main__":
+    # python rollups.py [--migrate] [--loop SECONDS]
+    import sys
+
+    import sms_sender
+
+    args = sys.argv[1:]
+    app = sms_sender.app
+    app.start_logging()
+    try:
+        if "--migrate" in args:
+            migrate_timestamps(app.db)
+        interval = float(args[args.index("--loop") + 1]) if "--loop" in args else None
+        while True:
+            try:
+                update_rollups(app.db)
+            except Exception as e:
+                if interval is None:
+                    raise
+                logging.error("Rollup run failed: %s", e, exc_info=True)
+            if interval is None:
+                break
+            time.sleep(interval)
+    finally:
+        app.close()
@@ -0,0 +1,181 @@
+import heapq
+import logging
+import threading
+import time
+import zlib
+from datetime import datetime, timedelta
+
+from metrics import counter
+
+EVICTED = counter("bot_sessions_evicted_total", "Idle sessions dropped by the sweeper")
+NUDGED = counter("bot_sessions_nudged_total", "Resume-your-draft reminders sent")
+CHAT_LOCK_STRIPES = 256
+
+
+class SessionSweeper:
+    """Expires conversation states that have been idle for ``ttl`` seconds.
+
+    ``touch`` stamps ``last_active`` on a state whenever its chat does
+    something and pushes the chat's next deadline onto a heap, so a sweep
+    only looks at the chats that are actually due. Stale heap entries (the
+    chat was active again, or is already gone) are recognised by their
+    ``last_active`` and dropped. With ``nudge_after`` set, ``nudge(chat_id,
+    state)`` is called once for a session idle that long, before it
+    expires; it returns True if a message was sent.
+
+    Whoever handles an update holds ``chat_lock(chat_id)`` meanwhile. The
+    sweeper takes the same lock and re-checks ``last_active`` before it
+    touches a state, so it never evicts or nudges a chat that is being
+    answered right now.
+    """
+
+    def __init__(self, ttl, nudge=None, nudge_after=None, interval=60.0):
+        self.ttl = ttl
+        self.nudge = nudge
+        self.nudge_after = nudge_after if nudge and nudge_after and nudge_after < ttl else None
+        self.interval = interval
+
+        self.states = None
+        self.evicted = 0
+        self.nudged = 0
+        self._heap = []
+        self._lock = threading.Lock()
+        self._chat_locks = [threading.Lock() for _ in range(CHAT_LOCK_STRIPES)]
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _due(self, state):
+        if self.nudge_after and not state.get("nudged"):
+            return state["last_active"] + self.nudge_after
+        return state["last_active"] + self.ttl
+
+    def chat_lock(self, chat_id):
+        return self._chat_locks[zlib.crc32(str(chat_id).encode()) % len(self._chat_locks)]
+
+    def touch(self, chat_id, state):
+        """Record activity on ``chat_id``; the caller commits ``state``."""
+        state["last_active"] = time.time()
+        state.pop("nudged", None)
+        if self.states is None:
+            return
+        with self._lock:
+            heapq.heappush(self._heap, (self._due(state), chat_id, state["last_active"]))
+
+    def start(self, states):
+        self.states = states
+        now = time.time()
+        with self._lock:
+            for chat_id, state in list(states.items()):
+                if state is None:
+                    continue
+                if "last_active" not in state:
+                    # Sessions from before expiry existed get a full TTL from now
+                    state["last_active"] = now
+                    states.commit(chat_id)
+                self._heap.append((self._due(state), chat_id, state["last_active"]))
+            heapq.heapify(self._heap)
+        self._thread = threading.Thread(target=self._loop, name="session-sweeper", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+
+    def _loop(self):
+        while not self._stop.wait(self.interval):
+            try:
+                evicted = self.sweep()
+            except Exception as e:
+                logging.error("Session sweep failed: %s", e, exc_info=True)
+                continue
+            if evicted:
+                logging.info("Evicted %s idle sessions; %s", evicted, self.stats())
+
+    def sweep(self, now=None):
+        """Nudge or evict every session that is due; returns how many were evicted."""
+        now = now or time.time()
+        evicted = 0
+        while True:
+            with self._lock:
+                if not self._heap or self._heap[0][0] > now:
+                    break
+                _, chat_id, last_active = heapq.heappop(self._heap)
+            with self.chat_lock(chat_id):
+                state = self.states.get(chat_id)
+                if state is None or state.get("last_active") != last_active:
+                    continue
+                if last_active + self.ttl <= now:
+                    del self.states[chat_id]
+                    evicted += 1
+                    continue
+                state["nudged"] = True
+                self.states.commit(chat_id)
+                nudged = self.nudge(chat_id, state)
+            if nudged:
+                self.nudged += 1
+                NUDGED.inc()
+            with self._lock:
+                heapq.heappush(self._heap, (self._due(state), chat_id, last_active))
+        self.evicted += evicted
+        EVICTED.inc(evicted)
+        return evicted
+
+    def active(self):
+        return len(self.states) if self.states is not None else 0
+
+    def stats(self):
+        return {"active": self.active(), "evicted": self.evicted, "nudged": self.nudged}
+
+
+class MongoSessionSweeper(SessionSweeper):
+    """``SessionSweeper`` for states kept in Mongo by ``MongoStateStore``.
+
+    Runs once, in the cluster's ingress process. Due sessions are found
+    through the ``updated_at`` index rather than a heap, and only chats
+    whose lease has run out are touched. Nudges and evictions are
+    conditional on ``updated_at``, so a chat that became active again in
+    the meantime is left alone.
+    """
+
+    def __init__(self, collection, ttl, nudge=None, nudge_after=None, interval=60.0, batch_size=500):
+        super().__init__(ttl, nudge, nudge_after, interval)
+        self.collection = collection
+        self.batch_size = batch_size
+
+    def start(self, states=None):
+        self._thread = threading.Thread(target=self._loop, name="session-sweeper", daemon=True)
+        self._thread.start()
+        return self
+
+    def sweep(self, now=None):
+        now = now or datetime.utcnow()
+        if self.nudge_after:
+            cursor = self.collection.find(
+                {"updated_at": {"$lt": now - timedelta(seconds=self.nudge_after)},
+                 "nudged_at": None, "lease_until": {"$lt": now}},
+                {"state": 1, "updated_at": 1},
+            ).sort("updated_at", 1).limit(self.batch_size)
+            for doc in cursor:
+                claimed = self.collection.update_one(
+                    {"_id": doc["_id"], "updated_at": doc["updated_at"], "nudged_at": None},
+                    {"$set": {"nudged_at": now}},
+                )
+                if claimed.modified_count and self.nudge(doc["_id"], doc["state"]):
+                    self.nudged += 1
+                    NUDGED.inc()
+
+        evicted = 0
+        cursor = self.collection.find(
+            {"updated_at": {"$lt": now - timedelta(seconds=self.ttl)}, "lease_until": {"$lt": now}},
+            {"updated_at": 1},
+        ).sort("updated_at", 1).limit(self.batch_size)
+        for doc in cursor:
+            evicted += self.collection.delete_one(
+                {"_id": doc["_id"], "updated_at": doc["updated_at"], "lease_until": {"$lt": now}}
+            ).deleted_count
+        self.evicted += evicted
+        EVICTED.inc(evicted)
+        return evicted
+
+    def active(self):
+        return self.collection.estimated_document_count()
@@ -0,0 +1,198 @@
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from uuid import uuid4
+
+import requests
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError, DuplicateKeyError
+from requests.adapters import HTTPAdapter
+
+from metrics import counter, histogram, timed
+
+AFRO_BASE_URL = "https://api.afromessage.com/api"
+DUPLICATE_KEY = 11000
+
+SMS_SECONDS = histogram("sms_send_seconds", "AfroMessage send round trip")
+SMS_SENT = counter("sms_messages_total", "SMS send attempts by result", ["result"])
+
+
+class AfroMessageClient:
+    """Thin AfroMessage client that reuses one pooled session."""
+
+    def __init__(self, token, sender_id, base_url=AFRO_BASE_URL, pool_size=16, timeout=15):
+        self.sender_id = sender_id
+        self.send_url = f"{base_url.rstrip('/')}/send"
+        self.timeout = timeout
+        self.session = requests.Session()
+        self.session.headers.update({
+            "Authorization": f"Bearer {token}",
+            "Content-Type": "application/json",
+        })
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
+    def send(self, phone_number, message):
+        """Send one SMS. Returns ``(ok, detail)``."""
+        body = {
+            "callback": "YOUR_CALLBACK",
+            "from": self.sender_id,
+            "sender": "AfroMessage",
+            "to": phone_number,
+            "message": message,
+        }
+        try:
+            with timed(SMS_SECONDS):
+                result = self.session.post(self.send_url, json=body, timeout=self.timeout)
+        except requests.RequestException as e:
+            SMS_SENT.inc(result="error")
+            return False, str(e)
+        SMS_SENT.inc(result="ok" if result.status_code == 200 else "error")
+        if result.status_code != 200:
+            return False, f"http {result.status_code}: {result.text[:200]}"
+        try:
+            json_resp = result.json()
+        except ValueError:
+            return False, "invalid JSON response"
+        if json_resp.get("acknowledge") == "success":
+            return True, json_resp.get("response", {})
+        return False, json_resp.get("response", json_resp)
+
+
+class SmsOutbox:
+    """Durable SMS queue stored in the ``sms_outbox`` collection.
+
+    Each message is keyed by ``<delivery_id>:<role>``, where
+    ``delivery_id`` is the delivery document's ``_id`` (``order_id`` is
+    only unique per chat), so queueing the same notification twice is a
+    no-op. Workers claim due messages in batches, send them concurrently
+    over the shared client and write the outcome back with a single
+    ``bulk_write``. Failures are retried with exponential backoff until
+    ``max_attempts``; messages claimed by a process that died are picked
+    up again once their lease expires.
+    """
+
+    def __init__(self, collection, client, workers=8, batch_size=50, max_attempts=6,
+                 base_delay=30, lease_seconds=120, poll_interval=2.0):
+        self.collection = collection
+        self.client = client
+        self.batch_size = batch_size
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.lease_seconds = lease_seconds
+        self.poll_interval = poll_interval
+
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="sms")
+        self._stop = threading.Event()
+        self._thread = None
+
+    def ensure_indexes(self):
+        self.collection.create_index([("status", 1), ("next_attempt_at", 1)])
+        self.collection.create_index([("status", 1), ("lease_until", 1)])
+        self.collection.create_index("delivery_id")
+
+    # ---- producers --------------------------------------------------------
+
+    def _new_doc(self, delivery_id, role, phone_number, message):
+        now = datetime.utcnow()
+        return {
+            "_id": f"{delivery_id}:{role}",
+            "delivery_id": delivery_id,
+            "role": role,
+            "to": phone_number,
+            "message": message,
+            "status": "pending",
+            "attempts": 0,
+            "next_attempt_at": now,
+            "created_at": now,
+        }
+
+    def enqueue(self, delivery_id, role, phone_number, message):
+        """Queue one SMS; returns False if it was already queued."""
+        try:
+            self.collection.insert_one(self._new_doc(delivery_id, role, phone_number, message))
+            return True
+        except DuplicateKeyError:
+            return False
+
+    def enqueue_many(self, items):
+        """Queue ``(delivery_id, role, phone_number, message)`` tuples in one round trip."""
+        docs = [self._new_doc(*item) for item in items]
+        if not docs:
+            return 0
+        try:
+            return len(self.collection.insert_many(docs, ordered=False).inserted_ids)
+        except BulkWriteError as e:
+            errors = e.details.get("writeErrors", [])
+            if any(err.get("code") != DUPLICATE_KEY for err in errors):
+                raise
+            return e.details.get("nInserted", 0)
+
+    # ---- workers ----------------------------------------------------------
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._loop, name="sms-outbox", daemon=True)
+            self._thread.start()
+
+    def stop(self, timeout=30):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+        self._executor.shutdown(wait=True)
+
+    def _loop(self):
+        while not self._stop.is_set():
+            try:
+                sent = self.run_once()
+            except Exception as e:
+                logging.error("SMS outbox iteration failed: %s", e)
+                sent = 0
+            if not sent:
+                self._stop.wait(self.poll_interval)
+
+    def run_once(self):
+        """Claim one batch of due messages and send it. Returns the batch size."""
+        batch = self._claim()
+        if not batch:
+            return 0
+        results = list(self._executor.map(
+            lambda doc: self.client.send(doc["to"], doc["message"]), batch
+        ))
+
+        now = datetime.utcnow()
+        ops = []
+        for doc, (ok, detail) in zip(batch, results):
+            attempts = doc.get("attempts", 0) + 1
+            if ok:
+                update = {"status": "sent", "sent_at": now, "attempts": attempts, "response": detail}
+            elif attempts >= self.max_attempts:
+                update = {"status": "failed", "attempts": attempts, "last_error": str(detail)}
+                logging.error("SMS %s failed permanently: %s", doc["_id"], detail)
+            else:
+                delay = self.base_delay * 2 ** (attempts - 1)
+                update = {"status": "pending", "attempts": attempts, "last_error": str(detail),
+                          "next_attempt_at": now + timedelta(seconds=delay)}
+            ops.append(UpdateOne({"_id": doc["_id"], "claim": doc["claim"]},
+                                 {"$set": update, "$unset": {"claim": "", "lease_until": ""}}))
+        self.collection.bulk_write(ops, ordered=False)
+        return len(batch)
+
+    def _claim(self):
+        now = datetime.utcnow()
+        due = {"$or": [
+            {"status": "pending", "next_attempt_at": {"$lte": now}},
+            {"status": "sending", "lease_until": {"$lt": now}},
+        ]}
+        ids = [doc["_id"] for doc in self.collection.find(due, {"_id": 1}).limit(self.batch_size)]
+        if not ids:
+            return []
+        claim = uuid4().hex
+        self.collection.update_many(
+            {"$and": [{"_id": {"$in": ids}}, due]},
+            {"$set": {"status": "sending", "claim": claim,
+                      "lease_until": now + timedelta(seconds=self.lease_seconds)}},
+        )
+        return list(self.collection.find({"claim": claim}))
@@ -1,75 +1,266 @@
 import requests
 import time
 import json
+import hashlib
 import os
+import signal
+import threading
 from datetime import datetime
-from geopy.geocoders import Nominatim   
 from dotenv import load_dotenv
 from pymongo import MongoClient
 import logging
-from uuid import uuid4
-
-logging.basicConfig(
-    level=logging.INFO,
-    format="%(asctime)s - %(levelname)s - %(message)s",
-    handlers=[
-        logging.FileHandler("bot_activity.log"),  
-        logging.StreamHandler()                  
-    ]
-)
+from uuid import uuid5, NAMESPACE_URL
+from state_store import StateStore
+from async_runtime import AsyncEngine, GetUpdatesError, update_chat_id, updates_result, GET_UPDATES_SECONDS
+from offset_commit import OffsetCommitter
+from mongo_writer import BatchWriter, MONGO_WRITE_SECONDS
+from indexes import ensure_indexes, MY_DELIVERIES_FIELDS
+from telegram_outbox import OutboundDispatcher, GLOBAL_RATE
+from geocache import GeocodeCache, PlaceCache
+from geocode_worker import GeocodeWorker
+from sms_dispatch import AfroMessageClient, SmsOutbox
+from webhook import WebhookServer, set_webhook, delete_webhook
+from cluster import Cluster, STATE_COLLECTION
+from conversation import Form, Router, PAYMENT_FIELD, is_ethiopian_phone, is_positive_int
+from session_gc import SessionSweeper, MongoSessionSweeper
+from metrics import counter, gauge, histogram, timed, serve
+from log_config import setup_logging
+from pricing import Quoter, price_table
 
 
 load_dotenv()
-client = MongoClient(os.getenv("MONGO_URI"))
-db = client["tolo_delivery"]
-deliveries_collection = db["deliveries"]
-feedback_collection = db["feedback"]
-free_delivery_collection = db["free_delivery"]
+
+MONGO_URI = os.getenv("MONGO_URI")
+MONGO_DB = os.getenv("MONGO_DB", "tolo_delivery")
 BOT_TOKEN = os.getenv("BOT_TOKEN")
 username = os.getenv("AT_USERNAME")
 api_key = os.getenv("AT_API_KEY")
 
 AFRO_TOKEN = os.getenv("AFRO_TOKEN")
 AFRO_SENDER_ID = os.getenv("AFRO_SENDER_ID")
+AFRO_BASE_URL = os.getenv("AFRO_BASE_URL", "https://api.afromessage.com/api")
 
-API_URL = f'https://api.telegram.org/bot{BOT_TOKEN}'
-JSON_FILE = 'messages.json'
-STATE_FILE = 'user_states.json'
+# Overridable so the bot can be pointed at the stand-ins in stub_servers.py
+TELEGRAM_API_BASE = os.getenv("TELEGRAM_API_BASE", "https://api.telegram.org")
+NOMINATIM_URL = os.getenv("NOMINATIM_URL", "https://nominatim.openstreetmap.org")
 
+API_URL = f'{TELEGRAM_API_BASE}/bot{BOT_TOKEN}'
+STATE_FILE = 'user_states.json'
 
+# "polling" uses getUpdates; "webhook" serves Telegram's webhook on PORT
+BOT_MODE = os.getenv("BOT_MODE", "polling")
+WEBHOOK_URL = os.getenv("WEBHOOK_URL")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET")
+WEBHOOK_WORKERS = int(os.getenv("WEBHOOK_WORKERS", "8"))
+PORT = int(os.getenv("PORT", "8080"))
+
+# Seconds between offset commits while updates keep arriving
+OFFSET_COMMIT_INTERVAL = float(os.getenv("OFFSET_COMMIT_INTERVAL", "5"))
+
+# "sync" processes updates one by one; "async" runs chats concurrently;
+# "cluster" spreads chats over BOT_WORKERS processes with state in Mongo
+BOT_RUNTIME = os.getenv("BOT_RUNTIME", "sync")
+BOT_CONCURRENCY = int(os.getenv("BOT_CONCURRENCY", "16"))
+BOT_WORKERS = int(os.getenv("BOT_WORKERS", "4"))
+
+# Unfinished sessions are dropped after SESSION_TTL idle seconds; with
+# SESSION_NUDGE_AFTER set, the user is asked to resume their draft first
+SESSION_TTL = float(os.getenv("SESSION_TTL", str(24 * 3600)))
+SESSION_NUDGE_AFTER = float(os.getenv("SESSION_NUDGE_AFTER", "0"))
+SESSION_SWEEP_INTERVAL = float(os.getenv("SESSION_SWEEP_INTERVAL", "60"))
+
+# /metrics is served on METRICS_PORT when set, and on the webhook app
+METRICS_PORT = int(os.getenv("METRICS_PORT") or 0)
+
+UPDATES = counter("bot_updates_total", "Updates received", ["kind"])
+REPLAYED_UPDATES = counter("bot_updates_replayed_total", "Updates skipped as already processed")
+UPDATE_SECONDS = histogram("bot_update_seconds", "Time to handle one update")
+FORM_COMPLETIONS = counter("bot_form_completions_total", "Delivery forms completed")
+VALIDATION_FAILURES = counter("bot_validation_failures_total", "Rejected form answers", ["field"])
+GEOCODE_SECONDS = histogram("geocode_lookup_seconds", "Address lookup, cache hits included")
+
+
+
+class lazy:
+    """``cached_property`` that builds the value only once when threads race for it."""
+
+    _lock = threading.RLock()
+
+    def __init__(self, build):
+        self.build = build
+        self.name = build.__name__
+        self.__doc__ = build.__doc__
+
+    def __get__(self, instance, owner=None):
+        if instance is None:
+            return self
+        with self._lock:
+            if self.name not in instance.__dict__:
+                instance.__dict__[self.name] = self.build(instance)
+        return instance.__dict__[self.name]
+
+
+class App:
+    """The bot's clients and background workers, each built on first use.
+
+    Importing this module only reads settings: Mongo isn't contacted, no
+    thread is started and nothing is written to disk until a handler or an
+    entry point asks for the object. ``close`` stops whatever was built.
+    """
+
+    def __init__(self):
+        self.log_listener = None
+        # Processes sending and geocoding for this bot; the cluster runtime
+        # raises it so Telegram's and Nominatim's limits are split between them
+        self.processes = 1
+
+    def start_logging(self):
+        # Records go through a queue to a background thread that formats them;
+        # LOG_SAMPLE_EVERY keeps one in N of the per-message INFO lines
+        if self.log_listener is None:
+            self.log_listener = setup_logging(
+                level=os.getenv("LOG_LEVEL", "INFO"),
+                path=os.getenv("LOG_FILE", "bot_activity.log"),
+                fmt=os.getenv("LOG_FORMAT", "json"),
+                max_bytes=int(os.getenv("LOG_MAX_BYTES", str(10 * 1024 * 1024))),
+                backups=int(os.getenv("LOG_BACKUPS", "5")),
+                rotate_when=os.getenv("LOG_ROTATE_WHEN") or None,
+                sample_every=int(os.getenv("LOG_SAMPLE_EVERY", "10")),
+            )
+        return self.log_listener
+
+    @lazy
+    def client(self):
+        return MongoClient(MONGO_URI)
+
+    @lazy
+    def db(self):
+        return self.client[MONGO_DB]
+
+    @property
+    def deliveries(self):
+        return self.db["deliveries"]
+
+    @property
+    def feedback(self):
+        return self.db["feedback"]
+
+    @property
+    def chat_stats(self):
+        return self.db["chat_stats"]
+
+    @property
+    def offsets(self):
+        return self.db["offset_tracking"]
+
+    @lazy
+    def outbox(self):
+        return OutboundDispatcher(
+            API_URL,
+            workers=int(os.getenv("TELEGRAM_SEND_WORKERS", "8")),
+            coalesce=os.getenv("TELEGRAM_COALESCE", "0") == "1",
+            global_rate=GLOBAL_RATE / self.processes,
+        )
+
+    @lazy
+    def writer(self):
+        # bot_events and feedback are written behind the reply; orders are not
+        return BatchWriter(
+            max_batch=int(os.getenv("MONGO_BATCH_SIZE", "500")),
+            flush_interval=float(os.getenv("MONGO_FLUSH_INTERVAL", "1")),
+        )
+
+    @lazy
+    def geocode_cache(self):
+        return GeocodeCache(
+            reverse_geocode,
+            collection=self.db["geocode_cache"] if os.getenv("GEOCODE_CACHE_MONGO", "1") == "1" else None,
+            precision=int(os.getenv("GEOCODE_PRECISION", "7")),
+            max_entries=int(os.getenv("GEOCODE_CACHE_SIZE", "10000")),
+            min_interval=float(os.getenv("GEOCODE_MIN_INTERVAL", "1")) * self.processes,
+        )
+
+    @lazy
+    def place_cache(self):
+        return PlaceCache(
+            forward_geocode,
+            collection=self.db["place_cache"] if os.getenv("GEOCODE_CACHE_MONGO", "1") == "1" else None,
+            max_entries=int(os.getenv("GEOCODE_CACHE_SIZE", "10000")),
+            # Both kinds of lookup count against the same Nominatim budget
+            rate_limiter=self.geocode_cache.rate_limiter,
+        )
+
+    @lazy
+    def quoter(self):
+        return Quoter(self.place_cache.lookup, workers=int(os.getenv("QUOTE_WORKERS", "2")))
+
+    @lazy
+    def geocode_worker(self):
+        return GeocodeWorker(
+            get_address_from_coordinates,
+            self.deliveries,
+            workers=int(os.getenv("GEOCODE_WORKERS", "4")),
+        )
+
+    @lazy
+    def afro_client(self):
+        return AfroMessageClient(AFRO_TOKEN, AFRO_SENDER_ID, base_url=AFRO_BASE_URL)
+
+    @lazy
+    def sms_outbox(self):
+        return SmsOutbox(
+            self.db["sms_outbox"],
+            self.afro_client,
+            workers=int(os.getenv("SMS_WORKERS", "8")),
+            batch_size=int(os.getenv("SMS_BATCH_SIZE", "50")),
+        )
+
+    def close(self):
+        """Stop the workers that were started, draining their queues first."""
+        built = vars(self)
+        if "geocode_worker" in built:
+            self.geocode_worker.shutdown()
+        if "quoter" in built:
+            self.quoter.shutdown()
+        if "sms_outbox" in built:
+            self.sms_outbox.stop()
+        if "writer" in built:
+            self.writer.close()
+        if "outbox" in built:
+            self.outbox.close()
+        if self.log_listener is not None:
+            self.log_listener.stop()
+            self.log_listener = None
+
+
+app = App()
+
+
+# Telegram picks a random next update_id once the bot has had no updates
+# for a week, so update_ids are only comparable within that window
+UPDATE_ID_EPOCH = 7 * 24 * 3600
+# ...and it drops undelivered updates after a day, so nothing older is replayed
+REPLAY_WINDOW = 24 * 3600
 
-offset_collection = db["offset_tracking"]
 
 def load_offset():
-    record = offset_collection.find_one({"_id": "telegram_offset"})
-    if record:
-        return record.get("last_update_id")
-    return None
+    record = app.offsets.find_one({"_id": "telegram_offset"})
+    if not record:
+        return None
+    committed_at = record.get("committed_at")
+    if committed_at and (datetime.now() - committed_at).total_seconds() > UPDATE_ID_EPOCH:
+        logging.info("Stored offset is from a previous update_id epoch; starting from the oldest pending update")
+        return None
+    return record.get("last_update_id")
 
 def save_offset(offset):
-    offset_collection.update_one(
+    app.offsets.update_one(
         {"_id": "telegram_offset"},
-        {"$set": {"last_update_id": offset}},
+        {"$set": {"last_update_id": offset, "committed_at": datetime.now()}},
         upsert=True
     )
 
 
-url = f"https://api.telegram.org/bot{BOT_TOKEN}/setMyCommands"
-
-
-geolocator = Nominatim(user_agent="ssas-bot")
-
-
-# Create files if not exist
-
-
-for file in [JSON_FILE, STATE_FILE]:
-    if not os.path.exists(file):
-        with open(file, 'w') as f:
-            json.dump({}, f) if file == STATE_FILE else json.dump([], f)
-
-
-
 Commands = [
     {"command": "/start", "description": "Start the bot / ቦትን ጀምር"},
     {"command": "/about", "description": "About this bot / ስለምን ይህ ቦት"},
@@ -96,15 +287,13 @@ Data_Message = [
 
 
 
-def get_updates(offset=None):
-    return requests.get(f'{API_URL}/getUpdates', params={'timeout': 100, 'offset': offset}, timeout=110).json()
+@timed(GET_UPDATES_SECONDS)
+def get_updates(offset=None, timeout=100):
+    return requests.get(f'{API_URL}/getUpdates', params={'timeout': timeout, 'offset': offset}, timeout=timeout + 10).json()
 
 
 def send_message(chat_id, text, reply_markup=None):
-    payload = {'chat_id': chat_id, 'text': text}
-    if reply_markup:
-        payload["reply_markup"] = json.dumps(reply_markup)
-    requests.post(f'{API_URL}/sendMessage', data=payload)
+    app.outbox.send(chat_id, text, reply_markup)
 
 
 def request_location(chat_id):
@@ -127,25 +316,65 @@ def request_payment_option(chat_id):
     send_message(chat_id, "Who will pay for the delivery? / ከፋዩ ማን ነው?", reply_markup=keyboard)
 
 
-def get_address_from_coordinates(lat, lon):
+def reverse_geocode(lat, lon):
     try:
-        url = "https://nominatim.openstreetmap.org/reverse"
+        url = f"{NOMINATIM_URL}/reverse"
         params = {'lat': lat, 'lon': lon, 'format': 'json', 'addressdetails': 1}
         headers = {'User-Agent': 'ToloDeliveryBot/1.0'}
-        response = requests.get(url, params=params, headers=headers)
+        response = requests.get(url, params=params, headers=headers, timeout=10)
         data = response.json()
+        if "error" in data or not data.get("display_name"):
+            # e.g. {"error": "Unable to geocode"}; an empty result isn't cached
+            logging.warning("Geocoding found nothing for %s,%s: %s", lat, lon, data.get("error"))
+            return {}
         address = data.get("address", {})
         return {
-            "full_address": data.get("display_name", "Unknown location"),
+            "full_address": data["display_name"],
             "city": address.get("city", address.get("town", "")),
             "postcode": address.get("postcode", ""),
             "country": address.get("country", "")
         }
     except Exception as e:
-        print("Geocoding failed:", e)
+        logging.warning("Geocoding failed for %s,%s: %s", lat, lon, e)
         return {}
 
 
+@timed(GEOCODE_SECONDS)
+def get_address_from_coordinates(lat, lon):
+    return app.geocode_cache.lookup(lat, lon)
+
+
+# Searches prefer (but aren't limited to) Addis Ababa
+ADDIS_ABABA_VIEWBOX = "38.63,9.10,38.91,8.83"
+
+
+def forward_geocode(place):
+    try:
+        params = {'q': place, 'format': 'json', 'limit': 1, 'countrycodes': 'et',
+                  'viewbox': ADDIS_ABABA_VIEWBOX, 'bounded': 0}
+        headers = {'User-Agent': 'ToloDeliveryBot/1.0'}
+        response = requests.get(f"{NOMINATIM_URL}/search", params=params, headers=headers, timeout=10)
+        results = response.json()
+        if not results:
+            return {}
+        return {"lat": float(results[0]["lat"]), "lon": float(results[0]["lon"])}
+    except Exception as e:
+        logging.warning("Forward geocoding failed for %r: %s", place, e)
+        return {}
+
+
+def send_quote(chat_id, order_id, quote):
+    """Store the quote on the order and tell the customer."""
+    if not quote:
+        logging.info("No quote for order %s: pickup or drop-off not found", order_id)
+        return
+    app.deliveries.update_one({"chat_id": chat_id, "order_id": order_id}, {"$set": {"quote": quote}})
+    if quote["price"] is None:
+        send_message(chat_id, f"📏 Distance: about {quote['distance_km']:.1f} km. That's beyond our price list, we will call you with a price.\nርቀቱ ከዋጋ ዝርዝራችን በላይ ነው፤ ዋጋውን በስልክ እናሳውቆታለን።")
+    else:
+        send_message(chat_id, f"💰 Estimated price: {quote['price']} birr ({quote['distance_km']:.1f} km)\nግምታዊ ዋጋ: {quote['price']} ብር")
+
+
 def remove_keyboard(chat_id):
     keyboard = {"remove_keyboard": True}
     send_message(chat_id, "✅Confirmed ", reply_markup=keyboard)  
@@ -153,364 +382,609 @@ def remove_keyboard(chat_id):
 
 
 def save_delivery(data):
-   
+    """Store a finished order; returns False if it couldn't be written."""
+    # Written synchronously: the user is only told the order was accepted once it is stored
     try:
-        
-        deliveries_collection.insert_one(data)
-        print("✅ Delivery saved to MongoDB.")
-        logging.info(f"Delivery saved: {data}")
+        # Upsert on the chat's order_id so a replayed update can't create a
+        # second copy; order ids are short, so they are only unique per chat
+        with timed(MONGO_WRITE_SECONDS, collection=app.deliveries.name):
+            result = app.deliveries.update_one(
+                {"chat_id": data["chat_id"], "order_id": data["order_id"]}, {"$setOnInsert": data}, upsert=True
+            )
+        if result.upserted_id is not None:
+            # Per-chat order count, kept up to date instead of counted on demand
+            app.writer.update(app.chat_stats, {"_id": data["chat_id"]},
+                          {"$inc": {"deliveries": 1}, "$set": {"last_order_at": data["created_at"]}},
+                          upsert=True)
+        logging.info("✅ Delivery saved", extra={"order_id": data["order_id"], "chat_id": data["chat_id"]})
+        return True
     except Exception as e:
-        print("❌ Failed to save to MongoDB:", e)
-        logging.error(f"Error saving delivery: {e}")    
+        logging.error("❌ Error saving delivery %s: %s", data.get("order_id"), e)
+        return False
 
 
 def send_sms(phone_number, message):
-    session = requests.Session()
-    # base url
-    base_url = 'https://api.afromessage.com/api/send'
-    # api token
-    token = AFRO_TOKEN
-        # header
-    headers = {'Authorization': 'Bearer ' + token,
-            'Content-Type': 'application/json'}
-        # request body
-    body = {'callback': 'YOUR_CALLBACK',
-                'from':AFRO_SENDER_ID,
-                'sender':'AfroMessage',
-                'to': phone_number,
-                'message': message}
-        # make request
-    result = session.post(base_url, json=body, headers=headers)
-        # check result
-    if result.status_code == 200:
-        json_resp = result.json()
-        print("🔍 Full JSON Response:", json_resp)  # ← ADD THIS LINE
-
-        if json_resp.get('acknowledge') == 'success':
-            print('✅ SMS sent successfully!')
+    ok, detail = app.afro_client.send(phone_number, message)
+    if ok:
+        logging.info("✅ SMS sent to %s", phone_number)
+    else:
+        logging.warning("❌ SMS to %s failed: %s", phone_number, detail)
+    return ok
+
+
+def save_feedback(data):
+    try:
+        doc = dict(data)
+        app.writer.insert_once(app.feedback, doc.pop("_id"), doc)
+        logging.info("✅ Feedback queued", extra={"chat_id": data["chat_id"]})
+    except Exception as e:
+        logging.error("❌ Failed to save feedback: %s", e)
+
+
+MY_DELIVERIES_PAGE_SIZE = 5
+
+
+def send_my_deliveries(chat_id, before=None):
+    query = {"chat_id": chat_id}
+    if before:
+        query["created_at"] = {"$lt": before}
+    projection = {"_id": 0}
+    projection.update({field: 1 for field in MY_DELIVERIES_FIELDS})
+    orders = list(
+        app.deliveries.find(query, projection)
+        .sort([("chat_id", 1), ("created_at", -1)])
+        .hint("chat_recent_orders")
+        .limit(MY_DELIVERIES_PAGE_SIZE)
+    )
+
+    if not orders:
+        if before:
+            send_message(chat_id, "No older deliveries. / ተጨማሪ ትእዛዝ የለም።")
         else:
-            print('❌ API responded with error:', json_resp)
+            send_message(chat_id, "You have no deliveries yet. Type /start to create one. / እስካሁን ምንም ትእዛዝ የለዎትም።")
+        return
+
+    stats = app.chat_stats.find_one({"_id": chat_id}) or {}
+    lines = [f"📦 Your recent deliveries / ያስተላለፉት ትእዛዞች ({stats.get('deliveries', len(orders))} total)"]
+    for order in orders:
+        created_at = order.get("created_at")
+        when = created_at.strftime("%Y-%m-%d %H:%M") if created_at else "—"
+        lines.append(f"\n#{order.get('order_id', '—')} · {when}\n{order.get('pickup', '?')} → {order.get('dropoff', '?')}")
+
+    reply_markup = None
+    last_created_at = orders[-1].get("created_at")
+    if len(orders) == MY_DELIVERIES_PAGE_SIZE and last_created_at:
+        reply_markup = {
+            "inline_keyboard": [
+                [{"text": "⬅️ Older", "callback_data": f"mydeliveries:{last_created_at.isoformat()}"}]
+            ]
+        }
+    send_message(chat_id, "\n".join(lines), reply_markup=reply_markup)
+
+
+def log_event(event, chat_id, key, **fields):
+    # Keyed by the message (see update_key) so replaying an update doesn't count it twice
+    app.writer.insert_once(app.db.bot_events, f"{event}:{key}", dict(fields, **{
+        "event": event,
+        "chat_id": chat_id,
+        "timestamp": datetime.now()
+    }))
+
+
+def handle_update(result, states):
+    """Process an update once, even if it is delivered again after a restart."""
+    chat_id = update_chat_id(result)
+    # Keeps the session sweeper off this chat until the update is done
+    with sessions.chat_lock(chat_id):
+        _handle_update(result, states, chat_id)
+
+
+def _handle_update(result, states, chat_id):
+    update_id = result["update_id"]
+    UPDATES.inc(kind="callback" if "callback_query" in result else "message")
+    state = states.get(chat_id)
+    if (state and state.get("last_update_id", -1) >= update_id
+            and time.time() - state.get("last_active", 0) < REPLAY_WINDOW):
+        logging.info("Skipping already processed update %s for chat_id %s", update_id, chat_id)
+        REPLAYED_UPDATES.inc()
+        return
+
+    with timed(UPDATE_SECONDS):
+        _process_update(result, states)
+
+    state = states.get(chat_id)
+    if state is not None:
+        state["last_update_id"] = update_id
+        sessions.touch(chat_id, state)
+        states.commit(chat_id)
+
+
+def nudge_session(chat_id, state):
+    """Ask a user who left an order half-way whether to pick it up again."""
+    if Router.mode(state) != "form":
+        return False
+    reply_markup = {
+        "inline_keyboard": [
+            [{"text": "▶️ Resume my draft", "callback_data": "keep_going"}],
+            [{"text": "🔄 Start a new one", "callback_data": "start_over"}]
+        ]
+    }
+    send_message(chat_id, "⏳ You have an unfinished delivery order. Do you want to resume your draft?\nያልተጠናቀቀ ትእዛዝ አለዎት። መቀጠል ይፈልጋሉ?", reply_markup=reply_markup)
+    return True
 
+
+sessions = SessionSweeper(SESSION_TTL, nudge=nudge_session, nudge_after=SESSION_NUDGE_AFTER,
+                          interval=SESSION_SWEEP_INTERVAL)
+
+gauge("bot_active_sessions", "Conversations with stored state", fn=sessions.active)
+gauge("telegram_outbox_queue_depth", "Messages waiting to be sent", fn=lambda: app.outbox.queue_depth())
+gauge("mongo_writer_pending", "Buffered Mongo writes", fn=lambda: app.writer.pending())
+
+
+def _process_update(result, states):
+    """Process a single Telegram update against the per-chat conversation state."""
+    router.dispatch(result, states)
+
+
+form = Form(Data_Message, validators={
+    "sender_phone": (is_ethiopian_phone, "⚠️ Invalid Ethiopian phone number. Example: 0912345678 or +251912345678 / እባክዎ ትክክል የኢትዮጵያ ስልክ ቁጥር ያስገቡ።"),
+    "receiver_phone": (is_ethiopian_phone, "⚠️ Invalid Ethiopian phone number. Example: 0912345678 or +251912345678 / እባክዎ ትክክል የኢትዮጵያ ስልክ ቁጥር ያስገቡ።"),
+    "Quantity": (is_positive_int, "⚠️ Please enter a valid quantity (positive number). / እባክዎ ትክክል ቁጥር ያስገቡ።"),
+})
+router = Router(Commands)
+
+
+def ask(chat_id, step):
+    """Send the prompt for a form step."""
+    kind = form[step].kind
+    if kind == "location":
+        request_location(chat_id)
+    elif kind == "payment":
+        request_payment_option(chat_id)
     else:
-            # anything other than 200 goes here.
-        print ('http error ... code: %d , msg: %s ' % (result.status_code, result.content))
+        send_message(chat_id, form[step].label)
 
 
-def save_feedback(data):
+def full_name(message):
+    user = message["from"]
+    return f"{user.get('first_name', '')} {user.get('last_name', '')}".strip()
+
+
+# ---- callback buttons -----------------------------------------------------
+
+@router.callback("start_over")
+def on_start_over(ctx):
+    if Router.mode(ctx.state) == "form":
+        log_event("cancel", ctx.chat_id, ctx.key, step=ctx.state["step"])
+    ctx.states[ctx.chat_id] = {"step": 0, "data": {}}
+    send_message(ctx.chat_id, "🔄 Starting over. Let's begin again.")
+    send_message(ctx.chat_id, form[0].label)
+
+
+@router.callback("keep_going")
+def on_keep_going(ctx):
+    state = ctx.state
+    if Router.mode(state) != "form":
+        send_start_hint(ctx)
+        return
+    send_message(ctx.chat_id, f"📍 Continuing your current session.\n\n{form[state['step']].label}")
+
+
+@router.callback("new_order")
+def on_new_order(ctx):
+    last_state = ctx.state
+    # A known payer carries over to the next order
+    last_payment = last_state.get("data", {}).get(PAYMENT_FIELD) if last_state else None
+    state = {"step": form.first_step(last_payment), "data": {}}
+    if last_payment:
+        state["data"][PAYMENT_FIELD] = last_payment
+    ctx.states[ctx.chat_id] = state
+    ctx.states.commit(ctx.chat_id)
+
+    send_message(ctx.chat_id, "📦 Great! Let's begin your new order.")
+    ask(ctx.chat_id, state["step"])
+
+
+@router.callback("mydeliveries:")
+def on_older_deliveries(ctx):
+    send_my_deliveries(ctx.chat_id, before=datetime.fromisoformat(ctx.data.split(":", 1)[1]))
+
+
+@router.callback("no_more_orders")
+def on_no_more_orders(ctx):
+    send_message(ctx.chat_id, "👍 Thank you for using Tolo Delivery!\nYou can type /start anytime to create a new delivery.")
+
+
+# ---- commands -------------------------------------------------------------
+
+@router.command("/mydeliveries", in_feedback=True)
+def cmd_my_deliveries(ctx):
+    send_my_deliveries(ctx.chat_id)
+
+
+@router.command("/feedback", blocked_in_form=True, in_feedback=True)
+def cmd_feedback(ctx):
+    ctx.states[ctx.chat_id] = {"step": "feedback"}  # special mode
+    send_message(ctx.chat_id, "📝 Please type your feedback below. / እባክዎ እቅድዎን እዚህ ያስገቡ:")
+
+
+@router.command("/about", blocked_in_form=True)
+def cmd_about(ctx):
+    send_message(ctx.chat_id,
+        "📦 *About Tolo Delivery*\n\n"
+        "Tolo Delivery is a fast and reliable delivery service helping you send packages across Addis Ababa.\n"
+        "We are committed to making your delivery experience quick and seamless.\n\n"
+        "ቶሎ ዴሊቨሪ በአዲስ አበባ ውስጥ ጥቅሎችን ለመላክ የሚረዳ ፈጣን እና አስተማማኝ የአቅርቦት አገልግሎት ነው. \n"
+        "የአቅርቦት ተሞክሮዎ ፈጣን እና እንከን የለሽ ለማድረግ ተግተን እንሰራለን"
+    )
+    send_start_hint(ctx)
+
+
+@router.command("/contact", blocked_in_form=True)
+def cmd_contact(ctx):
+    send_message(ctx.chat_id,
+        "📞 *Contact Us*\n\n"
+        "Phone: +251921296933\n"
+        "     : +251900041277\n"
+        "Email: info@tolo9558.com\n"
+        "ለአገልግሎታችን ከሆነ ጥያቄ ወይም መረጃ ለማግኘት:\n"
+        "ስልክ: +251921296933\n"
+        "     +251900041277\n"
+        "ኢሜይል: info@tolo9558.com"
+    )
+    send_start_hint(ctx)
+
+
+@router.command("/price", blocked_in_form=True)
+def cmd_price(ctx):
+    send_message(ctx.chat_id,
+        "💰 *Delivery Price*: \n\n"
+        + price_table()
+        + "የዋጋ ዝርዝር: \n"
+        + price_table("ኪ.ሜ", "ብር")
+    )
+    send_start_hint(ctx)
+
+
+@router.command("/start")
+def cmd_start(ctx):
+    chat_id = ctx.chat_id
+    log_event("bot_start", chat_id, ctx.key)
+    if chat_id in ctx.states:
+        reply_markup = {
+            "inline_keyboard": [
+                [{"text": "✅ Yes, start over", "callback_data": "start_over"}],
+                [{"text": "❌ No, continue current", "callback_data": "keep_going"}]
+            ]
+        }
+        send_message(chat_id, "⚠️ You already have an active delivery. Do you want to cancel it and start over?", reply_markup=reply_markup)
+    else:
+        log_event("fallback", chat_id, ctx.key)
+        ctx.states[chat_id] = {"step": 0, "data": {}}
+        send_message(chat_id, "👋 Selam! Welcome to Tolo Delivery.\nሰላም! ወደ ቶሎ ዴሊቨሪ እንኳን በደህና መጡ።\nLet's begin / እንጀምር።")
+        send_message(chat_id, form[0].label)
+
+
+@router.command("/cancel")
+def cmd_cancel(ctx):
+    if ctx.chat_id in ctx.states:
+        log_event("cancel", ctx.chat_id, ctx.key, step=ctx.state.get("step"))
+        del ctx.states[ctx.chat_id]
+        send_message(ctx.chat_id, "❌ Operation cancelled. / እቅዱ ተሰርዟል።")
+    else:
+        send_message(ctx.chat_id, "No operation to cancel. / ምንም እቅድ የለም።")
+
+
+router.check()
+
+
+# ---- free text and locations ----------------------------------------------
+
+def on_blocked(ctx):
+    send_message(ctx.chat_id, "⚠️ You have an active delivery session. Please finish or cancel it before using this command.")
+    logging.info("Blocked %s command for active session user %s", ctx.text, ctx.chat_id)
+
+
+def send_start_hint(ctx):
+    send_message(ctx.chat_id, "Type /start to begin. / እባክዎ /start ይጻፉ ለመጀመር።")
+    logging.info("Prompted chat_id=%s to use /start", ctx.chat_id, extra={"sampled": True})
+
+
+def on_feedback(ctx):
+    chat_id = ctx.chat_id
+    feedback_data = {
+        "_id": ctx.key,
+        "user_name": full_name(ctx.message),
+        "chat_id": chat_id,
+        "feedback": ctx.text,
+        "timestamp": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+        "created_at": datetime.now()
+    }
+    save_feedback(feedback_data)
+    send_message(chat_id, "✅ Thank you for your feedback! / እናመሰግናለን ለእቅድዎ!")
+    del ctx.states[chat_id]
+
+
+def on_location(ctx):
+    chat_id, states = ctx.chat_id, ctx.states
+    step = states[chat_id]["step"]
+    if form[step].kind != "location":
+        # Shared at some other step; ask for what that step needs instead
+        ask(chat_id, step)
+        return
+    lat = ctx.message["location"]["latitude"]
+    lon = ctx.message["location"]["longitude"]
+    states[chat_id]["data"].update({"latitude": lat, "longitude": lon})
+    log_event("step", chat_id, ctx.key, step=step)
+    states[chat_id]["step"] += 1
+    states.commit(chat_id)
+    # The address fields are filled in by the background geocoder
+    app.geocode_worker.submit(states, chat_id, lat, lon)
+    logging.info("Location received for chat_id %s", chat_id, extra={"sampled": True})
+    request_payment_option(chat_id)
+
+
+def on_form_input(ctx):
+    chat_id, states, text = ctx.chat_id, ctx.states, ctx.text
+    state = states[chat_id]
+    step = state["step"]
+    field = form[step].field
+
+    error = form.validate(field, text)
+    if error:
+        send_message(chat_id, error)
+        VALIDATION_FAILURES.inc(field=field)
+        logging.warning("Invalid %s input from chat_id %s: %s", field, chat_id, text)
+        return
+
+    if field == PAYMENT_FIELD and PAYMENT_FIELD in state["data"]:
+        # The payer is already known from the previous order
+        log_event("step", chat_id, ctx.key, step=step)
+        state["step"] = form.skip_from(step, state["data"][PAYMENT_FIELD])
+        states.commit(chat_id)
+        ask(chat_id, state["step"])
+        return
+
+    state["data"][field] = text
+    log_event("step", chat_id, ctx.key, step=step)
+    logging.info("Step %s (%s) completed for chat_id %s", step, field, chat_id, extra={"sampled": True})
+
+    if step == 0:
+        state["data"]["user_name"] = full_name(ctx.message)
+
+    if step < form.last:
+        state["step"] += 1
+        states.commit(chat_id)
+        ask(chat_id, state["step"])
+    else:
+        finish_order(ctx, state)
+
+
+def finish_order(ctx, state):
+    chat_id = ctx.chat_id
+    state["data"]["timestamp"] = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    state["data"]["source"] = "bot"
+    state["data"]["chat_id"] = chat_id
+
+    # Derived from the update so a replay reuses the same order_id
+    order_id = uuid5(NAMESPACE_URL, ctx.key).hex[:8]
+    state["data"]["order_id"] = order_id
+    # Make sure payment_from_sender_or_receiver is saved in final delivery data
+    state["data"][PAYMENT_FIELD] = state["data"].get(PAYMENT_FIELD)
+    # created_at is a real datetime for sorting and range queries; it
+    # stays out of the state dict, which has to remain JSON
+    if not save_delivery(dict(state["data"], created_at=datetime.now())):
+        # Keep the draft on its last step so resending the answer retries the save
+        state["data"].pop("order_id", None)
+        ctx.states.commit(chat_id)
+        send_message(chat_id, "⚠️ We couldn't save your order. Please send your last answer again.\nትዕዛዝዎን ማስቀመጥ አልቻልንም። እባክዎ የመጨረሻውን መልስ እንደገና ይላኩ።")
+        ask(chat_id, state["step"])
+        return
+    FORM_COMPLETIONS.inc()
+    del ctx.states[chat_id]
+    reply_markup = {
+        "inline_keyboard": [
+            [{"text": "➕ New Order", "callback_data": "new_order"}],
+            [{"text": "❌ Done", "callback_data": "no_more_orders"}]
+        ]
+    }
+
+    send_message(chat_id, "✅ Your order has been accepted! We Will Notify via sms When Driver Is Assigned Thank you for using Tolo Delivery..\nWould you like to place another order? \n ትዕዛዝዎ ተቀባይነት አግኝቷል! ሾፌሩ ሲመደብ በSMS አማካኝነት እናሳውቆታለን። ቶሎ ዴሊቨሪ በመጠቀምዎ እናመሰግናለን\n ሌላ ትእዛዝ መጨመር ይፍልጋሉ?", reply_markup=reply_markup)
+    app.quoter.quote_later(state["data"]["pickup"], state["data"]["dropoff"],
+                       lambda quote: send_quote(chat_id, order_id, quote))
+
+
+router.on_blocked = on_blocked
+router.on_idle = send_start_hint
+router.on_feedback = on_feedback
+router.on_location = on_location
+router.on_form_input = on_form_input
+
+
+def use_webhook():
+    """Register the webhook if BOT_MODE asks for it, otherwise make sure polling works."""
+    if BOT_MODE == "webhook":
+        if WEBHOOK_URL and WEBHOOK_SECRET and set_webhook(API_URL, WEBHOOK_URL.rstrip("/") + "/webhook", WEBHOOK_SECRET):
+            logging.info("Serving webhook on port %s", PORT)
+            return True
+        logging.warning("Webhook setup failed, falling back to long-polling")
+
     try:
-        feedback_collection.insert_one(data)
-        print("✅ Feedback saved to MongoDB.")
-        logging.info(f"Feedback saved: {data}")
+        delete_webhook(API_URL)
     except Exception as e:
-        print("❌ Failed to save feedback:", e)
-        error_message = f"Error saving feedback: {e}"
+        logging.warning("deleteWebhook failed: %s", e)
+    return False
+
+
+def run_cluster(committer):
+    # This process only owns ingress and the offset; workers run cluster.worker_main
+    logging.info("Using cluster runtime with %s worker processes", BOT_WORKERS)
+    cluster = Cluster(BOT_WORKERS, app.db[STATE_COLLECTION], committer)
+    cluster.start()
+    # Workers only stamp activity; expiry runs here, against the shared collection
+    sweeper = MongoSessionSweeper(app.db[STATE_COLLECTION], SESSION_TTL, nudge=nudge_session,
+                                  nudge_after=SESSION_NUDGE_AFTER, interval=SESSION_SWEEP_INTERVAL).start()
+    gauge("bot_active_sessions", "Conversations with stored state", fn=sweeper.active)
+    try:
+        if use_webhook():
+            WebhookServer(None, None, WEBHOOK_SECRET, dispatch=cluster.dispatch).run(port=PORT)
+        else:
+            cluster.run_polling(get_updates)
+    finally:
+        sweeper.stop()
+        cluster.stop()
 
 
+def commands_hash():
+    return hashlib.sha256(json.dumps(Commands, ensure_ascii=False, sort_keys=True).encode()).hexdigest()
 
-def load_states():
-    with open(STATE_FILE, 'r') as f:
-        return json.load(f)
+
+def register_commands():
+    """Post Commands to setMyCommands unless this bot already has exactly that list."""
+    # Keyed by the bot id (the public part of the token) so bots sharing a database don't mix
+    meta_id = f"commands:{(BOT_TOKEN or '').split(':', 1)[0]}"
+    digest = commands_hash()
+    meta = app.db["bot_meta"]
+    if (meta.find_one({"_id": meta_id}) or {}).get("hash") == digest:
+        logging.info("Bot commands unchanged, skipping setMyCommands")
+        return False
+    try:
+        response = requests.post(f"{API_URL}/setMyCommands", json={"commands": Commands}, timeout=10)
+        ok = response.json().get("ok", False)
+    except (requests.RequestException, ValueError) as e:
+        logging.warning("setMyCommands failed: %s", e)
+        return False
+    if not ok:
+        logging.warning("setMyCommands was rejected: %s", response.text)
+        return False
+    meta.update_one({"_id": meta_id}, {"$set": {"hash": digest, "updated_at": datetime.now()}}, upsert=True)
+    logging.info("Registered %s bot commands", len(Commands))
+    return True
+
+
+def warm_caches():
+    """Load recent geocode results from Mongo so lookups after a restart start out as hits."""
+    try:
+        addresses = app.geocode_cache.warm()
+        places = app.place_cache.warm()
+        logging.info("Warmed geocode caches with %s addresses and %s places", addresses, places)
+    except Exception as e:
+        logging.warning("Cache warm-up failed: %s", e)
 
 
-def save_states(states):
-    with open(STATE_FILE, 'w') as f:
-        json.dump(states, f)
+def start_warmup():
+    threading.Thread(target=warm_caches, name="cache-warmup", daemon=True).start()
 
 
 def main():
+    if BOT_RUNTIME == "cluster":
+        # The ingress process sends nudges; the workers do everything else
+        app.processes = BOT_WORKERS + 1
     last_update_id = load_offset()
-    print("🚀 Bot is running...")
-    logging.info("Bot started successfully.")
-    response = requests.post(url, json={"commands": Commands})
+    committer = OffsetCommitter(save_offset, interval=OFFSET_COMMIT_INTERVAL)
+    committer.start(last_update_id)
+    logging.info("🚀 Bot started successfully.")
+    register_commands()
+    ensure_indexes(app.db)
+    app.geocode_cache.ensure_indexes()
+    app.place_cache.ensure_indexes()
+    app.sms_outbox.ensure_indexes()
+    app.sms_outbox.start()
+    if METRICS_PORT:
+        serve(METRICS_PORT)
+
+    if BOT_RUNTIME == "cluster":
+        run_cluster(committer)
+        return
+
+    # The whole state snapshot is read here, so conversations resume from memory
+    states = StateStore(STATE_FILE)
+    sessions.start(states)
+    start_warmup()
+
+    def flush_all():
+        states.flush()
+        app.writer.flush()
+
+    # Nothing buffered may be lost once the offset has moved past it
+    committer.before_commit = flush_all
+
+    try:
+        run_updates(states, committer, last_update_id)
+    finally:
+        # Also reached on SIGTERM (see exit_on_sigterm)
+        sessions.stop()
+        try:
+            states.close()
+            committer.commit()
+        except Exception as e:
+            logging.error("Final state flush or offset commit failed: %s", e, exc_info=True)
+
+
+def run_updates(states, committer, last_update_id):
+    if use_webhook():
+        server = WebhookServer(handle_update, states, WEBHOOK_SECRET, workers=WEBHOOK_WORKERS)
+        try:
+            server.run(port=PORT)
+        finally:
+            # Queued updates were already acknowledged to Telegram; handle
+            # them before main() closes the state store
+            server.stop()
+        return
+
+    if BOT_RUNTIME == "async":
+        logging.info("Using async runtime with concurrency %s", BOT_CONCURRENCY)
+        engine = AsyncEngine(API_URL, handle_update, states, committer,
+                             concurrency=BOT_CONCURRENCY)
+        engine.run()
+        return
     
 
+    backoff = 1
     while True:
-        updates = get_updates(offset=last_update_id)
-        states = load_states()
-
-        for result in updates.get("result", []):
-            update_id = result["update_id"]
-            if "callback_query" in result:
-                callback = result["callback_query"]
-                chat_id = str(callback["message"]["chat"]["id"])
-                data = callback["data"]
-                
-                if data == "start_over":
-                    states[chat_id] = {"step": 0, "data": {}}
-                    save_states(states)
-                    send_message(chat_id, "🔄 Starting over. Let's begin again.")
-                    send_message(chat_id, Data_Message[0]['label'])
-                elif data == "keep_going":
-                    step = states[chat_id]["step"]
-                    current_field = Data_Message[step]["label"]
-                    send_message(chat_id, f"📍 Continuing your current session.\n\n{current_field}")
-                elif data == "new_order":
-                    states = load_states()
-                    last_state = states.get(chat_id, None)
-
-                    # Start new order with empty data dict
-                    states[chat_id] = {"step": 0, "data": {}}
-
-                    if last_state and "data" in last_state:
-                        last_payment = last_state["data"].get("payment_from_sender_or_receiver")
-                        if last_payment:
-                            states[chat_id]["data"]["payment_from_sender_or_receiver"] = last_payment
-
-                            # Skip phone question for the side that pays
-                            skip_field = "receiver_phone" if last_payment == "Sender / ላኪ" else "sender_phone"
-
-                            # Find first step not matching skip_field
-                            step = 0
-                            while step < len(Data_Message):
-                                if Data_Message[step]["field"] != skip_field:
-                                    break
-                                step += 1
-                            states[chat_id]["step"] = step
-                        else:
-                            states[chat_id]["step"] = 0
-                    else:
-                        states[chat_id]["step"] = 0
-
-                    save_states(states)
-
-                    send_message(chat_id, "📦 Great! Let's begin your new order.")
-
-                    current_field_info = Data_Message[states[chat_id]["step"]]
-                    if current_field_info["field"] == "location_marker":
-                        request_location(chat_id)
-                    elif current_field_info["field"] == "payment_from_sender_or_receiver":
-                        request_payment_option(chat_id)
-                    else:
-                        send_message(chat_id, current_field_info["label"])
-
-
-
-                elif data == "no_more_orders":
-                    send_message(chat_id, "👍 Thank you for using Tolo Delivery!\nYou can type /start anytime to create a new delivery.")
-
-            message = result.get("message")
-            if not message:
-                continue
-
-            chat_id = str(message["chat"]["id"])
-            logging.info(f"Processing message from chat_id {chat_id} with update_id {update_id}")
-
-            if "location" in message and chat_id in states:
-                lat = message["location"]["latitude"]
-                lon = message["location"]["longitude"]
-                states[chat_id]["data"].update({"latitude": lat, "longitude": lon})
-                states[chat_id]["data"].update(get_address_from_coordinates(lat, lon))
-                states[chat_id]["step"] += 1
-                save_states(states)
-                logging.info(f"Location received for chat_id {chat_id}: {lat}, {lon}")
-                request_payment_option(chat_id)
-                continue  # ✅ No update to last_update_id here
-
-            if "text" not in message:
-                continue
-
-            text = message["text"].strip()
-            logging.info(f"Received message: {text} from chat_id {chat_id}")
-
-            if text.lower() in ["/about", "/contact", "/feedback", "/price"]:
-                # Check if user is in an active delivery session (step is integer)
-                if chat_id in states and isinstance(states[chat_id].get("step"), int):
-                    send_message(chat_id, "⚠️ You have an active delivery session. Please finish or cancel it before using this command.")
-                    logging.info(f"Blocked {text} command for active session user {chat_id}")
-                    continue
-
-            if text.lower() == "/feedback":
-                states[chat_id] = {"step": "feedback"}  # special mode
-                save_states(states)
-                send_message(chat_id, "📝 Please type your feedback below. / እባክዎ እቅድዎን እዚህ ያስገቡ:")
-                continue
-
-            # If user is in feedback mode
-            if chat_id in states and states[chat_id].get("step") == "feedback":
-                user = message["from"]
-                full_name = f"{user.get('first_name', '')} {user.get('last_name', '')}".strip()
-                feedback_data = {
-                    "user_name": full_name,
-                    "chat_id": chat_id,
-                    "feedback": text,
-                    "timestamp": datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-                }
-                save_feedback(feedback_data)
-                send_message(chat_id, "✅ Thank you for your feedback! / እናመሰግናለን ለእቅድዎ!")
-                del states[chat_id]
-                save_states(states)
-                continue
-            elif text.lower() == "/about":
-                send_message(chat_id,
-                    "📦 *About Tolo Delivery*\n\n"
-                    "Tolo Delivery is a fast and reliable delivery service helping you send packages across Addis Ababa.\n"
-                    "We are committed to making your delivery experience quick and seamless.\n\n"
-                    "ቶሎ ዴሊቨሪ በአዲስ አበባ ውስጥ ጥቅሎችን ለመላክ የሚረዳ ፈጣን እና አስተማማኝ የአቅርቦት አገልግሎት ነው. \n"
-                    "የአቅርቦት ተሞክሮዎ ፈጣን እና እንከን የለሽ ለማድረግ ተግተን እንሰራለን"
-                )
-
-            elif text.lower() == "/contact":
-                send_message(chat_id,
-                    "📞 *Contact Us*\n\n"
-                    "Phone: +251921296933\n"
-                    "     : +251900041277\n"
-                    "Email: info@tolo9558.com\n"
-                    "ለአገልግሎታችን ከሆነ ጥያቄ ወይም መረጃ ለማግኘት:\n"
-                    "ስልክ: +251921296933\n"
-                    "     +251900041277\n"
-                    "ኢሜይል: info@tolo9558.com"
-                )
-            elif text.lower() == "/price":
-                send_message(chat_id,
-                    "💰 *Delivery Price*: \n\n"
-                    "1 - 5 km: 100 birr\n"
-                    "6 - 10 km: 200 birr\n"
-                    "11 - 20 km: 300 birr\n"
-                    "የዋጋ ዝርዝር: \n"
-                    "1 - 5 ኪ.ሜ: 100 ብር\n"
-                    "6 - 10 ኪ.ሜ: 200 ብር\n"
-                    "11 - 20 ኪ.ሜ: 300 ብር\n"
-                )
-            
-       
-
-
-            if text.lower() == "/start":
-                db.bot_events.insert_one({
-                    "event": "bot_start",
-                    "chat_id": chat_id,
-                    "timestamp": datetime.now()
-                })
-                if chat_id in states:
-                    
-                    reply_markup = {
-                        "inline_keyboard": [
-                            [{"text": "✅ Yes, start over", "callback_data": "start_over"}],
-                            [{"text": "❌ No, continue current", "callback_data": "keep_going"}]
-                        ]
-                    }
-                    send_message(chat_id, "⚠️ You already have an active delivery. Do you want to cancel it and start over?", reply_markup=reply_markup)
-                else:
-                    db.bot_events.insert_one({
-                        "event": "fallback",
-                        "chat_id": chat_id,
-                        "timestamp": datetime.now()
-                    })
-                    states[chat_id] = {"step": 0, "data": {}}
-                    save_states(states)
-                    send_message(chat_id, "👋 Selam! Welcome to Tolo Delivery.\nሰላም! ወደ ቶሎ ዴሊቨሪ እንኳን በደህና መጡ።\nLet's begin / እንጀምር።")
-                    send_message(chat_id, Data_Message[0]['label'])
-
-            
-            elif text.lower() == "/cancel":
-                if chat_id in states:
-                    del states[chat_id]
-                    save_states(states)
-                    send_message(chat_id, "❌ Operation cancelled. / እቅዱ ተሰርዟል።")
-                else:
-                    send_message(chat_id, "No operation to cancel. / ምንም እቅድ የለም።")
-
-            elif chat_id in states:
-                state = states[chat_id]
-                step = state["step"]
-                field_info = Data_Message[step]
-                field = field_info["field"]
-
-                if field in ["sender_phone", "receiver_phone"]:
-                    if not ((text.startswith("09") and len(text) == 10 and text.isdigit()) or
-                            (text.startswith("+2519") and len(text) == 13 and text[1:].isdigit())):
-                        send_message(chat_id, "⚠️ Invalid Ethiopian phone number. Example: 0912345678 or +251912345678 / እባክዎ ትክክል የኢትዮጵያ ስልክ ቁጥር ያስገቡ።")
-                        logging.warning(f"Invalid phone number input from chat_id {chat_id}: {text}")
-                        continue
-
-                if field == "Quantity":
-                    if not text.isdigit() or int(text) <= 0:
-                        send_message(chat_id, "⚠️ Please enter a valid quantity (positive number). / እባክዎ ትክክል ቁጥር ያስገቡ።")
-                        logging.warning(f"Invalid quantity input from chat_id {chat_id}: {text}")
-                        continue
-
-                valid_inputs = ["Sender / ላኪ", "Receiver / ተቀባይ"]
-                if field == "payment_from_sender_or_receiver":
-                    # If user already has payment choice, skip this question
-                    if "payment_from_sender_or_receiver" in state["data"]:
-                        last_payment = state["data"]["payment_from_sender_or_receiver"]
-                        skip_field = "receiver_phone" if last_payment == "Sender / ላኪ" else "sender_phone"
-                        step = state["step"]
-                        while step + 1 < len(Data_Message):
-                            step += 1
-                            next_field = Data_Message[step]["field"]
-                            if next_field != skip_field:
-                                break
-                        state["step"] = step
-                        save_states(states)
-
-                        next_field_info = Data_Message[step]
-                        if next_field_info["field"] == "location_marker":
-                            request_location(chat_id)
-                        else:
-                            send_message(chat_id, next_field_info["label"])
-                        continue
-
-
-                
-                state["data"][field] = text
-                logging.info(f"Step {step} completed for chat_id {chat_id}: {field} = {text}")
-
-                if step == 0:
-                    user = message["from"]
-                    full_name = f"{user.get('first_name', '')} {user.get('last_name', '')}".strip()
-                    state["data"]["user_name"] = full_name
-
-                if step + 1 < len(Data_Message):
-                    next_field_info = Data_Message[step + 1]
-                    state["step"] += 1
-                    save_states(states)
-
-                    if next_field_info["field"] == "location_marker":
-                        request_location(chat_id)
-                    elif next_field_info["field"] == "payment_from_sender_or_receiver":
-                        request_payment_option(chat_id)
-                      
-                    else:
-                        send_message(chat_id, next_field_info["label"])
-                else:
-                    state["data"]["timestamp"] = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-                    state["data"]["source"] = "bot" 
-                    delivery_count = deliveries_collection.count_documents({"chat_id": chat_id})
-                  
-
-                    order_id = str(uuid4())[:8]
-                    state["data"]["order_id"] = order_id
-                    # Make sure payment_from_sender_or_receiver is saved in final delivery data
-                    state["data"]["payment_from_sender_or_receiver"] = state["data"].get("payment_from_sender_or_receiver")
-                    save_delivery(state["data"])
-                    del states[chat_id]
-                    save_states(states)
-                    reply_markup = {
-                        "inline_keyboard": [
-                            [{"text": "➕ New Order", "callback_data": "new_order"}],
-                            [{"text": "❌ Done", "callback_data": "no_more_orders"}]
-                        ]
-                    }
-
-                    send_message(chat_id, "✅ Your order has been accepted! We Will Notify via sms When Driver Is Assigned Thank you for using Tolo Delivery..\nWould you like to place another order? \n ትዕዛዝዎ ተቀባይነት አግኝቷል! ሾፌሩ ሲመደብ በSMS አማካኝነት እናሳውቆታለን። ቶሎ ዴሊቨሪ በመጠቀምዎ እናመሰግናለን\n ሌላ ትእዛዝ መጨመር ይፍልጋሉ?", reply_markup=reply_markup)
-                
-               
-                    
-            else:
-                send_message(chat_id, "Type /start to begin. / እባክዎ /start ይጻፉ ለመጀመር።")
-                logging.info(f"Prompted chat_id={chat_id} to use /start")
-                
-            
-        if updates.get("result"):
-            last_update_id = updates["result"][-1]["update_id"] + 1
-            save_offset(last_update_id)
-
-
-        time.sleep(1)
-        
+        # Don't sit in a long poll while an offset commit is still owed
+        poll_timeout = max(1, int(committer.interval)) if committer.pending else 100
+        try:
+            results = updates_result(get_updates(offset=last_update_id, timeout=poll_timeout))
+        except (requests.RequestException, ValueError, GetUpdatesError) as e:
+            delay = getattr(e, "retry_after", None) or backoff
+            logging.error("getUpdates failed, retrying in %ss: %s", delay, e)
+            time.sleep(delay)
+            backoff = min(backoff * 2, 30)
+            continue
+        backoff = 1
+
+        for result in results:
+            try:
+                handle_update(result, states)
+            except Exception as e:
+                # Like the other runtimes: one bad update must not stop the bot
+                # (or crash it again every time the update is replayed)
+                logging.error("Failed to handle update %s: %s", result.get("update_id"), e, exc_info=True)
+            last_update_id = result["update_id"] + 1
+            committer.advance(last_update_id)
+
+        if results:
+            committer.commit_if_due()
+        else:
+            committer.commit()
+
+
+def exit_on_sigterm():
+    """Turn SIGTERM (how Heroku stops a dyno) into SystemExit, so shutdown code runs."""
+    def terminate(signum, frame):
+        logging.info("Received SIGTERM, shutting down")
+        raise SystemExit(0)
+    signal.signal(signal.SIGTERM, terminate)
+
+
 if __name__ == '__main__':
+    app.start_logging()
+    exit_on_sigterm()
     try:
         main()
     except Exception as e:
-        logging.critical(f"🚨 Bot crashed: {e}", exc_info=True)
+        logging.critical("🚨 Bot crashed: %s", e, exc_info=True)
+    finally:
+        sessions.stop()
+        app.close()
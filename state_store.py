@@ -0,0 +1,325 @@
+import copy
+import json
+import logging
+import os
+import threading
+import time
+from datetime import datetime, timedelta
+
+from pymongo import DeleteOne, ReturnDocument, UpdateOne
+from pymongo.errors import BulkWriteError
+
+from metrics import histogram, timed
+
+STATE_FLUSH_SECONDS = histogram("state_flush_seconds", "Time to persist dirty conversation states", ["store"])
+
+
+def _dumps(obj):
+    return json.dumps(obj, ensure_ascii=False)
+
+
+class StateStore:
+    """In-memory per-chat conversation state with a write-behind journal.
+
+    The snapshot file keeps the same ``{chat_id: state}`` layout as the old
+    ``user_states.json``. Every change only marks the chat as dirty; dirty
+    chats are appended to the journal in batches and the journal is folded
+    back into the snapshot once it grows past ``compact_every`` records, so
+    recovery on startup never replays more than that.
+
+    Different chats may be updated from different threads; callers are
+    expected to serialize work for the same chat themselves. ``commit()``
+    serializes the state on the calling thread, and the journal and
+    snapshot are written from those strings, so a flush never reads a
+    state another thread is changing.
+    """
+
+    def __init__(self, snapshot_path, journal_path=None, flush_every=50,
+                 flush_interval=1.0, compact_every=2000):
+        self.snapshot_path = snapshot_path
+        self.journal_path = journal_path or snapshot_path + ".journal"
+        self.flush_every = flush_every
+        self.flush_interval = flush_interval
+        self.compact_every = compact_every
+
+        self._data = {}
+        self._saved = {}
+        self._dirty = {}
+        self._journal_records = 0
+        self._last_flush = time.monotonic()
+        self._lock = threading.RLock()
+        self.load()
+
+    # ---- dict-like access -------------------------------------------------
+
+    def __contains__(self, chat_id):
+        return chat_id in self._data
+
+    def __getitem__(self, chat_id):
+        return self._data[chat_id]
+
+    def __setitem__(self, chat_id, state):
+        with self._lock:
+            self._data[chat_id] = state
+            self.commit(chat_id)
+
+    def __delitem__(self, chat_id):
+        with self._lock:
+            del self._data[chat_id]
+            self.commit(chat_id)
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, chat_id, default=None):
+        return self._data.get(chat_id, default)
+
+    def items(self):
+        return self._data.items()
+
+    # ---- persistence ------------------------------------------------------
+
+    def commit(self, chat_id):
+        """Record that the state of ``chat_id`` changed (in place or not).
+
+        Call it from the thread that changed the state, once it is done.
+        """
+        with self._lock:
+            state = self._data.get(chat_id)
+            try:
+                saved = None if state is None else _dumps(state)
+            except RuntimeError:
+                # Another thread (a background patch racing the handler) is
+                # changing this state right now; its own commit follows and
+                # records both changes.
+                return
+            self._dirty[chat_id] = saved
+            if saved is None:
+                self._saved.pop(chat_id, None)
+            else:
+                self._saved[chat_id] = saved
+            if len(self._dirty) >= self.flush_every:
+                self.flush()
+
+    def flush_if_due(self):
+        if self._dirty and time.monotonic() - self._last_flush >= self.flush_interval:
+            self.flush()
+
+    def flush(self):
+        """Append every dirty chat to the journal with a single fsync."""
+        with self._lock:
+            self._last_flush = time.monotonic()
+            if not self._dirty:
+                return
+            lines = ['{"chat_id": %s, "state": %s}' % (_dumps(chat_id), "null" if saved is None else saved)
+                     for chat_id, saved in self._dirty.items()]
+            self._dirty.clear()
+
+            with timed(STATE_FLUSH_SECONDS, store="file"), \
+                    open(self.journal_path, "a", encoding="utf-8") as f:
+                f.write("\n".join(lines) + "\n")
+                f.flush()
+                os.fsync(f.fileno())
+            self._journal_records += len(lines)
+
+            if self._journal_records >= self.compact_every:
+                self.compact()
+
+    def compact(self):
+        """Write a fresh snapshot atomically and truncate the journal."""
+        with self._lock:
+            tmp_path = self.snapshot_path + ".tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                f.write("{%s}" % ", ".join(f"{_dumps(chat_id)}: {saved}" for chat_id, saved in self._saved.items()))
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, self.snapshot_path)
+            open(self.journal_path, "w").close()
+            self._journal_records = 0
+
+    def close(self):
+        self.flush()
+        self.compact()
+
+    def load(self):
+        self._data = {}
+        if os.path.exists(self.snapshot_path):
+            try:
+                with open(self.snapshot_path, "r", encoding="utf-8") as f:
+                    self._data = json.load(f) or {}
+            except ValueError as e:
+                logging.error("State snapshot %s is unreadable: %s", self.snapshot_path, e)
+
+        replayed = 0
+        if os.path.exists(self.journal_path):
+            with open(self.journal_path, "r", encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        # A crash mid-append leaves a truncated last line.
+                        logging.warning("Skipping truncated state journal record")
+                        continue
+                    if record.get("state") is None:
+                        self._data.pop(record["chat_id"], None)
+                    else:
+                        self._data[record["chat_id"]] = record["state"]
+                    replayed += 1
+
+        self._saved = {chat_id: _dumps(state) for chat_id, state in self._data.items()}
+        if replayed:
+            logging.info("Replayed %s state journal records", replayed)
+            self.compact()
+
+
+class MongoStateStore:
+    """Conversation state shared between worker processes through Mongo.
+
+    Offers the same interface as ``StateStore``. Each chat is one document
+    ``{_id: chat_id, state, owner, lease_until}``. A worker may only use a
+    chat's state while it holds the lease; reading an owned chat renews it,
+    and every write renews it as part of the same update. Chats without a
+    document have no state and need no lease. If a worker dies, its leases
+    run out after ``lease_seconds`` (or are released early by the ingress
+    process) and whichever worker the chat is routed to next takes over.
+    """
+
+    def __init__(self, collection, owner, lease_seconds=30, flush_every=50, flush_interval=1.0):
+        self.collection = collection
+        self.owner = owner
+        self.lease_seconds = lease_seconds
+        self.flush_every = flush_every
+        self.flush_interval = flush_interval
+
+        self._cache = {}
+        self._renew_at = {}
+        self._dirty = {}
+        self._last_flush = time.monotonic()
+        self._lock = threading.RLock()
+
+    @staticmethod
+    def release_owner(collection, owner):
+        """Expire every lease held by ``owner`` (a worker known to be dead)."""
+        collection.update_many({"owner": owner}, {"$set": {"lease_until": datetime(1970, 1, 1)}})
+
+    def _claimable(self, chat_id, now):
+        return {"_id": chat_id, "$or": [
+            {"owner": self.owner}, {"owner": None}, {"lease_until": {"$lt": now}},
+        ]}
+
+    def _load(self, chat_id):
+        with self._lock:
+            if chat_id in self._cache and time.monotonic() < self._renew_at.get(chat_id, 0):
+                return self._cache[chat_id]
+
+        while True:
+            now = datetime.utcnow()
+            doc = self.collection.find_one_and_update(
+                self._claimable(chat_id, now),
+                {"$set": {"owner": self.owner, "lease_until": now + timedelta(seconds=self.lease_seconds)}},
+                return_document=ReturnDocument.AFTER,
+            )
+            if doc is not None or self.collection.find_one({"_id": chat_id}, {"_id": 1}) is None:
+                break
+            # Another worker still holds this chat; its lease will run out.
+            time.sleep(0.2)
+
+        with self._lock:
+            if chat_id not in self._dirty:
+                self._cache[chat_id] = doc.get("state") if doc else None
+            self._renew_at[chat_id] = time.monotonic() + self.lease_seconds / 2
+            return self._cache[chat_id]
+
+    # ---- dict-like access -------------------------------------------------
+
+    def __contains__(self, chat_id):
+        return self._load(chat_id) is not None
+
+    def __getitem__(self, chat_id):
+        state = self._load(chat_id)
+        if state is None:
+            raise KeyError(chat_id)
+        return state
+
+    def __setitem__(self, chat_id, state):
+        with self._lock:
+            self._cache[chat_id] = state
+            self.commit(chat_id)
+
+    def __delitem__(self, chat_id):
+        if self._load(chat_id) is None:
+            raise KeyError(chat_id)
+        with self._lock:
+            self._cache[chat_id] = None
+            self.commit(chat_id)
+
+    def get(self, chat_id, default=None):
+        state = self._load(chat_id)
+        return default if state is None else state
+
+    # ---- persistence ------------------------------------------------------
+
+    def commit(self, chat_id):
+        """Record that the state of ``chat_id`` changed; see ``StateStore.commit``."""
+        with self._lock:
+            state = self._cache.get(chat_id)
+            try:
+                # Copied here so the flush thread never encodes a live state
+                self._dirty[chat_id] = None if state is None else copy.deepcopy(state)
+            except RuntimeError:
+                return
+            if len(self._dirty) >= self.flush_every:
+                self.flush()
+
+    def flush_if_due(self):
+        if time.monotonic() - self._last_flush >= self.flush_interval:
+            self.flush()
+            self._forget_idle()
+
+    def _forget_idle(self):
+        # Once its lease renewal is due a cached state would be re-read from
+        # Mongo anyway, so idle chats (abandoned drafts included) are dropped
+        now = time.monotonic()
+        with self._lock:
+            for chat_id in [c for c in self._cache
+                            if c not in self._dirty and self._renew_at.get(c, 0) < now]:
+                del self._cache[chat_id]
+                self._renew_at.pop(chat_id, None)
+
+    def flush(self):
+        """Write every dirty chat in one unordered bulk_write."""
+        with self._lock:
+            self._last_flush = time.monotonic()
+            if not self._dirty:
+                return
+            now = datetime.utcnow()
+            chat_ids = list(self._dirty)
+            ops = []
+            for chat_id, state in self._dirty.items():
+                if state is None:
+                    ops.append(DeleteOne({"_id": chat_id, "owner": self.owner}))
+                    self._cache.pop(chat_id, None)
+                    self._renew_at.pop(chat_id, None)
+                else:
+                    ops.append(UpdateOne(
+                        self._claimable(chat_id, now),
+                        {"$set": {"state": state, "owner": self.owner, "updated_at": now,
+                                  "lease_until": now + timedelta(seconds=self.lease_seconds)},
+                         "$unset": {"nudged_at": ""}},
+                        upsert=True,
+                    ))
+            self._dirty.clear()
+
+            try:
+                with timed(STATE_FLUSH_SECONDS, store="mongo"):
+                    self.collection.bulk_write(ops, ordered=False)
+            except BulkWriteError as e:
+                for error in e.details.get("writeErrors", []):
+                    chat_id = chat_ids[error["index"]]
+                    # The upsert collided with a lease held by another worker.
+                    logging.error("Lost the lease on chat_id %s; dropping local state", chat_id)
+                    self._cache.pop(chat_id, None)
+                    self._renew_at.pop(chat_id, None)
+
+    def close(self):
+        self.flush()
@@ -0,0 +1,205 @@
+import json
+import random
+import threading
+import time
+import zlib
+from collections import defaultdict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+
+class StubServer:
+    """Base class for local HTTP stand-ins of the services the bot talks to.
+
+    Subclasses implement ``handle(method, path, query, body, headers)`` and
+    return a ``(status, payload)`` pair. ``latency`` (seconds) is added to
+    every response so the bot can be exercised against slow dependencies.
+    ``timings`` keeps a call count and the total time spent per endpoint.
+    """
+
+    def __init__(self, host="127.0.0.1", port=0, latency=0.0):
+        self.latency = latency
+        self.timings = defaultdict(lambda: [0, 0.0])
+        self.lock = threading.Lock()
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, *args):
+                pass
+
+            def _respond(self, method):
+                started = time.monotonic()
+                parsed = urlparse(self.path)
+                query = {k: v[-1] for k, v in parse_qs(parsed.query).items()}
+                length = int(self.headers.get("Content-Length") or 0)
+                raw = self.rfile.read(length) if length else b""
+                if self.headers.get("Content-Type", "").startswith("application/json"):
+                    body = json.loads(raw or b"{}")
+                else:
+                    body = {k: v[-1] for k, v in parse_qs(raw.decode()).items()}
+                if stub.latency:
+                    time.sleep(stub.latency)
+                status, payload = stub.handle(method, parsed.path, query, body, self.headers)
+                endpoint = stub.endpoint(parsed.path)
+                with stub.lock:
+                    stub.timings[endpoint][0] += 1
+                    stub.timings[endpoint][1] += time.monotonic() - started
+                data = json.dumps(payload).encode()
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def do_GET(self):
+                self._respond("GET")
+
+            def do_POST(self):
+                self._respond("POST")
+
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        self.server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self):
+        self._thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def endpoint(self, path):
+        return path
+
+    def handle(self, method, path, query, body, headers):
+        raise NotImplementedError
+
+
+class AfroMessageStub(StubServer):
+    """Stand-in for https://api.afromessage.com/api.
+
+    Point ``AFRO_BASE_URL`` at ``stub.url``. Every accepted message is kept
+    in ``sent``; ``failure_rate`` makes a share of sends fail with a 500.
+    """
+
+    def __init__(self, failure_rate=0.0, **kwargs):
+        super().__init__(**kwargs)
+        self.failure_rate = failure_rate
+        self.sent = []
+
+    def handle(self, method, path, query, body, headers):
+        if path.rstrip("/") != "/send" or method != "POST":
+            return 404, {"acknowledge": "error", "response": {"errors": ["not found"]}}
+        if not headers.get("Authorization", "").startswith("Bearer "):
+            return 401, {"acknowledge": "error", "response": {"errors": ["unauthorized"]}}
+        if self.failure_rate and random.random() < self.failure_rate:
+            return 500, {"acknowledge": "error", "response": {"errors": ["stub failure"]}}
+        with self.lock:
+            self.sent.append({"to": body.get("to"), "message": body.get("message"), "at": time.time()})
+            message_id = str(len(self.sent))
+        return 200, {"acknowledge": "success",
+                     "response": {"status": "Send", "message_id": message_id, "to": body.get("to")}}
+
+
+class TelegramStub(StubServer):
+    """Stand-in for the Bot API at ``<url>/bot<token>/<method>``.
+
+    ``push`` queues scripted updates for ``getUpdates`` (which long-polls
+    and honours ``offset`` like the real API). Every ``sendMessage`` is
+    recorded per chat with the time it arrived; ``wait_for_messages``
+    blocks until a chat has received a given number of them.
+    """
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.updates = []
+        self.messages = defaultdict(list)
+        self.next_update_id = 1
+        self.cond = threading.Condition(self.lock)
+
+    def endpoint(self, path):
+        return path.rsplit("/", 1)[-1]
+
+    def push(self, update):
+        """Queue an update (``update_id`` is assigned here) and return it."""
+        with self.cond:
+            update = dict(update, update_id=self.next_update_id)
+            self.next_update_id += 1
+            self.updates.append(update)
+            self.cond.notify_all()
+        return update
+
+    def messages_for(self, chat_id, skip=None):
+        with self.lock:
+            return [m for m in self.messages[str(chat_id)] if not (skip and skip(m))]
+
+    def wait_for_messages(self, chat_id, count, timeout, skip=None):
+        """Return the chat's messages once there are ``count``, or None on timeout.
+
+        Messages for which ``skip(message)`` is true are left out, both of
+        the count and of the result.
+        """
+        deadline = time.monotonic() + timeout
+        with self.cond:
+            while True:
+                messages = [m for m in self.messages[str(chat_id)] if not (skip and skip(m))]
+                if len(messages) >= count:
+                    return messages
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return None
+                self.cond.wait(remaining)
+
+    def handle(self, method, path, query, body, headers):
+        api_method = self.endpoint(path)
+        params = dict(query, **body)
+        if api_method == "getUpdates":
+            offset = int(params.get("offset") or 0)
+            timeout = float(params.get("timeout") or 0)
+            deadline = time.monotonic() + timeout
+            with self.cond:
+                # Confirmed updates are dropped, as Telegram does
+                self.updates = [u for u in self.updates if u["update_id"] >= offset]
+                while not self.updates and time.monotonic() < deadline:
+                    self.cond.wait(deadline - time.monotonic())
+                return 200, {"ok": True, "result": self.updates[:100]}
+        if api_method == "sendMessage":
+            with self.cond:
+                messages = self.messages[str(params.get("chat_id"))]
+                messages.append({"text": params.get("text"), "reply_markup": params.get("reply_markup"),
+                                 "at": time.monotonic()})
+                message_id = len(messages)
+                self.cond.notify_all()
+            return 200, {"ok": True, "result": {"message_id": message_id}}
+        return 200, {"ok": True, "result": True}
+
+
+class NominatimStub(StubServer):
+    """Stand-in for nominatim.openstreetmap.org ``/reverse`` and ``/search``.
+
+    ``/search`` places every query at a stable point in central Addis
+    Ababa derived from its text, so quotes are repeatable.
+    """
+
+    def handle(self, method, path, query, body, headers):
+        if path.rstrip("/") == "/search":
+            seed = zlib.crc32(query.get("q", "").lower().encode())
+            lat = 8.95 + (seed % 1000) / 1000 * 0.13
+            lon = 38.70 + (seed // 1000 % 1000) / 1000 * 0.15
+            return 200, [{"lat": f"{lat:.6f}", "lon": f"{lon:.6f}", "display_name": query.get("q", "")}]
+        if path.rstrip("/") == "/reverse":
+            lat, lon = float(query.get("lat", 0)), float(query.get("lon", 0))
+            return 200, {
+                "display_name": f"Stub street {lat:.4f}, {lon:.4f}, Addis Ababa, Ethiopia",
+                "address": {"city": "Addis Ababa", "postcode": "1000", "country": "Ethiopia"},
+            }
+        return 404, {"error": "not found"}
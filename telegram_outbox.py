@@ -0,0 +1,257 @@
+import heapq
+import itertools
+import json
+import logging
+import threading
+import time
+import zlib
+from collections import deque
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from metrics import counter, histogram, timed
+
+# Telegram allows roughly 30 messages/second per bot and about one message
+# per second to the same chat (short bursts are tolerated). The burst covers
+# a whole order conversation, so a user answering questions never waits.
+GLOBAL_RATE = 30
+PER_CHAT_RATE = 1
+PER_CHAT_BURST = 20
+MAX_TEXT_LENGTH = 4096
+
+SEND_SECONDS = histogram("telegram_send_seconds", "sendMessage round trip")
+QUEUED_SECONDS = histogram("telegram_send_delay_seconds", "Time from queueing a message to its delivery")
+MESSAGES = counter("telegram_messages_total", "Outgoing messages by result", ["result"])
+
+
+class TokenBucket:
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def reserve(self):
+        """Take one token and return how long the caller must wait for it."""
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= 1
+            if self.tokens >= 0:
+                return 0.0
+            return -self.tokens / self.rate
+
+    def is_full(self):
+        with self.lock:
+            elapsed = time.monotonic() - self.updated
+            return self.tokens + elapsed * self.rate >= self.capacity
+
+
+class OutboundDispatcher:
+    """Queues sendMessage calls and delivers them from background workers.
+
+    All requests share one keep-alive ``requests.Session``. Each chat is
+    pinned to one worker so its messages keep their order, and workers
+    respect a global and a per-chat token bucket. A 429 response is retried
+    after Telegram's ``retry_after``; network errors and 5xx responses are
+    retried with exponential backoff.
+
+    With ``coalesce`` enabled, consecutive plain messages queued for the
+    same chat are joined into a single sendMessage call.
+
+    ``global_rate`` is this process's share of the bot-wide limit when
+    several processes send for the same bot.
+    """
+
+    def __init__(self, api_url, workers=8, coalesce=False, max_retries=5, global_rate=GLOBAL_RATE):
+        self.api_url = api_url
+        self.coalesce = coalesce
+        self.max_retries = max_retries
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=workers)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
+        self._global_bucket = TokenBucket(global_rate, global_rate)
+        self._chat_buckets = {}
+        self._buckets_lock = threading.Lock()
+
+        self._queues = [deque() for _ in range(workers)]
+        self._conditions = [threading.Condition() for _ in range(workers)]
+        self._threads = []
+        self._start_lock = threading.Lock()
+        self._closing = False
+
+        self.sent = 0
+        self.failed = 0
+        self._latencies = deque(maxlen=1000)
+
+    # ---- public API -------------------------------------------------------
+
+    def send(self, chat_id, text, reply_markup=None):
+        """Queue a message; returns immediately."""
+        self._ensure_started()
+        index = zlib.crc32(str(chat_id).encode()) % len(self._queues)
+        item = {"chat_id": chat_id, "text": text, "reply_markup": reply_markup,
+                "queued_at": time.monotonic()}
+        with self._conditions[index]:
+            self._queues[index].append(item)
+            self._conditions[index].notify()
+
+    def queue_depth(self):
+        return sum(len(q) for q in self._queues)
+
+    def stats(self):
+        latencies = sorted(self._latencies)
+        stats = {"queue_depth": self.queue_depth(), "sent": self.sent, "failed": self.failed}
+        if latencies:
+            stats["latency_p50"] = latencies[len(latencies) // 2]
+            stats["latency_p99"] = latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))]
+        return stats
+
+    def close(self, timeout=10):
+        """Stop the workers after the queued messages have been sent."""
+        self._closing = True
+        for condition in self._conditions:
+            with condition:
+                condition.notify_all()
+        deadline = time.monotonic() + timeout
+        for thread in self._threads:
+            thread.join(max(0, deadline - time.monotonic()))
+        self.session.close()
+
+    # ---- workers ----------------------------------------------------------
+
+    def _ensure_started(self):
+        if self._threads:
+            return
+        with self._start_lock:
+            if self._threads:
+                return
+            for index in range(len(self._queues)):
+                thread = threading.Thread(target=self._worker, args=(index,),
+                                          name=f"telegram-outbox-{index}", daemon=True)
+                thread.start()
+                self._threads.append(thread)
+
+    def _next_item(self, index, timeout=None):
+        """Pop the next queued message, waiting up to ``timeout`` seconds; None if there is none."""
+        queue = self._queues[index]
+        with self._conditions[index]:
+            if not queue and not self._closing:
+                self._conditions[index].wait(timeout)
+            if not queue:
+                return None
+            item = queue.popleft()
+            if self.coalesce:
+                while (queue and not item["reply_markup"]
+                       and queue[0]["chat_id"] == item["chat_id"]
+                       and len(item["text"]) + len(queue[0]["text"]) + 2 <= MAX_TEXT_LENGTH):
+                    following = queue.popleft()
+                    item = dict(following, text=item["text"] + "\n\n" + following["text"],
+                                queued_at=item["queued_at"])
+            return item
+
+    def _worker(self, index):
+        # Messages a chat may not send yet wait here, ordered by the time they
+        # become sendable, while the worker serves its other chats. A chat's
+        # messages keep their order: each one reserves a later slot in the
+        # chat's bucket, ties go to the earlier arrival, and nothing overtakes
+        # a message that is waiting to be retried.
+        schedule = []
+        arrivals = itertools.count()
+        held = {}  # chat_id -> (retry time, arrival) of its message awaiting a retry
+        while True:
+            now = time.monotonic()
+            if schedule and schedule[0][0] <= now:
+                ready, order, item = heapq.heappop(schedule)
+            else:
+                timeout = schedule[0][0] - now if schedule else None
+                item = self._next_item(index, timeout)
+                if item is None:
+                    if self._closing and not schedule and not self._queues[index]:
+                        return
+                    continue
+                order = next(arrivals)
+                ready = now + self._chat_bucket(item["chat_id"]).reserve()
+
+            chat_id = item["chat_id"]
+            hold = held.get(chat_id)
+            if hold and hold[1] != order and hold[0] > ready:
+                ready = hold[0]
+            if ready > now:
+                heapq.heappush(schedule, (ready, order, item))
+                continue
+
+            try:
+                retry_in = self._deliver(item)
+            except Exception as e:
+                self.failed += 1
+                retry_in = None
+                logging.error("sendMessage to chat_id %s failed: %s", chat_id, e)
+            if retry_in is None:
+                if hold and hold[1] == order:
+                    del held[chat_id]
+            else:
+                ready = time.monotonic() + retry_in
+                held[chat_id] = (ready, order)
+                heapq.heappush(schedule, (ready, order, item))
+
+    def _chat_bucket(self, chat_id):
+        with self._buckets_lock:
+            bucket = self._chat_buckets.get(chat_id)
+            if bucket is None:
+                if len(self._chat_buckets) > 10000:
+                    # Idle chats have full buckets; forgetting them changes nothing.
+                    self._chat_buckets = {k: b for k, b in self._chat_buckets.items() if not b.is_full()}
+                bucket = self._chat_buckets[chat_id] = TokenBucket(PER_CHAT_RATE, PER_CHAT_BURST)
+            return bucket
+
+    def _deliver(self, item):
+        """Make one sendMessage attempt; returns the seconds until a retry, or None when done."""
+        payload = {"chat_id": item["chat_id"], "text": item["text"]}
+        if item["reply_markup"]:
+            payload["reply_markup"] = json.dumps(item["reply_markup"])
+
+        attempt = item["attempt"] = item.get("attempt", 0) + 1
+        backoff = 2 ** (attempt - 1)
+        if attempt > self.max_retries + 1:
+            self.failed += 1
+            MESSAGES.inc(result="failed")
+            logging.error("Giving up on sendMessage to chat_id %s after %s attempts", item["chat_id"], attempt - 1)
+            return None
+
+        # The global budget is shared by every chat, so waiting for it holds nobody back unfairly
+        time.sleep(self._global_bucket.reserve())
+        try:
+            with timed(SEND_SECONDS):
+                response = self.session.post(f"{self.api_url}/sendMessage", data=payload, timeout=30)
+        except requests.RequestException as e:
+            logging.warning("sendMessage network error (attempt %s): %s", attempt, e)
+            return backoff
+
+        if response.status_code == 429:
+            try:
+                retry_after = response.json().get("parameters", {}).get("retry_after", backoff)
+            except ValueError:
+                retry_after = backoff
+            logging.warning("Telegram rate limit hit, retrying in %ss", retry_after)
+            return retry_after
+        if response.status_code >= 500:
+            return backoff
+
+        if response.status_code == 200:
+            self.sent += 1
+            MESSAGES.inc(result="sent")
+        else:
+            self.failed += 1
+            MESSAGES.inc(result="rejected")
+            logging.error("sendMessage to chat_id %s rejected: %s %s", item["chat_id"], response.status_code,
+                          response.text[:200])
+        self._latencies.append(time.monotonic() - item["queued_at"])
+        QUEUED_SECONDS.observe(self._latencies[-1])
+        return None
@@ -0,0 +1,15 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+@pytest.fixture
+def db(monkeypatch):
+    mongomock = pytest.importorskip("mongomock")
+    from loadtest import mongomock_bulk_write
+
+    monkeypatch.setattr(mongomock.collection.Collection, "bulk_write", mongomock_bulk_write)
+    return mongomock.MongoClient().db
@@ -0,0 +1,25 @@
+import pytest
+
+from async_runtime import GetUpdatesError, update_chat_id, updates_result
+
+
+def test_updates_result():
+    assert updates_result({"ok": True, "result": [{"update_id": 1}]}) == [{"update_id": 1}]
+    assert updates_result({"ok": True}) == []
+
+
+def test_updates_result_failure():
+    with pytest.raises(GetUpdatesError) as e:
+        updates_result({"ok": False, "error_code": 409, "description": "Conflict"})
+    assert e.value.retry_after is None
+    assert "409" in str(e.value)
+
+    with pytest.raises(GetUpdatesError) as e:
+        updates_result({"ok": False, "error_code": 429, "parameters": {"retry_after": 7}})
+    assert e.value.retry_after == 7
+
+
+def test_update_chat_id():
+    assert update_chat_id({"message": {"chat": {"id": 42}}}) == "42"
+    assert update_chat_id({"callback_query": {"message": {"chat": {"id": 7}}}}) == "7"
+    assert update_chat_id({"poll": {}}) is None
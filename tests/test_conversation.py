@@ -0,0 +1,63 @@
+import pytest
+
+from conversation import Form, is_ethiopian_phone, update_key
+
+FIELDS = [
+    {"field": "pickup", "label": "Pickup"},
+    {"field": "sender_phone", "label": "Sender phone"},
+    {"field": "dropoff", "label": "Drop-off"},
+    {"field": "receiver_phone", "label": "Receiver phone"},
+    {"field": "location_marker", "label": "Location"},
+    {"field": "payment_from_sender_or_receiver", "label": "Payment"},
+    {"field": "item_description", "label": "Item"},
+    {"field": "Quantity", "label": "Quantity"},
+]
+SENDER = "Sender / ላኪ"
+RECEIVER = "Receiver / ተቀባይ"
+
+
+@pytest.fixture
+def form():
+    return Form(FIELDS, validators={"sender_phone": (is_ethiopian_phone, "bad phone")})
+
+
+def test_kinds(form):
+    assert [step.kind for step in form.steps] == ["text"] * 4 + ["location", "payment", "text", "text"]
+    assert form.last == 7
+
+
+def test_first_step(form):
+    assert form.first_step() == 0
+    assert form.first_step(SENDER) == 0
+    # Only a leading phone question would be skipped
+    assert Form(FIELDS[1:]).first_step(RECEIVER) == 1
+
+
+def test_skip_from_sender_pays(form):
+    # The receiver's phone is skipped when the sender pays
+    assert form.skip_from(2, SENDER) == 4
+    assert form.skip_from(0, SENDER) == 1
+    assert form.skip_from(3, SENDER) == 4
+
+
+def test_skip_from_receiver_pays(form):
+    assert form.skip_from(0, RECEIVER) == 2
+    assert form.skip_from(2, RECEIVER) == 3
+
+
+def test_skip_from_last_step_stays(form):
+    assert form.skip_from(form.last, SENDER) == form.last
+    assert form.skip_from(form.last, RECEIVER) == form.last
+
+
+def test_validate(form):
+    assert form.validate("sender_phone", "0911223344") is None
+    assert form.validate("sender_phone", "12345") == "bad phone"
+    assert form.validate("pickup", "anything") is None
+
+
+def test_update_key():
+    message = {"update_id": 7, "message": {"message_id": 3, "chat": {"id": 42}}}
+    assert update_key(message) == "42:3"
+    assert update_key({"update_id": 8, "callback_query": {"id": "abc"}}) == "cb:abc"
+    assert update_key({"update_id": 9, "callback_query": {}}) == "cb:u9"
@@ -0,0 +1,98 @@
+import random
+from datetime import datetime, timedelta
+
+import pytest
+
+from dispatcher import Dispatcher, GridIndex, PollingOrderFeed
+from pricing import haversine_km
+from sms_dispatch import SmsOutbox
+
+ADDIS = (9.01, 38.75)
+
+
+def test_nearest_empty():
+    assert GridIndex().nearest(*ADDIS, max_km=10) is None
+
+
+def test_nearest_within_and_beyond_max_km():
+    index = GridIndex(cell_km=1.0)
+    index.add("near", 9.02, 38.75)
+    index.add("far", 9.30, 38.75)
+    key, km = index.nearest(*ADDIS, max_km=10)
+    assert key == "near"
+    assert km == pytest.approx(haversine_km(*ADDIS, 9.02, 38.75))
+    assert index.nearest(9.30, 38.75, max_km=0.5)[0] == "far"
+    assert index.nearest(9.15, 38.75, max_km=5) is None
+
+
+def test_nearest_after_move_and_remove():
+    index = GridIndex()
+    index.add("a", 9.02, 38.75)
+    index.add("b", 9.05, 38.75)
+    index.add("a", 9.10, 38.75)
+    assert len(index) == 2
+    assert index.nearest(*ADDIS, max_km=20)[0] == "b"
+    index.remove("b")
+    index.remove("missing")
+    assert "b" not in index
+    assert index.nearest(*ADDIS, max_km=20)[0] == "a"
+
+
+def test_nearest_matches_brute_force():
+    rng = random.Random(3)
+    points = {i: (9.0 + rng.uniform(-0.1, 0.1), 38.75 + rng.uniform(-0.1, 0.1)) for i in range(300)}
+    index = GridIndex(cell_km=0.5)
+    for key, (lat, lon) in points.items():
+        index.add(key, lat, lon)
+    for _ in range(50):
+        lat, lon = 9.0 + rng.uniform(-0.12, 0.12), 38.75 + rng.uniform(-0.12, 0.12)
+        key, km = min(((k, haversine_km(lat, lon, *p)) for k, p in points.items()), key=lambda kv: kv[1])
+        found = index.nearest(lat, lon, max_km=3)
+        if km > 3:
+            assert found is None
+        else:
+            assert found == (key, pytest.approx(km))
+
+
+@pytest.fixture
+def dispatcher(db):
+    outbox = SmsOutbox(db["sms_outbox"], client=None)
+    yield Dispatcher(db["deliveries"], db["drivers"], PollingOrderFeed(db["deliveries"]), outbox)
+    outbox.stop()
+
+
+def add_order(db, chat_id, order_id, lat=9.02, lon=38.75, **fields):
+    doc = {"chat_id": chat_id, "order_id": order_id, "latitude": lat, "longitude": lon,
+           "sender_phone": "0911223344", "pickup": "Bole", "dropoff": "Piassa", "created_at": datetime.now()}
+    doc.update(fields)
+    return db["deliveries"].insert_one({k: v for k, v in doc.items() if v is not None}).inserted_id
+
+
+def add_driver(db, driver_id, lat=9.02, lon=38.75):
+    db["drivers"].insert_one({"_id": driver_id, "name": driver_id, "phone": "0922000000", "latitude": lat,
+                              "longitude": lon, "available": True, "updated_at": datetime.utcnow()})
+
+
+def test_old_and_undated_orders_are_left_alone(db, dispatcher):
+    add_order(db, "1", "aaaa0001", created_at=None)
+    add_order(db, "2", "aaaa0002", timestamp="2025-03-01 10:00:00", created_at="2025-03-01 10:00:00")
+    add_order(db, "3", "aaaa0003", created_at=datetime.now() - timedelta(days=2))
+    add_driver(db, "d1")
+    assert dispatcher.run_once() == 0
+    assert db["sms_outbox"].count_documents({}) == 0
+    assert db["drivers"].find_one({"_id": "d1"})["available"]
+
+
+def test_assigns_and_notifies_per_delivery(db, dispatcher):
+    # Same order_id in two chats: both get their driver and their SMS
+    first = add_order(db, "1", "abcd1234")
+    second = add_order(db, "2", "abcd1234", lat=9.03)
+    add_driver(db, "d1")
+    add_driver(db, "d2", lat=9.03)
+    assert dispatcher.run_once() == 2
+    assert db["deliveries"].find_one({"_id": first})["driver_id"] == "d1"
+    assert db["deliveries"].find_one({"_id": second})["driver_id"] == "d2"
+    assert db["drivers"].find_one({"_id": "d2"})["current_order"] == second
+    assert sorted(doc["_id"] for doc in db["sms_outbox"].find()) == sorted(
+        f"{delivery}:{role}" for delivery in (first, second) for role in ("customer_assigned", "driver_assigned"))
+    assert dispatcher.run_once() == 0
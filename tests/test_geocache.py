@@ -0,0 +1,85 @@
+import threading
+import time
+from datetime import timedelta
+
+from geocache import GeocodeCache, PlaceCache, geohash, place_key
+
+BOLE = (8.995, 38.789)
+
+
+class SlowFetch:
+    def __init__(self, result, delay=0.2):
+        self.result = result
+        self.delay = delay
+        self.calls = 0
+
+    def __call__(self, *args):
+        self.calls += 1
+        time.sleep(self.delay)
+        return dict(self.result) if self.result else self.result
+
+
+def test_geohash():
+    assert geohash(57.64911, 10.40744, 11) == "u4pruydqqvj"
+    assert geohash(*BOLE) == geohash(*BOLE, precision=11)[:7]
+
+
+def test_concurrent_lookups_share_one_fetch():
+    fetch = SlowFetch({"full_address": "Bole"})
+    cache = GeocodeCache(fetch, min_interval=0)
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(cache.lookup(*BOLE))) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert fetch.calls == 1
+    assert results == [{"full_address": "Bole"}] * 8
+    assert cache.lookup(*BOLE) == {"full_address": "Bole"}
+    assert fetch.calls == 1
+
+
+def test_failed_lookups_are_not_cached(db):
+    fetch = SlowFetch({}, delay=0)
+    cache = GeocodeCache(fetch, collection=db["geocache"], min_interval=0)
+    assert cache.lookup(*BOLE) == {}
+    assert cache.lookup(*BOLE) == {}
+    assert fetch.calls == 2
+    assert db["geocache"].count_documents({}) == 0
+
+
+def test_persistent_layer_and_warm(db):
+    fetch = SlowFetch({"full_address": "Bole"}, delay=0)
+    first = GeocodeCache(fetch, collection=db["geocache"], min_interval=0)
+    first.lookup(*BOLE)
+    second = GeocodeCache(fetch, collection=db["geocache"], min_interval=0)
+    assert second.warm() == 1
+    assert second.lookup(*BOLE) == {"full_address": "Bole"}
+    assert fetch.calls == 1
+
+
+def test_expired_entries_are_fetched_again():
+    fetch = SlowFetch({"full_address": "Bole"}, delay=0)
+    cache = GeocodeCache(fetch, min_interval=0, ttl=timedelta(seconds=-1))
+    cache.lookup(*BOLE)
+    cache.lookup(*BOLE)
+    assert fetch.calls == 2
+
+
+def test_lru_eviction():
+    fetch = SlowFetch({"full_address": "x"}, delay=0)
+    cache = GeocodeCache(fetch, min_interval=0, max_entries=2)
+    for lat in (9.0, 9.1, 9.2):
+        cache.lookup(lat, 38.7)
+    cache.lookup(9.0, 38.7)
+    assert fetch.calls == 4
+
+
+def test_place_cache():
+    fetch = SlowFetch({"lat": 9.0, "lon": 38.7}, delay=0)
+    cache = PlaceCache(fetch, min_interval=0)
+    assert place_key("  Bole,  Edna Mall ") == "bole edna mall"
+    cache.lookup("Bole, Edna Mall")
+    cache.lookup("bole edna mall")
+    assert cache.lookup("   ") == {}
+    assert fetch.calls == 1
@@ -0,0 +1,53 @@
+import json
+import logging
+
+import pytest
+
+from log_config import JsonFormatter, RedactingFormatter, SamplingFilter, redact
+
+
+@pytest.mark.parametrize("text, expected", [
+    ("call 0911223344 now", "call 09******44 now"),
+    ("0711223344", "07******44"),
+    ("+251911223344", "+2519******44"),
+    ("251711223344", "2517******44"),
+    ("0911223344,0922334455", "09******44,09******55"),
+])
+def test_redact_masks_phone_numbers(text, expected):
+    assert redact(text) == expected
+
+
+@pytest.mark.parametrize("text", [
+    "update 12345678901",   # longer digit runs aren't phone numbers
+    "0811223344",           # not a mobile prefix
+    "091122334",            # too short
+    "order ab12cd34",
+])
+def test_redact_leaves_other_text(text):
+    assert redact(text) == text
+
+
+def record(msg, *args, **extra):
+    rec = logging.LogRecord("root", logging.INFO, __file__, 1, msg, args, None)
+    rec.__dict__.update(extra)
+    return rec
+
+
+def test_json_formatter_redacts_message_and_extra():
+    entry = json.loads(JsonFormatter().format(record("Sent to %s", "0911223344", chat_id="42",
+                                                     phone="+251911223344")))
+    assert entry["msg"] == "Sent to 09******44"
+    assert entry["phone"] == "+2519******44"
+    assert entry["chat_id"] == "42"
+    assert entry["level"] == "INFO"
+
+
+def test_redacting_formatter():
+    assert RedactingFormatter("%(message)s").format(record("phone %s", "0911223344")) == "phone 09******44"
+
+
+def test_sampling_filter():
+    sampler = SamplingFilter(every=3)
+    kept = [sampler.filter(record("chatty", sampled=True)) for _ in range(6)]
+    assert kept == [True, False, False, True, False, False]
+    assert sampler.filter(record("important"))
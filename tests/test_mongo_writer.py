@@ -0,0 +1,99 @@
+import time
+from types import SimpleNamespace
+
+import pytest
+from pymongo.errors import AutoReconnect, BulkWriteError
+
+import mongo_writer
+from mongo_writer import BatchWriter
+
+
+@pytest.fixture(autouse=True)
+def no_backoff(monkeypatch):
+    monkeypatch.setattr(mongo_writer, "time", SimpleNamespace(sleep=lambda seconds: None, monotonic=time.monotonic))
+
+
+class FlakyCollection:
+    """Records bulk_write batches; raises the queued errors first."""
+
+    name = "events"
+    full_name = "test.events"
+
+    def __init__(self, *errors):
+        self.errors = list(errors)
+        self.batches = []
+
+    def bulk_write(self, ops, ordered=True):
+        if self.errors:
+            raise self.errors.pop(0)
+        self.batches.append([op._doc for op in ops])
+
+
+def test_flush_writes_one_batch_per_collection(db):
+    writer = BatchWriter(flush_interval=3600)
+    writer.insert(db["bot_events"], {"event": "a"})
+    writer.insert(db["bot_events"], {"event": "b"})
+    writer.insert_once(db["feedback"], "k1", {"text": "hi"})
+    writer.insert_once(db["feedback"], "k1", {"text": "replayed"})
+    assert writer.pending() == 4
+    writer.flush()
+    assert writer.pending() == 0
+    assert db["bot_events"].count_documents({}) == 2
+    assert list(db["feedback"].find()) == [{"_id": "k1", "text": "hi"}]
+    writer.close()
+
+
+def test_failed_batch_is_retried():
+    events = FlakyCollection(AutoReconnect("primary stepped down"))
+    writer = BatchWriter(flush_interval=3600)
+    writer.insert(events, {"n": 1})
+    writer.flush()
+    assert writer.pending() == 1
+    writer.flush()
+    assert events.batches == [[{"n": 1}]]
+    writer.close()
+
+
+def test_write_is_dropped_after_max_retries():
+    events = FlakyCollection(*[AutoReconnect("down")] * 3)
+    writer = BatchWriter(flush_interval=3600, max_retries=3)
+    writer.insert(events, {"n": 1})
+    for _ in range(3):
+        writer.flush()
+    assert writer.pending() == 0
+    assert events.batches == []
+    writer.close()
+
+
+def test_duplicates_are_ignored_and_other_errors_retried():
+    details = {"writeErrors": [{"index": 0, "code": 11000}, {"index": 1, "code": 121}]}
+    events = FlakyCollection(BulkWriteError(details))
+    writer = BatchWriter(flush_interval=3600)
+    writer.insert(events, {"n": 1})
+    writer.insert(events, {"n": 2})
+    writer.flush()
+    assert writer.pending() == 1
+    writer.flush()
+    assert events.batches == [[{"n": 2}]]
+    writer.close()
+
+
+def test_full_batch_is_flushed_in_the_background():
+    events = FlakyCollection()
+    writer = BatchWriter(max_batch=3, flush_interval=3600)
+    for n in range(3):
+        writer.insert(events, {"n": n})
+    deadline = time.monotonic() + 2
+    while not events.batches and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert events.batches == [[{"n": 0}, {"n": 1}, {"n": 2}]]
+    writer.close()
+
+
+def test_close_drains_everything():
+    events = FlakyCollection(AutoReconnect("down"))
+    writer = BatchWriter(flush_interval=3600)
+    writer.insert(events, {"n": 1})
+    writer.close(timeout=5)
+    assert writer.pending() == 0
+    assert events.batches == [[{"n": 1}]]
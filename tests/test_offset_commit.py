@@ -0,0 +1,55 @@
+from offset_commit import OffsetCommitter
+
+
+def make_committer(**kwargs):
+    calls = []
+    committer = OffsetCommitter(lambda offset: calls.append(("save", offset)),
+                                before_commit=lambda: calls.append(("flush",)), **kwargs)
+    return committer, calls
+
+
+def test_commits_after_max_updates():
+    committer, calls = make_committer(interval=3600, max_updates=3)
+    committer.start(10)
+    assert not committer.advance(11)
+    assert not committer.advance(12)
+    assert committer.advance(13)
+    committer.commit_if_due()
+    assert calls == [("flush",), ("save", 13)]
+    assert committer.committed == 13
+    assert not committer.pending
+
+
+def test_commits_after_interval():
+    committer, calls = make_committer(interval=0, max_updates=100)
+    committer.start(1)
+    assert committer.advance(2)
+    committer.commit_if_due()
+    assert calls == [("flush",), ("save", 2)]
+
+
+def test_nothing_to_commit():
+    committer, calls = make_committer(interval=0)
+    committer.start(5)
+    assert not committer.due()
+    committer.commit()
+    assert calls == []
+
+    unstarted, calls = make_committer()
+    unstarted.commit()
+    assert calls == []
+
+
+def test_failed_save_stays_pending():
+    def save_offset(offset):
+        raise OSError("disk full")
+
+    committer = OffsetCommitter(save_offset, interval=0)
+    committer.start(1)
+    committer.advance(2)
+    try:
+        committer.commit()
+    except OSError:
+        pass
+    assert committer.committed == 1
+    assert committer.pending
@@ -0,0 +1,24 @@
+import pytest
+
+from pricing import PRICE_TIERS, price_for_km, price_table
+
+
+@pytest.mark.parametrize("km, price", [
+    (0, 100), (0.2, 100), (5, 100),
+    (5.01, 200), (10, 200),
+    (10.5, 300), (20, 300),
+])
+def test_price_for_km_tiers(km, price):
+    assert price_for_km(km) == price
+
+
+def test_price_for_km_beyond_last_tier():
+    assert price_for_km(20.01) is None
+    assert price_for_km(500) is None
+
+
+def test_price_table_matches_tiers():
+    lines = price_table().splitlines()
+    assert len(lines) == len(PRICE_TIERS)
+    assert lines[0] == "1 - 5 km: 100 birr"
+    assert lines[-1] == "11 - 20 km: 300 birr"
@@ -0,0 +1,86 @@
+from datetime import datetime
+
+from rollups import compute_hours, hour_id, merge, migrate_timestamps, update_rollups
+
+START = datetime(2026, 10, 18, 9)
+
+
+def event(db, minute, name, step=None, hour=9):
+    doc = {"event": name, "timestamp": datetime(2026, 10, 18, hour, minute)}
+    if step is not None:
+        doc["step"] = step
+    db["bot_events"].insert_one(doc)
+
+
+def test_compute_hours_counts(db):
+    event(db, 1, "bot_start")
+    event(db, 2, "fallback")
+    event(db, 3, "step", 0)
+    event(db, 4, "step", 0)
+    event(db, 5, "step", 1)
+    event(db, 6, "cancel", 1)
+    event(db, 7, "cancel")
+    event(db, 30, "bot_start", hour=10)
+    db["deliveries"].insert_many([
+        {"created_at": datetime(2026, 10, 18, 9, 10), "payment_from_sender_or_receiver": "Sender / ላኪ",
+         "city": "Addis Ababa"},
+        {"created_at": datetime(2026, 10, 18, 9, 20), "payment_from_sender_or_receiver": "Sender / ላኪ"},
+    ])
+    db["feedback"].insert_one({"created_at": datetime(2026, 10, 18, 10, 5)})
+
+    nine, ten = compute_hours(db, START, datetime(2026, 10, 18, 11))
+    assert nine["_id"] == hour_id(START) == "hour:2026-10-18T09"
+    assert [nine[name] for name in ("starts", "sessions", "orders", "cancellations", "feedback")] == [1, 1, 2, 2, 0]
+    assert nine["funnel"] == {"0": 2, "1": 1}
+    assert nine["dropoff"] == {"0": 1}
+    assert nine["cancelled_at"] == {"1": 1}
+    assert nine["payment"] == {"Sender / ላኪ": 2}
+    assert nine["cities"] == {"Addis Ababa": 1, "unknown": 1}
+    assert (ten["starts"], ten["feedback"], ten["orders"]) == (1, 1, 0)
+
+
+def test_compute_hours_empty_range_has_zero_hours(db):
+    hours = compute_hours(db, START, datetime(2026, 10, 18, 12))
+    assert [doc["start"].hour for doc in hours] == [9, 10, 11]
+    assert all(doc["orders"] == 0 and doc["funnel"] == {} for doc in hours)
+
+
+def test_compute_hours_excludes_end(db):
+    event(db, 0, "bot_start", hour=10)
+    (nine,) = compute_hours(db, START, datetime(2026, 10, 18, 10))
+    assert nine["starts"] == 0
+
+
+def test_merge_sums_hours():
+    hours = [
+        {"starts": 1, "orders": 2, "funnel": {"0": 3, "1": 1}, "cities": {"Adama": 1}},
+        {"starts": 2, "funnel": {"1": 1}, "cities": {"Adama": 2}},
+    ]
+    day = merge(hours, "day", datetime(2026, 10, 18))
+    assert day["_id"] == "day:2026-10-18"
+    assert (day["starts"], day["orders"]) == (3, 2)
+    assert day["funnel"] == {"0": 3, "1": 2}
+    assert day["dropoff"] == {"0": 1}
+    assert day["cities"] == {"Adama": 3}
+
+
+def test_migrate_timestamps(db):
+    db["deliveries"].insert_many([
+        {"_id": 1, "timestamp": "2026-10-18 09:15:00"},
+        {"_id": 2, "timestamp": "not a date"},
+        {"_id": 3, "timestamp": "2026-10-18 09:20:00", "created_at": datetime(2026, 10, 18, 9, 20)},
+    ])
+    assert migrate_timestamps(db) == {"deliveries": 1, "feedback": 0}
+    assert db["deliveries"].find_one({"_id": 1})["created_at"] == datetime(2026, 10, 18, 9, 15)
+    assert "created_at" not in db["deliveries"].find_one({"_id": 2})
+    # Running it again changes nothing
+    assert migrate_timestamps(db) == {"deliveries": 0, "feedback": 0}
+
+
+def test_update_rollups_resumes_from_checkpoint(db):
+    event(db, 5, "bot_start")
+    now = datetime(2026, 10, 18, 11, 30)
+    assert update_rollups(db, now=now) == 2
+    assert db["rollups"].find_one({"_id": "hour:2026-10-18T09"})["starts"] == 1
+    assert db["rollups"].find_one({"_id": "day:2026-10-18"})["starts"] == 1
+    assert update_rollups(db, now=now) == 0
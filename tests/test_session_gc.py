@@ -0,0 +1,88 @@
+import threading
+import time
+
+from session_gc import SessionSweeper
+from state_store import StateStore
+
+
+def make_sweeper(tmp_path, **kwargs):
+    nudges = []
+
+    def nudge(chat_id, state):
+        nudges.append(chat_id)
+        return True
+
+    sweeper = SessionSweeper(ttl=100, nudge=nudge, interval=3600, **kwargs)
+    states = StateStore(str(tmp_path / "user_states.json"))
+    sweeper.start(states)
+    sweeper.stop()
+    return sweeper, states, nudges
+
+
+def add(sweeper, states, chat_id, state):
+    sweeper.touch(chat_id, state)
+    states[chat_id] = state
+
+
+def test_idle_session_is_evicted(tmp_path):
+    sweeper, states, nudges = make_sweeper(tmp_path)
+    add(sweeper, states, "1", {"step": 2})
+    now = states["1"]["last_active"]
+    assert sweeper.sweep(now + 99) == 0
+    assert sweeper.sweep(now + 100) == 1
+    assert "1" not in states
+    assert nudges == []
+    assert sweeper.stats() == {"active": 0, "evicted": 1, "nudged": 0}
+
+
+def test_nudge_before_eviction(tmp_path):
+    sweeper, states, nudges = make_sweeper(tmp_path, nudge_after=60)
+    add(sweeper, states, "1", {"step": 2})
+    now = states["1"]["last_active"]
+    assert sweeper.sweep(now + 60) == 0
+    assert nudges == ["1"]
+    assert states["1"]["nudged"]
+    # Only once
+    assert sweeper.sweep(now + 61) == 0
+    assert nudges == ["1"]
+    assert sweeper.sweep(now + 100) == 1
+
+
+def test_activity_postpones_eviction(tmp_path):
+    sweeper, states, nudges = make_sweeper(tmp_path)
+    add(sweeper, states, "1", {"step": 2})
+    first = states["1"]["last_active"]
+    time.sleep(0.01)
+    sweeper.touch("1", states["1"])
+    states.commit("1")
+    # The heap entry from the first touch is stale and skipped
+    assert sweeper.sweep(first + 100) == 0
+    assert sweeper.sweep(states["1"]["last_active"] + 100) == 1
+
+
+def test_states_from_before_expiry_get_a_full_ttl(tmp_path):
+    states = StateStore(str(tmp_path / "user_states.json"))
+    states["1"] = {"step": 1}
+    sweeper = SessionSweeper(ttl=100, interval=3600).start(states)
+    sweeper.stop()
+    assert states["1"]["last_active"] >= time.time() - 1
+    assert sweeper.sweep(time.time() + 50) == 0
+
+
+def test_sweep_waits_for_the_chat_being_handled(tmp_path):
+    sweeper, states, nudges = make_sweeper(tmp_path)
+    add(sweeper, states, "1", {"step": 2})
+    due = states["1"]["last_active"] + 100
+    results = []
+    with sweeper.chat_lock("1"):
+        thread = threading.Thread(target=lambda: results.append(sweeper.sweep(due)))
+        thread.start()
+        time.sleep(0.05)
+        assert thread.is_alive()
+        # The handler answers and touches the chat before letting go
+        states["1"]["step"] = 3
+        sweeper.touch("1", states["1"])
+        states.commit("1")
+    thread.join()
+    assert results == [0]
+    assert states["1"]["step"] == 3
@@ -0,0 +1,89 @@
+from datetime import datetime, timedelta
+
+import pytest
+
+from sms_dispatch import AfroMessageClient, SmsOutbox
+from stub_servers import AfroMessageStub
+
+
+@pytest.fixture
+def afro():
+    stub = AfroMessageStub().start()
+    yield stub
+    stub.stop()
+
+
+@pytest.fixture
+def outbox(db, afro):
+    client = AfroMessageClient("token", "sender", base_url=afro.url)
+    outbox = SmsOutbox(db["sms_outbox"], client, workers=2, base_delay=30)
+    yield outbox
+    outbox.stop()
+
+
+def test_enqueue_is_idempotent(outbox):
+    assert outbox.enqueue("6712ab12cd34", "sender", "0911223344", "hi")
+    assert not outbox.enqueue("6712ab12cd34", "sender", "0911223344", "hi")
+    assert outbox.enqueue("6712ab12cd34", "receiver", "0911556677", "hi")
+    assert outbox.collection.count_documents({}) == 2
+
+
+def test_run_once_sends_and_marks_sent(outbox, afro):
+    outbox.enqueue("6712ab12cd34", "sender", "0911223344", "hello")
+    outbox.enqueue("6712ab12cd34", "receiver", "0911556677", "hello")
+    assert outbox.run_once() == 2
+    assert sorted(sms["to"] for sms in afro.sent) == ["0911223344", "0911556677"]
+    for doc in outbox.collection.find():
+        assert doc["status"] == "sent"
+        assert doc["attempts"] == 1
+        assert "claim" not in doc and "lease_until" not in doc
+    # Nothing is due any more
+    assert outbox.run_once() == 0
+    assert len(afro.sent) == 2
+
+
+def test_failure_is_retried_with_backoff(outbox, afro):
+    outbox.enqueue("6712ab12cd34", "sender", "0911223344", "hello")
+    afro.failure_rate = 1.0
+    before = datetime.utcnow()
+    assert outbox.run_once() == 1
+    doc = outbox.collection.find_one()
+    assert doc["status"] == "pending"
+    assert doc["attempts"] == 1
+    assert "stub failure" in doc["last_error"]
+    assert doc["next_attempt_at"] >= before + timedelta(seconds=30)
+    # Not due until the backoff has passed
+    assert outbox.run_once() == 0
+
+    afro.failure_rate = 0.0
+    outbox.collection.update_one({"_id": doc["_id"]}, {"$set": {"next_attempt_at": datetime.utcnow()}})
+    assert outbox.run_once() == 1
+    doc = outbox.collection.find_one()
+    assert doc["status"] == "sent"
+    assert doc["attempts"] == 2
+    assert len(afro.sent) == 1
+
+
+def test_gives_up_after_max_attempts(outbox, afro):
+    outbox.max_attempts = 1
+    afro.failure_rate = 1.0
+    outbox.enqueue("6712ab12cd34", "sender", "0911223344", "hello")
+    assert outbox.run_once() == 1
+    assert outbox.collection.find_one()["status"] == "failed"
+    assert outbox.run_once() == 0
+
+
+def test_expired_claim_is_picked_up_again(outbox, afro):
+    outbox.enqueue("6712ab12cd34", "sender", "0911223344", "hello")
+    outbox.collection.update_one({}, {"$set": {"status": "sending", "claim": "dead-worker",
+                                               "lease_until": datetime.utcnow() - timedelta(seconds=1)}})
+    assert outbox.run_once() == 1
+    assert outbox.collection.find_one()["status"] == "sent"
+
+
+def test_live_claim_is_left_alone(outbox, afro):
+    outbox.enqueue("6712ab12cd34", "sender", "0911223344", "hello")
+    outbox.collection.update_one({}, {"$set": {"status": "sending", "claim": "other-worker",
+                                               "lease_until": datetime.utcnow() + timedelta(minutes=2)}})
+    assert outbox.run_once() == 0
+    assert afro.sent == []
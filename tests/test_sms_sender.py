@@ -0,0 +1,34 @@
+import pytest
+
+import sms_sender
+
+
+class FakeResponse:
+    def __init__(self, payload):
+        self.payload = payload
+
+    def json(self):
+        return self.payload
+
+
+@pytest.fixture
+def nominatim(monkeypatch):
+    responses = []
+    monkeypatch.setattr(sms_sender.requests, "get", lambda *args, **kwargs: FakeResponse(responses.pop(0)))
+    return responses
+
+
+def test_reverse_geocode(nominatim):
+    nominatim.append({"display_name": "Bole, Addis Ababa, Ethiopia",
+                      "address": {"city": "Addis Ababa", "postcode": "1000", "country": "Ethiopia"}})
+    assert sms_sender.reverse_geocode(9.0, 38.78) == {
+        "full_address": "Bole, Addis Ababa, Ethiopia", "city": "Addis Ababa",
+        "postcode": "1000", "country": "Ethiopia",
+    }
+
+
+def test_reverse_geocode_failure_is_empty(nominatim):
+    nominatim.extend([{"error": "Unable to geocode"}, {"address": {"country": "Ethiopia"}}])
+    # Empty, so neither the cache nor the saved order treats it as resolved
+    assert sms_sender.reverse_geocode(0.0, 0.0) == {}
+    assert sms_sender.reverse_geocode(0.0, 0.0) == {}
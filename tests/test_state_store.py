@@ -0,0 +1,55 @@
+import json
+
+from state_store import StateStore
+
+
+def make_store(tmp_path, **kwargs):
+    return StateStore(str(tmp_path / "user_states.json"), **kwargs)
+
+
+def test_state_survives_restart(tmp_path):
+    states = make_store(tmp_path)
+    states["1"] = {"step": 2, "data": {"pickup": "ቦሌ"}}
+    states["2"] = {"step": 0, "data": {}}
+    del states["2"]
+    states.flush()
+
+    reopened = make_store(tmp_path)
+    assert dict(reopened.items()) == {"1": {"step": 2, "data": {"pickup": "ቦሌ"}}}
+
+
+def test_truncated_journal_record_is_skipped(tmp_path):
+    states = make_store(tmp_path)
+    states["1"] = {"step": 1}
+    states["2"] = {"step": 4}
+    states.flush()
+    with open(states.journal_path, "a", encoding="utf-8") as f:
+        f.write('{"chat_id": "3", "state": {"st')
+
+    reopened = make_store(tmp_path)
+    assert dict(reopened.items()) == {"1": {"step": 1}, "2": {"step": 4}}
+    # Replaying compacts, so the broken line is gone
+    assert open(reopened.journal_path).read() == ""
+    with open(reopened.snapshot_path, encoding="utf-8") as f:
+        assert json.load(f) == {"1": {"step": 1}, "2": {"step": 4}}
+
+
+def test_only_committed_changes_are_saved(tmp_path):
+    states = make_store(tmp_path)
+    states["1"] = {"step": 1}
+    states["1"]["step"] = 2
+    states.close()
+    assert make_store(tmp_path)["1"] == {"step": 1}
+
+
+def test_flush_every_and_compact_every(tmp_path):
+    states = make_store(tmp_path, flush_every=2, compact_every=4)
+    states["1"] = {"step": 1}
+    states["2"] = {"step": 1}
+    with open(states.journal_path, encoding="utf-8") as f:
+        assert len(f.readlines()) == 2
+    states["3"] = {"step": 1}
+    states["4"] = {"step": 1}
+    # Four journal records trigger a compaction
+    assert open(states.journal_path).read() == ""
+    assert len(make_store(tmp_path)) == 4
@@ -0,0 +1,131 @@
+import threading
+import time
+
+import pytest
+
+import telegram_outbox
+from telegram_outbox import OutboundDispatcher, TokenBucket
+
+
+class FakeResponse:
+    def __init__(self, status_code, payload=None):
+        self.status_code = status_code
+        self.payload = payload or {"ok": status_code == 200}
+        self.text = str(self.payload)
+
+    def json(self):
+        return self.payload
+
+
+class FakeSession:
+    """Stands in for requests.Session; ``script[chat_id]`` lists responses to give first."""
+
+    def __init__(self):
+        self.script = {}
+        self.sent = []
+        self.lock = threading.Lock()
+
+    def post(self, url, data, timeout):
+        chat_id = data["chat_id"]
+        with self.lock:
+            script = self.script.get(chat_id)
+            response = script.pop(0) if script else FakeResponse(200)
+            if response.status_code == 200:
+                self.sent.append((chat_id, data["text"], time.monotonic()))
+        return response
+
+    def close(self):
+        pass
+
+
+@pytest.fixture
+def outbox():
+    outbox = OutboundDispatcher("http://telegram.invalid/botTOKEN", workers=1)
+    outbox.session = FakeSession()
+    yield outbox
+    outbox.close()
+
+
+def rate_limited(seconds):
+    return FakeResponse(429, {"ok": False, "error_code": 429, "parameters": {"retry_after": seconds}})
+
+
+def test_token_bucket():
+    bucket = TokenBucket(rate=10, capacity=2)
+    assert bucket.reserve() == 0
+    assert bucket.reserve() == 0
+    assert bucket.reserve() == pytest.approx(0.1, abs=0.01)
+    assert bucket.reserve() == pytest.approx(0.2, abs=0.01)
+    assert not bucket.is_full()
+
+
+def test_messages_keep_their_order(outbox):
+    for n in range(10):
+        outbox.send(1, f"a{n}")
+        outbox.send(2, f"b{n}")
+    outbox.close()
+    sent = outbox.session.sent
+    assert [text for chat_id, text, _ in sent if chat_id == 1] == [f"a{n}" for n in range(10)]
+    assert [text for chat_id, text, _ in sent if chat_id == 2] == [f"b{n}" for n in range(10)]
+    assert outbox.stats()["sent"] == 20
+
+
+def test_rate_limited_chat_doesnt_hold_up_others(outbox):
+    # Both chats share the single worker
+    outbox.session.script[1] = [rate_limited(0.3)]
+    started = time.monotonic()
+    outbox.send(1, "a1")
+    outbox.send(1, "a2")
+    outbox.send(2, "b1")
+    outbox.close()
+    sent = {text: at - started for _, text, at in outbox.session.sent}
+    assert sent["b1"] < 0.2
+    assert sent["a1"] >= 0.3
+    # Nothing overtakes the message waiting for its retry
+    assert [text for _, text, _ in outbox.session.sent if text.startswith("a")] == ["a1", "a2"]
+
+
+def test_per_chat_rate(outbox, monkeypatch):
+    monkeypatch.setattr(telegram_outbox, "PER_CHAT_RATE", 20)
+    monkeypatch.setattr(telegram_outbox, "PER_CHAT_BURST", 1)
+    for n in range(5):
+        outbox.send(1, str(n))
+    outbox.send(2, "other")
+    outbox.close()
+    times = [at for chat_id, _, at in outbox.session.sent if chat_id == 1]
+    assert times[-1] - times[0] >= 4 / 20 * 0.9
+    # The other chat went out while chat 1 waited for its bucket
+    assert [chat_id for chat_id, _, _ in outbox.session.sent].index(2) < 4
+
+
+def test_gives_up_after_max_retries(outbox):
+    outbox.max_retries = 2
+    outbox.session.script[1] = [rate_limited(0)] * 3
+    outbox.send(1, "never")
+    outbox.send(1, "next")
+    outbox.close()
+    assert [text for _, text, _ in outbox.session.sent] == ["next"]
+    assert outbox.stats()["failed"] == 1
+
+
+def test_rejected_message_is_not_retried(outbox):
+    outbox.session.script[1] = [FakeResponse(400, {"ok": False, "description": "chat not found"})]
+    outbox.send(1, "hello")
+    outbox.close()
+    assert outbox.session.sent == []
+    assert outbox.stats()["failed"] == 1
+
+
+def test_coalesce(outbox):
+    outbox.coalesce = True
+    messages = [("one", None), ("two", None), ("pick one", {"keyboard": []}), ("after", None)]
+    # Queued before the worker looks, so they are all waiting together
+    with outbox._conditions[0]:
+        outbox._ensure_started()
+        for text, reply_markup in messages:
+            outbox._queues[0].append({"chat_id": 1, "text": text, "reply_markup": reply_markup,
+                                      "queued_at": time.monotonic()})
+        outbox._conditions[0].notify()
+    outbox.close()
+    # A keyboard stays on the last message it is joined to
+    assert [text for _, text, _ in outbox.session.sent] == ["one\n\ntwo\n\npick one", "after"]
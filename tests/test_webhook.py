@@ -0,0 +1,82 @@
+import threading
+import time
+
+import pytest
+
+from webhook import WebhookServer
+
+SECRET = "s3cret"
+
+
+class FakeStates:
+    flush_interval = 0.05
+
+    def __init__(self):
+        self.flushes = 0
+
+    def flush_if_due(self):
+        self.flushes += 1
+
+
+def update(update_id, chat_id=1):
+    return {"update_id": update_id, "message": {"message_id": update_id, "chat": {"id": chat_id}, "text": "hi"}}
+
+
+@pytest.fixture
+def handled():
+    return []
+
+
+@pytest.fixture
+def server(handled):
+    def handle_update(update, states):
+        time.sleep(0.01)
+        handled.append(update["update_id"])
+
+    return WebhookServer(handle_update, FakeStates(), SECRET, workers=2, queue_size=100)
+
+
+def post(server, body, secret=SECRET):
+    headers = {"X-Telegram-Bot-Api-Secret-Token": secret} if secret is not None else {}
+    return server.app.test_client().post("/webhook", json=body, headers=headers)
+
+
+def test_secret_is_checked(server):
+    assert post(server, update(1), secret=None).status_code == 403
+    assert post(server, update(1), secret="wrong").status_code == 403
+    assert post(server, update(1)).status_code == 200
+    assert server.queue_depth() == 1
+
+
+def test_missing_secret_refuses_everything():
+    server = WebhookServer(lambda update, states: None, FakeStates(), "")
+    assert post(server, update(1), secret="").status_code == 403
+
+
+def test_malformed_update(server):
+    assert post(server, {"message": {}}).status_code == 400
+    assert post(server, ["not", "a", "dict"]).status_code == 400
+
+
+def test_full_queue_asks_for_redelivery():
+    server = WebhookServer(lambda update, states: None, FakeStates(), SECRET, workers=1, queue_size=1)
+    assert post(server, update(1)).status_code == 200
+    assert post(server, update(2)).status_code == 503
+
+
+def test_stop_drains_acknowledged_updates(server, handled):
+    server.start_workers()
+    for update_id in range(1, 21):
+        assert post(server, update(update_id, chat_id=update_id % 3)).status_code == 200
+    server.stop()
+    assert sorted(handled) == list(range(1, 21))
+    assert not any(thread.is_alive() for thread in threading.enumerate() if thread.name.startswith("webhook-worker"))
+    # Refused once stopping, so Telegram redelivers to the next dyno
+    assert post(server, update(21)).status_code == 503
+
+
+def test_dispatch_mode():
+    accepted = []
+    server = WebhookServer(None, None, SECRET, dispatch=lambda update: accepted.append(update) or len(accepted) < 2)
+    assert post(server, update(1)).status_code == 200
+    assert post(server, update(2)).status_code == 503
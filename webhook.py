@@ -0,0 +1,124 @@
+import hmac
+import logging
+import queue
+import threading
+import zlib
+
+import requests
+from flask import Flask, jsonify, request
+
+from async_runtime import update_chat_id
+from metrics import CONTENT_TYPE, REGISTRY, gauge
+
+
+def set_webhook(api_url, webhook_url, secret_token, max_connections=40):
+    response = requests.post(f"{api_url}/setWebhook", json={
+        "url": webhook_url,
+        "secret_token": secret_token,
+        "max_connections": max_connections,
+        "allowed_updates": ["message", "callback_query"],
+    }, timeout=30)
+    return response.json().get("ok", False)
+
+
+def delete_webhook(api_url):
+    """getUpdates is refused while a webhook is set, so polling clears it first."""
+    response = requests.post(f"{api_url}/deleteWebhook", timeout=30)
+    return response.json().get("ok", False)
+
+
+class WebhookServer:
+    """Receives Telegram updates over HTTP and hands them to worker threads.
+
+    Requests are checked against the ``X-Telegram-Bot-Api-Secret-Token``
+    header and acknowledged as soon as the update is queued. Each chat is
+    hashed onto one worker queue so its updates keep their order. When a
+    queue is full the request gets a 503 and Telegram redelivers it later.
+    ``stop()`` refuses new updates the same way and waits until every
+    acknowledged one has been handled.
+
+    In cluster mode ``dispatch`` replaces the local queues: it is called with
+    each update and returns False when the update can't be accepted.
+    """
+
+    def __init__(self, handle_update, states, secret_token, workers=8, queue_size=1000,
+                 path="/webhook", dispatch=None):
+        self.handle_update = handle_update
+        self.states = states
+        self.secret_token = secret_token
+        self.dispatch = dispatch
+        self._queues = [queue.Queue(maxsize=max(1, queue_size // workers)) for _ in range(workers)]
+        self._threads = []
+        self._stopping = threading.Event()
+
+        self.app = Flask(__name__)
+        self.app.add_url_rule(path, "webhook", self._receive, methods=["POST"])
+        self.app.add_url_rule("/health", "health", lambda: jsonify(ok=True))
+        self.app.add_url_rule("/metrics", "metrics", lambda: (REGISTRY.render(), 200, {"Content-Type": CONTENT_TYPE}))
+        gauge("webhook_queue_depth", "Updates accepted but not yet handled", fn=self.queue_depth)
+
+    def _receive(self):
+        if self._stopping.is_set():
+            return jsonify(ok=False), 503
+        token = request.headers.get("X-Telegram-Bot-Api-Secret-Token", "")
+        if not self.secret_token or not hmac.compare_digest(token, self.secret_token):
+            return jsonify(ok=False), 403
+        update = request.get_json(silent=True)
+        if not isinstance(update, dict) or "update_id" not in update:
+            return jsonify(ok=False), 400
+
+        if self.dispatch is not None:
+            if not self.dispatch(update):
+                return jsonify(ok=False), 503
+            return jsonify(ok=True)
+
+        chat_id = update_chat_id(update)
+        index = zlib.crc32(str(chat_id).encode()) % len(self._queues)
+        try:
+            self._queues[index].put_nowait(update)
+        except queue.Full:
+            logging.warning("Webhook queue %s full, asking Telegram to retry update %s", index, update["update_id"])
+            return jsonify(ok=False), 503
+        return jsonify(ok=True)
+
+    def _worker(self, index):
+        updates = self._queues[index]
+        while True:
+            try:
+                update = updates.get(timeout=self.states.flush_interval)
+            except queue.Empty:
+                if self._stopping.is_set():
+                    return
+                self.states.flush_if_due()
+                continue
+            try:
+                self.handle_update(update, self.states)
+            except Exception as e:
+                logging.error("Failed to handle update %s: %s", update.get("update_id"), e, exc_info=True)
+            finally:
+                updates.task_done()
+            self.states.flush_if_due()
+
+    def queue_depth(self):
+        return sum(q.qsize() for q in self._queues)
+
+    def start_workers(self):
+        for index in range(len(self._queues)):
+            thread = threading.Thread(target=self._worker, args=(index,),
+                                      name=f"webhook-worker-{index}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self):
+        """Refuse new updates, then wait for the workers to handle every queued one."""
+        self._stopping.set()
+        for updates in self._queues:
+            updates.join()
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+
+    def run(self, host="0.0.0.0", port=8080):
+        if self.dispatch is None:
+            self.start_workers()
+        self.app.run(host=host, port=port, threaded=True)